@@ -1,24 +1,81 @@
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from jose import jwt
-from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from jose import jwt, JWTError
+from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import event
+import os
+import threading
+import time
 import models
-from database import get_main_db
+import request_timing
+from database import MainSessionLocal
+from response_cache import ResponseCache
+from passwords import hash_password
 
 SECRET_KEY = "your-secret-key-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Verified tokens and their user, so authenticated requests skip the JWT decode
+# and the users query. A changed user is dropped at once in this worker; other
+# workers see the change within the TTL.
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", "1024"))
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", "60"))
+token_cache = ResponseCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+# Rejected requests by reason
+auth_failures = {"invalid_token": 0, "expired_token": 0, "unknown_user": 0}
+_auth_failures_lock = threading.Lock()
+
 security = HTTPBearer()
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# Login attempts allowed per username and client address within the window,
+# and failed attempts per client address over all usernames (so trying many usernames is capped too)
+LOGIN_RATE_LIMIT = int(os.environ.get("LOGIN_RATE_LIMIT", "10"))
+LOGIN_IP_RATE_LIMIT = int(os.environ.get("LOGIN_IP_RATE_LIMIT", "50"))
+LOGIN_RATE_WINDOW = float(os.environ.get("LOGIN_RATE_WINDOW", "60"))
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return hash_password(password)
+
+class RateLimiter:
+    """Sliding-window counter per key; thread-safe"""
+
+    def __init__(self, limit: int, window: float, clock=time.monotonic):
+        self.limit = limit
+        self.window = window
+        self._clock = clock
+        self._events = {}
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def retry_after(self, key) -> float:
+        """Seconds until key may try again, 0 when it is within the limit"""
+        now = self._clock()
+        with self._lock:
+            events = self._prune(key, now)
+            if len(events) < self.limit:
+                return 0.0
+            self.rejected += 1
+            return events[0] + self.window - now
+
+    def hit(self, key):
+        now = self._clock()
+        with self._lock:
+            self._prune(key, now).append(now)
+
+    def _prune(self, key, now) -> list:
+        """Events of key still inside the window (lock held); idle keys are dropped"""
+        if len(self._events) > 10000:
+            for stale in [k for k, v in self._events.items() if not v or v[-1] <= now - self.window]:
+                del self._events[stale]
+        events = [t for t in self._events.get(key, ()) if t > now - self.window]
+        self._events[key] = events
+        return events
+
+login_limiter = RateLimiter(LOGIN_RATE_LIMIT, LOGIN_RATE_WINDOW)
+login_ip_limiter = RateLimiter(LOGIN_IP_RATE_LIMIT, LOGIN_RATE_WINDOW)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -26,22 +83,88 @@ def create_access_token(data: dict):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_main_db)):
+@dataclass(frozen=True)
+class AuthenticatedUser:
+    """The fields of a User that requests need, safe to share between threads"""
+    id: int
+    username: str
+    is_admin: bool
+
+def reject(reason: str, detail: str):
+    with _auth_failures_lock:
+        auth_failures[reason] += 1
+    raise HTTPException(status_code=401, detail=detail)
+
+def load_user(username: str):
+    """The user named username, or None; opens a main.db session only for this lookup"""
+    db = MainSessionLocal()
     try:
+        db_user = db.query(models.User).filter(models.User.username == username).first()
+    finally:
+        db.close()
+    if db_user is None:
+        return None
+    return AuthenticatedUser(id=db_user.id, username=db_user.username, is_admin=bool(db_user.is_admin))
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # No main.db session dependency: cache hits, the common case, never need one
+    with request_timing.span("auth"):
         token = credentials.credentials
+        cached = token_cache.get(token)
+        if cached is not None:
+            user, expires_at = cached
+            if expires_at > time.time():
+                return user
+            token_cache.invalidate(("token", token))
+
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except jwt.ExpiredSignatureError:
+            reject("expired_token", "Token expired")
+        except JWTError:
+            reject("invalid_token", "Invalid token")
+        username = payload.get("sub")
+        if not isinstance(username, str):
+            reject("invalid_token", "Invalid token")
+
+        user = load_user(username)
+        if user is None:
+            reject("unknown_user", "User not found")
+        token_cache.put(token, (user, payload.get("exp", 0)), tags=[("token", token), ("user", username)])
+        return user
+
+def is_admin_token(token: str) -> bool:
+    """Whether token belongs to an admin; for optional admin features, so failures are not counted"""
+    cached = token_cache.get(token)
+    if cached is not None:
+        user, expires_at = cached
+        return expires_at > time.time() and user.is_admin
+    try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
-    return user
-
-def require_admin(current_user: models.User = Depends(get_current_user)):
+    except JWTError:
+        return False
+    username = payload.get("sub")
+    if not isinstance(username, str):
+        return False
+    user = load_user(username)
+    return user is not None and user.is_admin
+
+def invalidate_user(username: str):
+    """Forget the cached tokens of a user, e.g. after its admin flag changed"""
+    token_cache.invalidate(("user", username))
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def forget_changed_user(mapper, connection, target):
+    invalidate_user(target.username)
+
+def auth_stats() -> dict:
+    with _auth_failures_lock:
+        failures = dict(auth_failures)
+    return {"token_cache": token_cache.stats(), "failures": failures, "login_rate_limited": login_limiter.rejected,
+            "login_ip_rate_limited": login_ip_limiter.rejected}
+
+def require_admin(current_user: AuthenticatedUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
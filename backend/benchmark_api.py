@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+后端API负载基准 - 按真实用量合成数据，混合查看者/编辑者/导入者压测各接口
+
+数据规模默认与线上一致：10个计划 × 10个阶段 × 20个类别 × 20个子类别 × 每个子类别1000行
+（约4000万行，首次生成需要较长时间；--workdir 指定目录后可重复使用已生成的数据，
+ --preset small 用小规模数据快速跑一遍）。
+
+三类并发用户在 --seconds 时间内循环请求：
+  - 查看者: 计划概览、阶段类别、子类别分页（随机页）、可视化；按浏览器的方式带If-None-Match
+  - 编辑者: 修改单行数据、修改子类别描述
+  - 导入者: 向随机子类别上传整表CSV（覆盖导入）
+--target inprocess 经ASGI直接调用应用；--target http 在数据目录下启动uvicorn，经真实HTTP请求。
+
+输出每个接口的请求数、出错数、p50/p95/p99延迟、总吞吐和数据库文件大小。
+--save-baseline 保存结果，之后用 --baseline 对比。benchmark_baseline.json 是一次参考运行
+（--preset small --seconds 30，其余参数取默认值）的结果，改动后可直接 --baseline benchmark_baseline.json 对比；
+绝对延迟随机器而变，应在同一台机器上先重跑一份再比较。
+
+运行: cd backend && python benchmark_api.py [--preset full|small] [--target inprocess|http]
+      [--viewers 50] [--editors 2] [--importers 1] [--seconds 60] [--workdir DIR]
+      [--save-baseline baseline.json] [--baseline baseline.json]
+"""
+import argparse
+import asyncio
+import csv
+import glob
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark_common import BACKEND_DIR, create_bench_admin, latency_summary
+
+PRESETS = {
+    # 线上实际用量
+    "full": {"plans": 10, "stages": 10, "categories": 20, "subcategories": 20, "rows": 1000},
+    "small": {"plans": 2, "stages": 3, "categories": 4, "subcategories": 5, "rows": 200},
+}
+
+BENCH_USER = "bench_admin"
+
+DETAIL_ROUTE = "/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}"
+
+# 查看者打开各页面的比例
+VIEWER_ROUTES = (
+    (DETAIL_ROUTE, 0.5),
+    ("/api/plans/{plan_name}/stages/{stage_name}/categories", 0.25),
+    ("/api/plan{plan_name}", 0.15),
+    ("/api/plans/{plan_name}/visualization", 0.1),
+)
+
+
+def plan_name(index: int) -> str:
+    return f"bench{index:02d}"
+
+
+def stage_name(index: int) -> str:
+    return f"s{index:02d}"
+
+
+def category_name(index: int) -> str:
+    return f"c{index:02d}"
+
+
+def subcategory_name(index: int) -> str:
+    return f"sc{index:02d}"
+
+
+def dataset_rows(count: int, seed: int) -> list:
+    """Rows of one subcategory, keyed 1..count, with paths and token counts like the real sheets"""
+    rnd = random.Random(seed)
+    return [{
+        "key": key,
+        "hdfs_path": f"/user/data/v3/{seed}/part-{key:05d}",
+        "obs_fuzzy_path": f"obs://bucket/{seed}/*",
+        "obs_full_path": f"obs://bucket/{seed}/part-{key:05d}.jsonl",
+        "token_count": str(rnd.randint(1_000, 5_000_000)),
+        "actual_usage": rnd.choice(["是", "否", ""]),
+        "actual_token": str(rnd.randint(0, 1_000_000)),
+    } for key in range(1, count + 1)]
+
+
+def seed_database(scale: dict):
+    """Create the bench admin, the plans and all their rows in the current directory (imports main)"""
+    sys.path.insert(0, BACKEND_DIR)
+    from fastapi.testclient import TestClient
+    import main
+    from database import get_plan_session
+
+    headers = create_bench_admin(BENCH_USER)
+    client = TestClient(main.app)
+
+    for p in range(scale["plans"]):
+        name = plan_name(p)
+        client.post("/api/plans", json={"name": name}, headers=headers)
+        stages = {
+            stage_name(s): {
+                "rows": [{"category": category_name(c), "subcategory": subcategory_name(sc)}
+                         for c in range(scale["categories"]) for sc in range(scale["subcategories"])],
+                "merges": []
+            } for s in range(scale["stages"])
+        }
+        client.post(f"/api/plan{name}", json={"description": f"benchmark plan {name}", "stages": stages}, headers=headers)
+
+        # 数据行直接走upsert，不经HTTP，一个阶段一次提交
+        plan_db = get_plan_session(name)
+        try:
+            for s in range(scale["stages"]):
+                for c in range(scale["categories"]):
+                    for sc in range(scale["subcategories"]):
+                        detail = main.get_or_create_category_detail(
+                            plan_db, stage_name(s), category_name(c), subcategory_name(sc)
+                        )
+                        seed = ((p * 100 + s) * 100 + c) * 100 + sc
+                        main.upsert_dataset_rows(plan_db, detail, dataset_rows(scale["rows"], seed))
+                plan_db.commit()
+        finally:
+            plan_db.close()
+        print(f"seeded {name}", file=sys.stderr)
+
+    with open("bench_scale.json", "w") as f:
+        json.dump(scale, f)
+
+
+def database_sizes(workdir: str) -> dict:
+    def size(paths):
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    plan_files = glob.glob(os.path.join(workdir, "databases", "*.db"))
+    plan_sizes = [size([path, path + "-wal", path + "-shm"]) for path in plan_files]
+    main_db = os.path.join(workdir, "main.db")
+    return {
+        "main_db_bytes": size([main_db, main_db + "-wal", main_db + "-shm"]),
+        "plan_db_count": len(plan_files),
+        "plan_db_total_bytes": sum(plan_sizes),
+        "plan_db_max_bytes": max(plan_sizes, default=0),
+    }
+
+
+class Recorder:
+    """Latencies and errors per endpoint label"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, label: str, elapsed: float, ok: bool):
+        if ok:
+            self.latencies.setdefault(label, []).append(elapsed)
+        else:
+            self.errors[label] = self.errors.get(label, 0) + 1
+
+    def summary(self, seconds: float) -> dict:
+        endpoints = {}
+        for label in sorted(set(self.latencies) | set(self.errors)):
+            endpoints[label] = {**latency_summary(self.latencies.get(label, []), seconds), "errors": self.errors.get(label, 0)}
+        return endpoints
+
+
+async def run_load(client, headers: dict, scale: dict, viewers: int, editors: int, importers: int,
+                   seconds: float) -> dict:
+    """Drive the app with the three user kinds until the time is up"""
+    recorder = Recorder()
+    deadline = time.perf_counter() + seconds
+
+    def random_subcategory(rnd):
+        return {
+            "plan_name": plan_name(rnd.randrange(scale["plans"])),
+            "stage_name": stage_name(rnd.randrange(scale["stages"])),
+            "category_name": category_name(rnd.randrange(scale["categories"])),
+            "subcategory_name": subcategory_name(rnd.randrange(scale["subcategories"])),
+        }
+
+    async def timed(label, request):
+        started = time.perf_counter()
+        try:
+            response = await request
+            ok = response.status_code < 400
+        except Exception:
+            response, ok = None, False
+        recorder.record(label, time.perf_counter() - started, ok)
+        return response
+
+    async def viewer(index):
+        rnd = random.Random(index)
+        etags = {}
+        pages = max(1, scale["rows"] // 20)
+        routes, weights = zip(*VIEWER_ROUTES)
+        while time.perf_counter() < deadline:
+            route = rnd.choices(routes, weights)[0]
+            path = route.format(**random_subcategory(rnd))
+            if route == DETAIL_ROUTE:
+                path += f"?page={rnd.randint(1, pages)}&page_size=20"
+            request_headers = {"If-None-Match": etags[path]} if path in etags else {}
+            response = await timed("GET " + route, client.get(path, headers=request_headers))
+            if response is not None and response.status_code == 200 and "etag" in response.headers:
+                etags[path] = response.headers["etag"]
+
+    async def editor(index):
+        rnd = random.Random(10_000 + index)
+        while time.perf_counter() < deadline:
+            target = random_subcategory(rnd)
+            base = DETAIL_ROUTE.format(**target)
+            if rnd.random() < 0.9:
+                row = {"key": rnd.randint(1, scale["rows"]), "hdfs_path": f"/user/data/edited/{rnd.random()}",
+                       "token_count": str(rnd.randint(1_000, 5_000_000)), "actual_token": str(rnd.randint(0, 1_000_000))}
+                await timed("PATCH " + DETAIL_ROUTE + "/row",
+                            client.patch(base + "/row", json=row, headers=headers))
+            else:
+                await timed("PATCH " + DETAIL_ROUTE + "/description",
+                            client.patch(base + "/description", json={"description": f"edited {rnd.random()}"},
+                                         headers=headers))
+
+    async def importer(index):
+        rnd = random.Random(20_000 + index)
+        while time.perf_counter() < deadline:
+            target = random_subcategory(rnd)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(["hdfs", "obs_fuzzy", "obs_full", "token", "usage", "actual"])
+            for row in dataset_rows(scale["rows"], rnd.randrange(1 << 30)):
+                writer.writerow([row["hdfs_path"], row["obs_fuzzy_path"], row["obs_full_path"],
+                                 row["token_count"], row["actual_usage"], row["actual_token"]])
+            files = {"file": ("rows.csv", buffer.getvalue().encode("utf-8"), "text/csv")}
+            await timed("POST " + DETAIL_ROUTE + "/import",
+                        client.post(DETAIL_ROUTE.format(**target) + "/import", files=files, headers=headers))
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(viewer(i) for i in range(viewers)),
+        *(editor(i) for i in range(editors)),
+        *(importer(i) for i in range(importers)),
+    )
+    elapsed = time.perf_counter() - started
+    endpoints = recorder.summary(elapsed)
+    total = sum(endpoint["requests"] for endpoint in endpoints.values())
+    return {
+        "seconds": round(elapsed, 1),
+        "requests": total,
+        "per_second": round(total / elapsed, 1),
+        "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+        "endpoints": endpoints,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_target(args, scale: dict, headers: dict) -> dict:
+    import httpx
+
+    load = (scale, args.viewers, args.editors, args.importers, args.seconds)
+    limits = httpx.Limits(max_connections=args.viewers + args.editors + args.importers)
+    if args.target == "inprocess":
+        import main
+        transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            return await run_load(client, headers, *load)
+
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=os.getcwd(), env={**os.environ, "PYTHONPATH": BACKEND_DIR}
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None, limits=limits) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/api/plans")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.2)
+            else:
+                raise RuntimeError("uvicorn did not start")
+            return await run_load(client, headers, *load)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def print_results(results: dict, baseline: dict = None):
+    config = results["config"]
+    print(f"target={config['target']} viewers={config['viewers']} editors={config['editors']} "
+          f"importers={config['importers']} seconds={config['seconds']:g} scale={config['scale']}")
+    columns = ("requests", "errors", "per_second", "p50_ms", "p95_ms", "p99_ms")
+    width = max([len(label) for label in results["endpoints"]] + [8])
+    print(f"{'endpoint':<{width}}" + "".join(f"{column:>12}" for column in columns))
+    for label, endpoint in results["endpoints"].items():
+        print(f"{label:<{width}}" + "".join(f"{endpoint[column]:>12}" for column in columns))
+        before = (baseline or {}).get("endpoints", {}).get(label)
+        if before:
+            deltas = []
+            for column in columns:
+                if before[column]:
+                    deltas.append(f"{(endpoint[column] - before[column]) / before[column] * 100:+.0f}%")
+                else:
+                    deltas.append("-")
+            print(f"{'  vs baseline':<{width}}" + "".join(f"{delta:>12}" for delta in deltas))
+    print(f"total: {results['requests']} requests, {results['per_second']} req/s, {results['errors']} errors")
+    if baseline:
+        print(f"baseline: {baseline['requests']} requests, {baseline['per_second']} req/s, {baseline['errors']} errors")
+    for key, value in results["database"].items():
+        line = f"{key}: {value}"
+        if baseline and key in baseline.get("database", {}):
+            line += f" (baseline {baseline['database'][key]})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="full")
+    for key in PRESETS["full"]:
+        parser.add_argument(f"--{key}", type=int, help=f"override the preset's {key}")
+    parser.add_argument("--target", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for --target http")
+    parser.add_argument("--viewers", type=int, default=50)
+    parser.add_argument("--editors", type=int, default=2)
+    parser.add_argument("--importers", type=int, default=1)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--workdir", help="data directory; reused when it already holds generated data")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    args = parser.parse_args()
+
+    scale = dict(PRESETS[args.preset])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="bench_api_"))
+    os.makedirs(workdir, exist_ok=True)
+    # database.py 在导入时按当前目录建库
+    os.chdir(workdir)
+    scale_path = os.path.join(workdir, "bench_scale.json")
+    if os.path.exists(scale_path):
+        with open(scale_path) as f:
+            existing = json.load(f)
+        if existing != scale:
+            sys.exit(f"{workdir} holds data of scale {existing}, not {scale}")
+        sys.path.insert(0, BACKEND_DIR)
+    else:
+        started = time.perf_counter()
+        seed_database(scale)
+        print(f"seeded {workdir} in {time.perf_counter() - started:.0f}s", file=sys.stderr)
+
+    from auth import create_access_token
+    from database import plan_engines
+    headers = {"Authorization": "Bearer " + create_access_token({"sub": BENCH_USER})}
+    if args.target == "http":
+        # 服务进程自己打开数据库
+        plan_engines.clear()
+
+    results = asyncio.run(run_target(args, scale, headers))
+    results["config"] = {
+        "target": args.target, "viewers": args.viewers, "editors": args.editors,
+        "importers": args.importers, "seconds": args.seconds, "scale": scale,
+    }
+    results["database"] = database_sizes(workdir)
+    print_results(results, baseline)
+
+    if save_path:
+        with open(save_path, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"baseline saved to {save_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+异步读接口基准 - 大量查看者同时打开子类别分页时的延迟
+
+对比两条读路径，每条在独立子进程和临时目录中进行：
+  - async: 现有的 async def 接口，经aiosqlite在事件循环上查询
+  - sync:  同样的查询写成普通 def 接口，由线程池执行（改造前的做法）
+每一档并发下，N个查看者同时各发若干次请求（响应缓存关闭，不带ETag），
+统计p50/p99延迟、吞吐和出错数。请求在进程内经ASGI直接送给应用，不经过网络。
+
+运行: cd backend && python benchmark_async_reads.py [--viewers 100,250,500,1000] [--requests 5] [--rows 20000]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark_common import create_bench_admin, latency_summary, seed_subcategory
+
+MODES = ("async", "sync")
+
+
+def add_sync_route(app):
+    """Register the category detail read as a plain def endpoint, run on the threadpool.
+
+    The sessions are opened inside the endpoint rather than by generator
+    dependencies: those take a second threadpool slot each, and once the
+    threads outnumber the connection pool they wait on each other until the
+    pool times out, which would measure the 30s timeout instead of the path.
+    """
+    from fastapi import HTTPException
+    import main
+    import models
+    from database import MainSessionLocal, get_plan_session
+
+    @app.get("/bench/sync/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}")
+    def get_category_detail_sync(
+        plan_name: str,
+        stage_name: str,
+        category_name: str,
+        subcategory_name: str,
+        page: int = 1,
+        page_size: int = 20
+    ):
+        main_db = MainSessionLocal()
+        try:
+            if not main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first():
+                raise HTTPException(status_code=404, detail="Plan not found")
+        finally:
+            main_db.close()
+        plan_db = get_plan_session(plan_name)
+        try:
+            category_data = plan_db.query(models.CategoryDetail).join(
+                models.Stage, models.Stage.id == models.CategoryDetail.stage_id
+            ).filter(
+                models.Stage.name == stage_name,
+                models.CategoryDetail.category_name == category_name,
+                models.CategoryDetail.subcategory_name == subcategory_name
+            ).first()
+            return main.load_category_detail_page(plan_db, category_data, page, page_size, "row_order", "asc", None, None)
+        finally:
+            plan_db.close()
+
+
+async def run_level(app, path_prefix: str, viewers: int, requests: int, pages: int) -> dict:
+    import httpx
+
+    latencies = []
+    errors = []
+
+    async def viewer(client, index):
+        for n in range(requests):
+            page = (index + n) % pages + 1
+            started = time.perf_counter()
+            response = await client.get(f"{path_prefix}?page={page}&page_size=50")
+            elapsed = time.perf_counter() - started
+            if response.status_code == 200:
+                latencies.append(elapsed)
+            else:
+                errors.append(response.status_code)
+
+    # 应用内异常（如连接池等待超时）记为500，不中断整轮
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(viewer(client, i) for i in range(viewers)))
+        elapsed = time.perf_counter() - started
+
+    return {"viewers": viewers, **latency_summary(latencies, elapsed), "errors": len(errors)}
+
+
+def run_mode(mode: str, viewer_levels: list, requests: int, row_count: int) -> list:
+    """Run every concurrency level in the current process (cwd must be an empty temp dir)"""
+    # 关掉响应缓存，测的是查询路径本身
+    os.environ["RESPONSE_CACHE_SIZE"] = "0"
+    from fastapi.testclient import TestClient
+    import main
+
+    headers = create_bench_admin("bench")
+    client = TestClient(main.app)
+    base = "/api/plans/bench/stages/s1/categories/c/sc"
+    seed_subcategory(client, headers, "bench", base, row_count)
+
+    if mode == "sync":
+        add_sync_route(main.app)
+        path_prefix = "/bench/sync/bench/stages/s1/categories/c/sc"
+    else:
+        path_prefix = base
+    pages = max(1, row_count // 50)
+
+    async def run_levels():
+        return [await run_level(main.app, path_prefix, viewers, requests, pages) for viewers in viewer_levels]
+
+    return asyncio.run(run_levels())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--viewers", default="100,250,500,1000", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=5, help="requests per viewer at each level")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    viewer_levels = [int(level) for level in args.viewers.split(",")]
+
+    if args.mode:
+        # 子进程：输出一行JSON结果
+        print(json.dumps(run_mode(args.mode, viewer_levels, args.requests, args.rows)))
+        return
+
+    results = {}
+    for mode in MODES:
+        workdir = tempfile.mkdtemp(prefix=f"bench_{mode}_")
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode, "--viewers", args.viewers,
+             "--requests", str(args.requests), "--rows", str(args.rows)],
+            cwd=workdir, capture_output=True, text=True, check=True
+        ).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"{args.requests} requests per viewer, {args.rows} rows, response cache off")
+    print(f"{'viewers':>8}" + "".join(f"{mode + ' ' + column:>16}" for mode in MODES for column in ("p50_ms", "p99_ms", "req/s", "errors")))
+    for index, viewers in enumerate(viewer_levels):
+        line = f"{viewers:>8}"
+        for mode in MODES:
+            level = results[mode][index]
+            line += f"{level['p50_ms']:>16}{level['p99_ms']:>16}{level['per_second']:>16}{level['errors']:>16}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
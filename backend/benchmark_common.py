@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+基准脚本的公共部分 - 延迟分位数与汇总、基准管理员账号、子类别数据准备
+
+由 benchmark_api.py、benchmark_async_reads.py、benchmark_concurrent_reads.py 共用。
+后两个函数会导入应用模块，调用前当前目录须是基准用的数据目录（database.py 在导入时按当前目录建库）。
+"""
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, q):
+    """Nearest-rank q-quantile of values, 0 when there are none"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def latency_summary(latencies, seconds: float) -> dict:
+    """Count, throughput and p50/p95/p99 in milliseconds of successful request latencies"""
+    return {
+        "requests": len(latencies),
+        "per_second": round(len(latencies) / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def create_bench_admin(username: str) -> dict:
+    """Create the admin user on first use; returns its Authorization header"""
+    sys.path.insert(0, BACKEND_DIR)
+    import models
+    from database import MainSessionLocal
+    from auth import get_password_hash, create_access_token
+
+    db = MainSessionLocal()
+    try:
+        if not db.query(models.User).filter(models.User.username == username).first():
+            db.add(models.User(username=username, hashed_password=get_password_hash(username), is_admin=True))
+            db.commit()
+    finally:
+        db.close()
+    return {"Authorization": "Bearer " + create_access_token({"sub": username})}
+
+
+def seed_subcategory(client, headers: dict, plan_name: str, detail_path: str, row_count: int):
+    """Create the plan and fill one subcategory with row_count rows through the bulk row endpoint"""
+    client.post("/api/plans", json={"name": plan_name}, headers=headers)
+    rows = [{"key": i, "hdfs_path": f"/data/{i}", "token_count": str(i), "actual_token": "1"} for i in range(row_count)]
+    for start in range(0, row_count, 5000):
+        client.post(detail_path + "/rows", json={"rows": rows[start:start + 5000]}, headers=headers)
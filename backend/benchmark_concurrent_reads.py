@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+并发读写基准 - 管理员持续写入时，查看者的读吞吐与延迟
+
+分别以回滚日志模式（SQLite默认）和调优后的连接配置（WAL等）各跑一遍，
+每一遍在独立子进程和临时目录中进行：
+  - 若干读线程循环请求子类别分页和可视化接口
+  - 一个写线程循环批量upsert数据行
+
+运行: cd backend && python benchmark_concurrent_reads.py [--readers 8] [--seconds 10] [--rows 20000]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark_common import create_bench_admin, latency_summary, percentile, seed_subcategory
+
+PROFILES = {
+    # SQLite默认：回滚日志 + FULL同步，不做内存映射
+    "rollback": {
+        "SQLITE_JOURNAL_MODE": "DELETE",
+        "SQLITE_SYNCHRONOUS": "FULL",
+        "SQLITE_MMAP_SIZE": "0",
+        "SQLITE_CACHE_SIZE": "-2000",
+        "SQLITE_TEMP_STORE": "DEFAULT",
+    },
+    # database.py 中的默认配置
+    "tuned": {},
+}
+
+
+def run_profile(readers: int, seconds: float, row_count: int) -> dict:
+    """Run the workload in the current process (cwd must be an empty temp dir)"""
+    from fastapi.testclient import TestClient
+    import main
+
+    headers = create_bench_admin("bench")
+    # 读写线程共用一个事件循环：不进with的TestClient每个请求新开一个循环，
+    # 而aiosqlite连接绑定在创建它的循环上，换了循环的请求会一直等下去
+    with TestClient(main.app) as client:
+        base = "/api/plans/bench/stages/s1/categories/c/sc"
+        seed_subcategory(client, headers, "bench", base, row_count)
+        return run_workload(client, headers, base, readers, seconds, row_count)
+
+
+def run_workload(client, headers: dict, base: str, readers: int, seconds: float, row_count: int) -> dict:
+    """Readers page through the subcategory and visualization while one writer upserts batches"""
+    stop = threading.Event()
+    latencies = []
+    read_errors = []
+    writes = []
+    write_errors = []
+    lock = threading.Lock()
+
+    def reader(index):
+        page = index
+        while not stop.is_set():
+            page = page % max(1, row_count // 50) + 1
+            path = "/api/plans/bench/visualization" if page % 5 == 0 else f"{base}?page={page}&page_size=50"
+            started = time.perf_counter()
+            response = client.get(path)
+            elapsed = time.perf_counter() - started
+            with lock:
+                if response.status_code == 200:
+                    latencies.append(elapsed)
+                else:
+                    read_errors.append(response.status_code)
+
+    def writer():
+        version = 0
+        while not stop.is_set():
+            version += 1
+            batch = [{"key": i, "hdfs_path": f"/data/{i}", "token_count": str(i + version), "actual_token": "1"}
+                     for i in range(version * 997 % row_count, min(row_count, version * 997 % row_count + 2000))]
+            started = time.perf_counter()
+            response = client.post(base + "/rows", json={"rows": batch}, headers=headers)
+            elapsed = time.perf_counter() - started
+            if response.status_code == 200:
+                writes.append(elapsed)
+            else:
+                write_errors.append(response.status_code)
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    reads = latency_summary(latencies, elapsed)
+    return {
+        "reads": reads["requests"],
+        "reads_per_second": reads["per_second"],
+        "read_p50_ms": reads["p50_ms"],
+        "read_p99_ms": reads["p99_ms"],
+        "read_errors": len(read_errors),
+        "writes": len(writes),
+        "write_p50_ms": round(percentile(writes, 0.50) * 1000, 1),
+        "write_errors": len(write_errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--profile", choices=sorted(PROFILES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        # 子进程：输出一行JSON结果
+        print(json.dumps(run_profile(args.readers, args.seconds, args.rows)))
+        return
+
+    results = {}
+    for name, overrides in PROFILES.items():
+        env = {**os.environ, **overrides}
+        workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--profile", name,
+             "--readers", str(args.readers), "--seconds", str(args.seconds), "--rows", str(args.rows)],
+            cwd=workdir, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        results[name] = json.loads(output.strip().splitlines()[-1])
+
+    columns = list(results["tuned"])
+    print(f"{args.readers} readers + 1 writer, {args.seconds:g}s, {args.rows} rows")
+    print(f"{'':<18}" + "".join(f"{name:>12}" for name in results))
+    for column in columns:
+        print(f"{column:<18}" + "".join(f"{results[name][column]:>12}" for name in results))
+
+
+if __name__ == "__main__":
+    main()
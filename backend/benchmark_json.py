@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+JSON序列化基准 - 大响应和模型JSON属性的编码/解码耗时
+
+在临时目录生成一个计划（默认10个阶段 × 20个类别 × 20个子类别，即4000个子类别），
+用接口实际的构建函数得到计划概览、阶段类别、子类别分页和可视化的响应数据，比较：
+  - fastapi: FastAPI默认路径，jsonable_encoder遍历复制后由JSONResponse用标准库json编码
+  - stdlib:  FastJSONResponse在未安装orjson时的编码（标准库json，不经jsonable_encoder）
+  - fast:    FastJSONResponse当前使用的编码（安装了orjson时为orjson）
+另外比较阶段categories/merges这类JSON列在标准库json和fast_json下的解码、编码耗时。
+
+运行: cd backend && python benchmark_json.py [--stages 10] [--categories 20] [--subcategories 20] [--rows 20] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def best_of(function, repeat: int) -> float:
+    """Fastest of repeat runs in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def build_payloads(scale: dict) -> dict:
+    """Seed one plan in the current directory and build the payloads of the heavy read endpoints"""
+    from benchmark_api import seed_database, plan_name, stage_name, category_name, subcategory_name
+    import main
+    import models
+    from database import get_plan_session
+
+    seed_database(scale)
+    plan_db = get_plan_session(plan_name(0))
+    try:
+        stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name(0)).first()
+        detail = main.get_or_create_category_detail(plan_db, stage_name(0), category_name(0), subcategory_name(0))
+        return {
+            "plan": {"description": "", "stages": main.load_plan_stages(plan_db)},
+            "stage categories": main.load_stage_categories(plan_db, stage),
+            "detail page": main.load_category_detail_page(
+                plan_db, detail, 1, 100, "row_order", "asc", None, None
+            ),
+            "visualization": main.load_visualization_data(plan_db),
+        }
+    finally:
+        plan_db.close()
+
+
+def json_columns(scale: dict) -> dict:
+    """Stored texts of a stage category tree and merge list at the given scale"""
+    categories = [{
+        "name": f"c{c:02d}",
+        "description": f"类别{c}的说明",
+        "subcategories": [{"name": f"sc{sc:02d}", "description": f"子类别{sc}的说明"} for sc in range(scale["subcategories"])],
+    } for c in range(scale["categories"])]
+    merges = [{"row": r * 3, "col": 0, "rowspan": 3, "colspan": 1} for r in range(scale["categories"] * scale["subcategories"] // 3)]
+    return {"stage.categories": json.dumps(categories), "stage.merges": json.dumps(merges)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", type=int, default=10)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--subcategories", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=20, help="rows of each subcategory (the detail page shows up to 100)")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    scale = {"plans": 1, "stages": args.stages, "categories": args.categories,
+             "subcategories": args.subcategories, "rows": args.rows}
+
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(tempfile.mkdtemp(prefix="bench_json_"))
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    import fast_json
+    from fast_json import FastJSONResponse
+
+    payloads = build_payloads(scale)
+    print(f"codec: {'orjson ' + fast_json.orjson.__version__ if fast_json.orjson else 'stdlib json (orjson not installed)'}")
+    print(f"{'response':<24}{'bytes':>10}{'fastapi ms':>12}{'stdlib ms':>12}{'fast ms':>10}{'speedup':>9}")
+    for name, payload in payloads.items():
+        size = len(FastJSONResponse(payload).body)
+        default = best_of(lambda: JSONResponse(jsonable_encoder(payload)).body, args.repeat)
+        stdlib = best_of(lambda: fast_json.stdlib_dumps_bytes(payload), args.repeat)
+        fast = best_of(lambda: FastJSONResponse(payload).body, args.repeat)
+        print(f"{name:<24}{size:>10}{default:>12.2f}{stdlib:>12.2f}{fast:>10.2f}{default / fast:>8.1f}x")
+
+    print()
+    print(f"{'JSON column':<24}{'bytes':>10}{'json load':>12}{'fast load':>12}{'json dump':>12}{'fast dump':>12}")
+    for name, text in json_columns(scale).items():
+        value = json.loads(text)
+        print(f"{name:<24}{len(text):>10}"
+              f"{best_of(lambda: json.loads(text), args.repeat):>12.3f}"
+              f"{best_of(lambda: fast_json.loads(text), args.repeat):>12.3f}"
+              f"{best_of(lambda: json.dumps(value), args.repeat):>12.3f}"
+              f"{best_of(lambda: fast_json.dumps(value), args.repeat):>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
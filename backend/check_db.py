@@ -4,7 +4,7 @@
 """
 from database import get_main_db
 import models
-from auth import verify_password
+from passwords import verify_password
 
 db_gen = get_main_db()
 db = next(db_gen)
@@ -30,19 +30,27 @@ def check_obs_full_path(plan_name, stage_name, category_name, subcategory_name):
             print(f"❌ CategoryDetail 不存在")
             return
 
-        rows = category_data.rows
-        print(f"\n总行数: {len(rows)}")
+        total = category_data.row_count
+        print(f"\n总行数: {total}")
 
-        if len(rows) == 0:
+        if total == 0:
             print("⚠️ 没有数据行")
             return
 
+        # 数据行存在dataset_rows表中，只取前3行
+        rows = [
+            models.dataset_row_to_dict(row)
+            for row in plan_db.query(models.DatasetRow).filter(
+                models.DatasetRow.detail_id == category_data.id
+            ).order_by(models.DatasetRow.row_order).limit(3)
+        ]
+
         # 检查前3行
-        print(f"\n检查前 {min(3, len(rows))} 行数据:")
+        print(f"\n检查前 {len(rows)} 行数据:")
         print("-"*80)
 
         has_obs_full_path = 0
-        for i, row in enumerate(rows[:3], 1):
+        for i, row in enumerate(rows, 1):
             print(f"\n第 {i} 行:")
             print(f"  hdfs_path: {row.get('hdfs_path', 'N/A')[:50]}...")
             print(f"  obs_fuzzy_path: {row.get('obs_fuzzy_path', 'N/A')[:50]}...")
@@ -57,7 +65,7 @@ def check_obs_full_path(plan_name, stage_name, category_name, subcategory_name):
             print(f"  token_count: {row.get('token_count', 'N/A')}")
 
         print("\n" + "="*80)
-        print(f"统计: {has_obs_full_path}/{min(3, len(rows))} 行包含obs_full_path数据")
+        print(f"统计: {has_obs_full_path}/{len(rows)} 行包含obs_full_path数据")
 
         if has_obs_full_path > 0:
             print("✅ 数据库中已有obs_full_path字段，无需修改！")
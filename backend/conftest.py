@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+测试公共设置 - 在临时目录中建库（不碰真实数据），提供TestClient、登录头和SQL语句记录
+
+pytest先加载本文件再收集测试模块，所以切换目录一定发生在导入database之前，与收集顺序无关。
+运行: cd backend && pytest
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp())
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+from fastapi.testclient import TestClient
+
+import main
+import models
+from database import MainSessionLocal
+from auth import get_password_hash, create_access_token
+
+
+def create_user(username: str, is_admin: bool = False) -> dict:
+    """Create the user on first use; returns its Authorization header"""
+    db = MainSessionLocal()
+    try:
+        if not db.query(models.User).filter(models.User.username == username).first():
+            db.add(models.User(username=username, hashed_password=get_password_hash(username), is_admin=is_admin))
+            db.commit()
+    finally:
+        db.close()
+    return {"Authorization": "Bearer " + create_access_token({"sub": username})}
+
+
+@contextmanager
+def record_statements(*engines, prefixes=None):
+    """Collect the statements executed on the engines inside the block, optionally only those starting with prefixes"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if prefixes is None or statement.lstrip().upper().startswith(prefixes):
+            statements.append(statement)
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture(scope="session")
+def client():
+    return TestClient(main.app)
+
+
+@pytest.fixture(scope="session")
+def admin_headers():
+    return create_user("test_admin", is_admin=True)
+
+
+@pytest.fixture
+def user_headers():
+    """user_headers(username, is_admin=False): Authorization header of that user, created on first use"""
+    return create_user
+
+
+@pytest.fixture
+def statement_recorder():
+    """statement_recorder(*engines, prefixes=None): context manager collecting the statements run on the engines"""
+    return record_statements
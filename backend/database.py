@@ -1,10 +1,18 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from collections import OrderedDict, namedtuple
+import asyncio
 import os
+import threading
+import request_timing
 
 # Main database for users and plan list
 MAIN_DATABASE_URL = "sqlite:///./main.db"
+MAIN_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./main.db"
 
 # Directory for per-plan databases
 DATABASES_DIR = "./databases"
@@ -12,16 +20,56 @@ DATABASES_DIR = "./databases"
 # Ensure databases directory exists
 os.makedirs(DATABASES_DIR, exist_ok=True)
 
+# SQLite connection profile applied to main.db and every plan database.
+# WAL lets viewers keep reading while an admin save is being written.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    # 负数表示以KiB为单位
+    "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", "-65536")),
+    "temp_store": os.environ.get("SQLITE_TEMP_STORE", "MEMORY"),
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+}
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Run the configured PRAGMAs on every new SQLite connection"""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            if value is not None and value != "":
+                cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def create_sqlite_engine(db_url: str):
+    engine = create_engine(db_url, connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+    request_timing.track_queries(engine)
+    return engine
+
+def create_async_sqlite_engine(db_url: str):
+    """Engine on the aiosqlite driver, with the same connection profile"""
+    # 显式用连接池：较老的SQLAlchemy对aiosqlite文件库默认NullPool，每次请求都要重新连接
+    engine = create_async_engine(db_url, poolclass=AsyncAdaptedQueuePool)
+    event.listen(engine.sync_engine, "connect", apply_sqlite_pragmas)
+    request_timing.track_queries(engine.sync_engine)
+    return engine
+
 # Main database engine and session
-main_engine = create_engine(MAIN_DATABASE_URL, connect_args={"check_same_thread": False})
+main_engine = create_sqlite_engine(MAIN_DATABASE_URL)
 MainSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=main_engine)
 
+# Async engine for the async read endpoints; tables are created through main_engine
+main_async_engine = create_async_sqlite_engine(MAIN_ASYNC_DATABASE_URL)
+MainAsyncSessionLocal = async_sessionmaker(main_async_engine, autoflush=False, expire_on_commit=False)
+
 # Base classes for different database types
 MainBase = declarative_base()  # For User and Plan models
 PlanBase = declarative_base()  # For Stage, TableRow, CategoryDetail models
 
-# Dictionary to cache plan database engines
-_plan_engines = {}
+# Most plan database engines kept open at once; least recently used idle ones are disposed
+PLAN_ENGINE_CAPACITY = int(os.environ.get("PLAN_ENGINE_CAPACITY", "64"))
 
 def get_main_db():
     """Get main database session (for users and plan list)"""
@@ -35,40 +83,284 @@ def get_plan_db_path(plan_name: str) -> str:
     """Get the database file path for a specific plan"""
     return os.path.join(DATABASES_DIR, f"{plan_name.lower()}.db")
 
+def create_tables(engine, metadata):
+    """Create missing tables and columns, backfilling them from existing data.
+
+    A table may declare info={"triggers": [<SQL>, ...]}, created once all
+    columns exist, and info={"backfill": [<SQL>, ...]} to populate itself
+    when it is added to a database that already holds data.
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    metadata.create_all(bind=engine)
+    add_missing_columns(engine, metadata, existing_tables)
+    add_missing_autoincrement(engine, metadata, existing_tables)
+    with engine.begin() as conn:
+        # create_all only creates indexes together with new tables
+        for table in metadata.sorted_tables:
+            if table.name in existing_tables:
+                for index in table.indexes:
+                    conn.execute(CreateIndex(index, if_not_exists=True))
+        for table in metadata.sorted_tables:
+            for statement in table.info.get("triggers", []):
+                conn.execute(text(statement))
+        if not existing_tables:
+            return
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                for statement in table.info.get("backfill", []):
+                    conn.execute(text(statement))
+
+def add_missing_columns(engine, metadata, existing_tables):
+    """Add model columns that are missing from existing tables.
+
+    create_all only creates whole tables, so columns added to a model later
+    are appended with ALTER TABLE. A column may declare info={"backfill": <SQL>}
+    to fill existing rows from other columns right after it is added.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}"
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    ddl += f" DEFAULT {default.text}" if hasattr(default, "text") else f" DEFAULT '{default}'"
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+                conn.execute(text(ddl))
+                if column.info.get("backfill"):
+                    conn.execute(text(f"UPDATE {table.name} SET {column.name} = {column.info['backfill']}"))
+
+def add_missing_autoincrement(engine, metadata, existing_tables):
+    """Rebuild existing tables that a model now declares with sqlite_autoincrement.
+
+    SQLite cannot add AUTOINCREMENT to a table in place, so the table is
+    renamed, recreated from the model (with its indexes) and refilled. Only the
+    ids handed out from now on are protected from reuse.
+    """
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables or not table.dialect_options["sqlite"]["autoincrement"]:
+                continue
+            ddl = conn.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name}
+            ).scalar()
+            if "AUTOINCREMENT" in ddl.upper():
+                continue
+            inspector = inspect(conn)
+            columns = ", ".join(column["name"] for column in inspector.get_columns(table.name))
+            indexes = [index["name"] for index in inspector.get_indexes(table.name)]
+            old_name = f"_{table.name}_old"
+            conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_name}"))
+            # The indexes moved with the renamed table and would clash with the new ones
+            for index_name in indexes:
+                conn.execute(text(f"DROP INDEX {index_name}"))
+            table.create(bind=conn)
+            conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}"))
+            conn.execute(text(f"DROP TABLE {old_name}"))
+
+# Sync and aiosqlite engines of one plan database, with their session factories
+PlanEngines = namedtuple("PlanEngines", "engine session_factory async_engine async_session_factory")
+
+def _engine_in_use(entry: PlanEngines) -> bool:
+    return bool(entry.engine.pool.checkedout() or entry.async_engine.sync_engine.pool.checkedout())
+
+class PlanEngineRegistry:
+    """Thread-safe LRU cache of per-plan engines and their session factories.
+
+    Engines are created under a per-plan lock so concurrent first requests
+    run create_tables once. Beyond capacity, the least recently used engines
+    with no checked-out connections are disposed; an engine that is still in
+    use is kept until a later eviction pass finds it idle.
+
+    Each plan also gets an aiosqlite engine for the async endpoints. Its
+    connections belong to the event loop, so it is disposed there.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self._creation_locks = {}
+        self._loop = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, plan_name: str):
+        """Engine of a plan database, created on first use"""
+        return self._entry(plan_name).engine
+
+    def get_async(self, plan_name: str):
+        """aiosqlite engine of a plan database, created on first use"""
+        return self._entry(plan_name).async_engine
+
+    def session_factory(self, plan_name: str):
+        """sessionmaker bound to the plan's engine; sessions carry the plan name in info"""
+        return self._entry(plan_name).session_factory
+
+    def cached_async_session_factory(self, plan_name: str):
+        """async_sessionmaker of an already open plan, or None (never blocks on creating one)"""
+        self._loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._engines.get(plan_name)
+            if entry is None:
+                return None
+            self._engines.move_to_end(plan_name)
+            self.hits += 1
+            return entry.async_session_factory
+
+    def async_session_factory(self, plan_name: str):
+        """async_sessionmaker bound to the plan's aiosqlite engine"""
+        return self._entry(plan_name).async_session_factory
+
+    def _entry(self, plan_name: str) -> PlanEngines:
+        with self._lock:
+            entry = self._engines.get(plan_name)
+            if entry is not None:
+                self._engines.move_to_end(plan_name)
+                self.hits += 1
+                return entry
+            creation_lock = self._creation_locks.setdefault(plan_name, threading.Lock())
+
+        with creation_lock:
+            with self._lock:
+                entry = self._engines.get(plan_name)
+                if entry is not None:
+                    # 另一个线程刚建好
+                    self._engines.move_to_end(plan_name)
+                    self.hits += 1
+                    return entry
+                self.misses += 1
+
+            db_url = f"sqlite:///{get_plan_db_path(plan_name)}"
+            engine = create_sqlite_engine(db_url)
+            # Create tables if they don't exist, and columns added since
+            create_tables(engine, PlanBase.metadata)
+            factory = sessionmaker(autocommit=False, autoflush=False, bind=engine, info={"plan_name": plan_name})
+            async_engine = create_async_sqlite_engine(f"sqlite+aiosqlite:///{get_plan_db_path(plan_name)}")
+            async_factory = async_sessionmaker(
+                async_engine, autoflush=False, expire_on_commit=False, info={"plan_name": plan_name}
+            )
+            entry = PlanEngines(engine, factory, async_engine, async_factory)
+
+            with self._lock:
+                self._engines[plan_name] = entry
+                evicted = self._evict()
+            for old in evicted:
+                self._dispose(old, wait=False)
+        return entry
+
+    def _evict(self) -> list:
+        """Unregister idle engines, oldest first, until within capacity (lock held); returns them"""
+        evicted = []
+        for name in list(self._engines):
+            if len(self._engines) <= self.capacity:
+                break
+            entry = self._engines[name]
+            if _engine_in_use(entry):
+                continue
+            del self._engines[name]
+            self._creation_locks.pop(name, None)
+            evicted.append(entry)
+            self.evictions += 1
+        return evicted
+
+    def _dispose(self, entry: PlanEngines, wait: bool = True):
+        """Close both engines; wait=True returns only once the async connections are closed"""
+        entry.engine.dispose()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None:
+            # 在事件循环里：交给循环去关，不能在这里阻塞
+            running.create_task(entry.async_engine.dispose())
+        elif self._loop is not None and self._loop.is_running():
+            future = asyncio.run_coroutine_threadsafe(entry.async_engine.dispose(), self._loop)
+            if wait:
+                future.result(timeout=10)
+        else:
+            asyncio.run(entry.async_engine.dispose())
+
+    def remove(self, plan_name: str):
+        """Drop and dispose the engine of a plan, e.g. before deleting its file"""
+        with self._lock:
+            entry = self._engines.pop(plan_name, None)
+            self._creation_locks.pop(plan_name, None)
+        if entry is not None:
+            self._dispose(entry)
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._engines.values())
+            self._engines.clear()
+            self._creation_locks.clear()
+        for entry in entries:
+            self._dispose(entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            engines = [entry.engine for entry in self._engines.values()]
+            engines += [entry.async_engine.sync_engine for entry in self._engines.values()]
+            stats = {
+                "capacity": self.capacity,
+                "engines": len(self._engines),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+        checked_out = sum(engine.pool.checkedout() for engine in engines)
+        stats["connections_in_use"] = checked_out
+        stats["open_connections"] = checked_out + sum(engine.pool.checkedin() for engine in engines)
+        return stats
+
+
+plan_engines = PlanEngineRegistry(PLAN_ENGINE_CAPACITY)
+
 def get_plan_engine(plan_name: str):
     """Get or create engine for a specific plan database"""
-    if plan_name not in _plan_engines:
-        db_path = get_plan_db_path(plan_name)
-        db_url = f"sqlite:///{db_path}"
-        engine = create_engine(db_url, connect_args={"check_same_thread": False})
-        _plan_engines[plan_name] = engine
-
-        # Create tables if they don't exist
-        PlanBase.metadata.create_all(bind=engine)
+    return plan_engines.get(plan_name)
 
-    return _plan_engines[plan_name]
+def get_plan_session(plan_name: str):
+    """Open a session on a plan database; the caller closes it"""
+    return plan_engines.session_factory(plan_name.upper())()
 
 def get_plan_db(plan_name: str):
-    """Get database session for a specific plan"""
-    engine = get_plan_engine(plan_name)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = SessionLocal()
+    """Get database session for a specific plan (FastAPI dependency on the plan_name path parameter)"""
+    db = get_plan_session(plan_name)
     try:
         yield db
     finally:
         db.close()
 
+async def get_async_plan_db(plan_name: str):
+    """Async session on a plan database (FastAPI dependency on the plan_name path parameter)"""
+    plan_name = plan_name.upper()
+    factory = plan_engines.cached_async_session_factory(plan_name)
+    if factory is None:
+        # 第一次打开要建表，放到线程池里做，不阻塞事件循环
+        factory = await asyncio.to_thread(plan_engines.async_session_factory, plan_name)
+    async with factory() as db:
+        yield db
+
 def init_main_database():
     """Initialize main database tables"""
-    MainBase.metadata.create_all(bind=main_engine)
+    create_tables(main_engine, MainBase.metadata)
 
 def delete_plan_database(plan_name: str):
     """Delete the database file for a specific plan"""
     db_path = get_plan_db_path(plan_name)
     if os.path.exists(db_path):
         # Close engine if cached
-        if plan_name in _plan_engines:
-            _plan_engines[plan_name].dispose()
-            del _plan_engines[plan_name]
-        # Delete file
+        plan_engines.remove(plan_name)
+        # Delete file, along with the WAL files left by the last connection
         os.remove(db_path)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
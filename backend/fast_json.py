@@ -0,0 +1,51 @@
+"""JSON codec of the heavy API responses, the response cache and the JSON columns.
+
+Uses orjson when it is installed and falls back to the stdlib json module
+with the same output shape (compact, UTF-8, non-string keys as strings).
+"""
+from datetime import date, datetime
+import json
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    # orjson writes dates natively; the fallback writes them the same way (ISO 8601)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def stdlib_dumps_bytes(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+if orjson is not None:
+    def dumps_bytes(value) -> bytes:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+else:
+    dumps_bytes = stdlib_dumps_bytes
+    loads = json.loads
+
+
+def dumps(value) -> str:
+    return dumps_bytes(value).decode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered straight from plain dicts and lists.
+
+    Returned by an endpoint it skips FastAPI's jsonable_encoder walk, which
+    copies every nested object, so the payload must already be built from
+    JSON types (and datetimes).
+    """
+
+    def render(self, content) -> bytes:
+        return dumps_bytes(content)
@@ -0,0 +1,128 @@
+"""Minimal JSON Patch (RFC 6902) support for partial plan updates"""
+import copy
+
+
+class JsonPatchError(ValueError):
+    """Raised when a patch operation is malformed or cannot be applied"""
+
+
+def _decode_pointer(pointer: str) -> list:
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith('/')):
+        raise JsonPatchError(f"invalid path: {pointer!r}")
+    if pointer == '':
+        return []
+    return [part.replace('~1', '/').replace('~0', '~') for part in pointer[1:].split('/')]
+
+
+def _list_index(container: list, token: str, allow_end: bool) -> int:
+    if allow_end and token == '-':
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise JsonPatchError(f"invalid array index: {token!r}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise JsonPatchError(f"array index out of range: {token}")
+    return index
+
+
+def _resolve_parent(document, parts: list):
+    """Return the container holding the last path segment"""
+    target = document
+    for token in parts[:-1]:
+        if isinstance(target, dict):
+            if token not in target:
+                raise JsonPatchError(f"path not found: /{'/'.join(parts)}")
+            target = target[token]
+        elif isinstance(target, list):
+            target = target[_list_index(target, token, allow_end=False)]
+        else:
+            raise JsonPatchError(f"path not found: /{'/'.join(parts)}")
+    return target
+
+
+def _get(document, parts: list):
+    if not parts:
+        return document
+    parent = _resolve_parent(document, parts)
+    token = parts[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise JsonPatchError(f"path not found: /{'/'.join(parts)}")
+        return parent[token]
+    if isinstance(parent, list):
+        return parent[_list_index(parent, token, allow_end=False)]
+    raise JsonPatchError(f"path not found: /{'/'.join(parts)}")
+
+
+def _add(document, parts: list, value):
+    if not parts:
+        return value
+    parent = _resolve_parent(document, parts)
+    token = parts[-1]
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(_list_index(parent, token, allow_end=True), value)
+    else:
+        raise JsonPatchError(f"path not found: /{'/'.join(parts)}")
+    return document
+
+
+def _remove(document, parts: list):
+    if not parts:
+        raise JsonPatchError("cannot remove the whole document")
+    parent = _resolve_parent(document, parts)
+    token = parts[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise JsonPatchError(f"path not found: /{'/'.join(parts)}")
+        return parent.pop(token)
+    if isinstance(parent, list):
+        return parent.pop(_list_index(parent, token, allow_end=False))
+    raise JsonPatchError(f"path not found: /{'/'.join(parts)}")
+
+
+def apply_patch(document, operations: list):
+    """Apply patch operations to a copy of document and return it.
+
+    Supports add, remove, replace, move, copy and test. The patch is atomic:
+    on any error JsonPatchError is raised and the input is left untouched.
+    """
+    if not isinstance(operations, list):
+        raise JsonPatchError("patch must be a list of operations")
+
+    document = copy.deepcopy(document)
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise JsonPatchError(f"operation {index} must be an object")
+        op = operation.get('op')
+        parts = _decode_pointer(operation.get('path'))
+        try:
+            if op in ('add', 'replace', 'test') and 'value' not in operation:
+                raise JsonPatchError("missing value")
+            if op == 'add':
+                document = _add(document, parts, copy.deepcopy(operation['value']))
+            elif op == 'remove':
+                _remove(document, parts)
+            elif op == 'replace':
+                _get(document, parts)
+                if parts:
+                    _remove(document, parts)
+                document = _add(document, parts, copy.deepcopy(operation['value']))
+            elif op in ('move', 'copy'):
+                from_parts = _decode_pointer(operation.get('from'))
+                if op == 'move':
+                    if parts[:len(from_parts)] == from_parts and parts != from_parts:
+                        raise JsonPatchError("cannot move a value into itself")
+                    value = _remove(document, from_parts)
+                else:
+                    value = copy.deepcopy(_get(document, from_parts))
+                document = _add(document, parts, value)
+            elif op == 'test':
+                if _get(document, parts) != operation['value']:
+                    raise JsonPatchError("test failed")
+            else:
+                raise JsonPatchError(f"unsupported op: {op!r}")
+        except JsonPatchError as e:
+            raise JsonPatchError(f"operation {index} ({op} {operation.get('path')}): {e}")
+    return document
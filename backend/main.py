@@ -1,24 +1,75 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import event, func, insert, select, text, update, and_, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from typing import List, Optional
 from pydantic import BaseModel
+from urllib.parse import quote
+from datetime import datetime
+from bisect import bisect_left
+import base64
+import json
+import math
+import os
+import time
+import zlib
 import models
-from database import get_main_db, get_plan_engine, delete_plan_database, init_main_database
-from sqlalchemy.orm import sessionmaker
-from auth import get_password_hash, verify_password, create_access_token, get_current_user, require_admin
+import metrics
+from models import parse_token_value
+import spreadsheet
+import json_patch
+from fast_json import FastJSONResponse
+from database import (
+    MainSessionLocal, MainAsyncSessionLocal, get_main_db, get_plan_db, get_async_plan_db, get_plan_session,
+    get_plan_engine, delete_plan_database, init_main_database, plan_engines
+)
+from response_cache import create_response_cache
+import request_timing
+from request_timing import RequestTimingMiddleware
+from profiling import ProfileStore, ProfilingMiddleware
+import passwords
+from auth import (
+    AuthenticatedUser, create_access_token, get_current_user, require_admin, auth_stats, login_limiter, login_ip_limiter,
+    token_cache, is_admin_token
+)
 
 # Initialize main database
 init_main_database()
 
 app = FastAPI()
 
+
+@app.on_event("shutdown")
+def stop_password_executor():
+    passwords.shutdown_executor()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 浏览器开发者工具的Timing面板读取Server-Timing需要跨域放行
+    expose_headers=["Server-Timing", "X-Profile-Id"],
+)
+
+# Server-Timing on every response; requests slower than this are logged with their plan/stage/subcategory
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "1000"))
+app.add_middleware(RequestTimingMiddleware, slow_request_ms=SLOW_REQUEST_MS)
+
+# Admins profile a request with X-Profile: 1 or ?profile=1; PROFILE_SAMPLE_RATE profiles that share of all requests
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "./profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "2"))
+profile_store = ProfileStore(PROFILE_DIR, PROFILE_KEEP)
+app.add_middleware(
+    ProfilingMiddleware, store=profile_store, authorize=is_admin_token,
+    sample_rate=PROFILE_SAMPLE_RATE, interval_ms=PROFILE_INTERVAL_MS
 )
 
 class UserLogin(BaseModel):
@@ -100,40 +151,576 @@ class RowUpdateData(BaseModel):
 class RowDeleteData(BaseModel):
     keys: list[int]
 
+class RowBulkData(BaseModel):
+    # Plain dicts so that one malformed row is reported instead of failing the batch
+    rows: List[dict]
+    replace: bool = False
+
+
+def get_existing_plan(plan_name: str, main_db: Session = Depends(get_main_db)):
+    """Plan row of the path's plan; 404 instead of creating it"""
+    plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
+    if not plan:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    return plan
+
+
+def get_existing_plan_db(plan_name: str, plan: models.Plan = Depends(get_existing_plan)):
+    """Plan session dependency that answers 404 for plans missing from main.db"""
+    yield from get_plan_db(plan_name)
+
+
+async def get_existing_plan_async(plan_name: str):
+    """get_existing_plan for the async endpoints.
+
+    The main.db session is closed right after the lookup instead of at the end
+    of the request, so many concurrent viewers do not hold its pool.
+    """
+    async with MainAsyncSessionLocal() as main_db:
+        plan = await main_db.scalar(select(models.Plan).where(models.Plan.name == plan_name.upper()))
+    if not plan:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    return plan
+
+
+async def get_existing_async_plan_db(plan_name: str, plan: models.Plan = Depends(get_existing_plan_async)):
+    """Async plan session that answers 404 for plans missing from main.db"""
+    async for plan_db in get_async_plan_db(plan_name):
+        yield plan_db
+
+
+def not_modified(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """Tag the response with etag; returns a 304 when the client's If-None-Match already has it.
+
+    Cache-Control: no-cache lets the browser keep the body but revalidate on
+    every view, so unchanged pages cost one version lookup.
+    """
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    response.headers.update(headers)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # If-None-Match uses weak comparison
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in candidates or etag in candidates:
+            return Response(status_code=304, headers=headers)
+    return None
+
+
+# Upper bounds of the rows-per-subcategory histogram exported at /metrics
+SUBCATEGORY_ROW_BUCKETS = (0, 10, 100, 500, 1000, 2000, 5000, 10000, 50000, 100000)
+
+
+def subcategory_row_histogram(row_counts) -> str:
+    """JSON histogram of subcategory row counts, as stored in Plan.subcategory_row_histogram"""
+    bucket_counts = [0] * (len(SUBCATEGORY_ROW_BUCKETS) + 1)
+    row_total = 0
+    for row_count in row_counts:
+        bucket_counts[bisect_left(SUBCATEGORY_ROW_BUCKETS, row_count or 0)] += 1
+        row_total += row_count or 0
+    return json.dumps({"bounds": list(SUBCATEGORY_ROW_BUCKETS), "buckets": bucket_counts, "sum": row_total})
 
-# Helper function to get plan database session
-def get_plan_session(plan_name: str):
-    """Get a database session for a specific plan"""
-    engine = get_plan_engine(plan_name.upper())
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = SessionLocal()
+
+def load_plan_summary(plan_db: Session) -> dict:
+    """Stage count and token totals of a plan database, read from the rollups,
+    and the histogram of its subcategories' row counts"""
+    stage_count = plan_db.query(func.count(models.Stage.id)).scalar()
+    token_total, actual_total = plan_db.query(
+        func.coalesce(func.sum(models.StageRollup.token_count_sum), 0.0),
+        func.coalesce(func.sum(models.StageRollup.actual_token_sum), 0.0)
+    ).one()
+    row_counts = [row_count for (row_count,) in plan_db.query(models.CategoryDetail.row_count)]
+    return {"stage_count": stage_count, "token_count_sum": token_total, "actual_token_sum": actual_total,
+            "subcategory_row_histogram": subcategory_row_histogram(row_counts)}
+
+
+def store_plan_summary(main_db: Session, plan_name: str, summary: dict):
+    main_db.query(models.Plan).filter(models.Plan.name == plan_name).update(
+        {**summary, "updated_at": datetime.utcnow()}, synchronize_session=False
+    )
+
+
+@app.on_event("startup")
+def backfill_plan_summaries():
+    """Compute the main.db summary of plans saved before it existed, so the plan list never writes"""
+    main_db = MainSessionLocal()
     try:
-        return db
+        plans = main_db.query(models.Plan.name).filter(
+            or_(models.Plan.stage_count.is_(None), models.Plan.subcategory_row_histogram.is_(None))
+        ).all()
+        for (plan_name,) in plans:
+            plan_db = get_plan_session(plan_name)
+            try:
+                summary = load_plan_summary(plan_db)
+            finally:
+                plan_db.close()
+            store_plan_summary(main_db, plan_name, summary)
+        main_db.commit()
     finally:
-        pass
+        main_db.close()
+
+
+# Read payloads built from the plan databases, keyed by their data version.
+# "sqlite" shares one cache between all uvicorn workers; "memory" keeps one per worker.
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "./response_cache.db")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "300"))
+response_cache = create_response_cache(RESPONSE_CACHE_BACKEND, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH)
+
+
+def cache_tags(plan_name: str, *scope) -> tuple:
+    """Tags of a cached payload: its plan, and the plan-wide "overview" or the stage/subcategory it shows"""
+    return ((plan_name,), (plan_name, *scope))
+
+
+def touch_category_detail(plan_db: Session, category_data: models.CategoryDetail):
+    """Mark a subcategory and its stage as changed; their versions move on commit"""
+    plan_db.info.setdefault("touched_details", set()).add(category_data.id)
+    plan_db.info.setdefault("touched_stages", set()).add(category_data.stage_id)
+
+
+def get_plan_version(plan_db: Session) -> int:
+    """Version of a plan database, bumped by every commit that writes to it"""
+    return plan_db.execute(text("PRAGMA user_version")).scalar()
+
+
+async def get_plan_version_async(plan_db: AsyncSession) -> int:
+    return await plan_db.scalar(text("PRAGMA user_version"))
+
+
+async def call_response_cache(method, *args):
+    """Call a response_cache method from the event loop; backends doing I/O run in the threadpool"""
+    if response_cache.blocking:
+        return await run_in_threadpool(method, *args)
+    return method(*args)
+
+
+async def get_or_build_async(plan_db: AsyncSession, key, build, tags=()):
+    """response_cache.get_or_build for the async endpoints; build(session) runs on the async session's connection"""
+    value = await call_response_cache(response_cache.get, key)
+    if value is None:
+        value = await plan_db.run_sync(build)
+        await call_response_cache(response_cache.put, key, value, tags)
+    return value
+
+
+def json_response(payload, response: Optional[Response] = None) -> FastJSONResponse:
+    """Send a built payload as is, skipping the jsonable_encoder walk; keeps the headers set on response (ETag)"""
+    return FastJSONResponse(payload, headers=response.headers if response is not None else None)
+
+
+def bump_plan_version(plan_db: Session):
+    """Advance the plan version and stamp it on the stages and subcategories touched in this transaction.
+
+    The version lives in the database header (PRAGMA user_version), so it is
+    part of the write transaction and needs no extra table.
+    """
+    connection = plan_db.connection()
+    version = connection.exec_driver_sql("PRAGMA user_version").scalar() + 1
+    connection.exec_driver_sql(f"PRAGMA user_version = {version}")
+    plan_name = plan_db.info["plan_name"]
+    stale_tags = [(plan_name, "overview")]
+    for model, key, scope in ((models.Stage, "touched_stages", "stage"), (models.CategoryDetail, "touched_details", "detail")):
+        ids = list(plan_db.info.pop(key, ()))
+        stale_tags.extend((plan_name, scope, id_) for id_ in ids)
+        for start in range(0, len(ids), SQL_IN_CHUNK_SIZE):
+            connection.execute(
+                update(model.__table__).where(model.__table__.c.id.in_(ids[start:start + SQL_IN_CHUNK_SIZE])).values(version=version)
+            )
+    plan_db.info["stale_cache_tags"] = stale_tags
+
+
+# 计划库的每次写入提交后，把汇总同步到main.db中的Plan行
+@event.listens_for(Session, "after_flush")
+def mark_plan_written_by_flush(session, flush_context):
+    if "plan_name" not in session.info:
+        return
+    # 赋了相同值的对象也在dirty里，但flush不会为它发UPDATE，不算写入
+    changed = list(session.new) + [obj for obj in session.dirty if session.is_modified(obj)]
+    if changed or session.deleted:
+        session.info["plan_written"] = True
+        for obj in changed:
+            if isinstance(obj, models.Stage):
+                session.info.setdefault("touched_stages", set()).add(obj.id)
+            elif isinstance(obj, models.CategoryDetail):
+                touch_category_detail(session, obj)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def mark_plan_written_by_statement(orm_execute_state):
+    session = orm_execute_state.session
+    if "plan_name" in session.info and (
+        orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete
+    ):
+        session.info["plan_written"] = True
+
+
+@event.listens_for(Session, "before_commit")
+def collect_plan_summary(session):
+    if "plan_name" not in session.info:
+        return
+    session.flush()
+    if session.info.pop("plan_written", False):
+        bump_plan_version(session)
+        session.info["plan_summary"] = load_plan_summary(session)
+
+
+@event.listens_for(Session, "after_commit")
+def sync_plan_summary(session):
+    summary = session.info.pop("plan_summary", None)
+    if summary is None:
+        return
+    main_db = MainSessionLocal()
+    try:
+        store_plan_summary(main_db, session.info["plan_name"], summary)
+        main_db.commit()
+    finally:
+        main_db.close()
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_cached_responses(session):
+    stale_tags = session.info.pop("stale_cache_tags", None)
+    if stale_tags:
+        response_cache.invalidate(*stale_tags)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_plan_summary(session):
+    session.info.pop("plan_written", None)
+    session.info.pop("plan_summary", None)
+    session.info.pop("stale_cache_tags", None)
+    session.info.pop("touched_stages", None)
+    session.info.pop("touched_details", None)
+
+
+# Keep IN (...) lists well below SQLite's bound-parameter limit
+SQL_IN_CHUNK_SIZE = 500
+
+# Rows buffered per upsert during a spreadsheet import, and how many row errors are echoed back
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_REPORTED_ERRORS = 100
+
+# Rows fetched per round trip while streaming an export
+EXPORT_BATCH_SIZE = 1000
+
+
+# Server-side sort keys accepted by the category detail endpoint
+CATEGORY_ROW_SORTS = {
+    'row_order': models.DatasetRow.row_order,
+    'token_count': models.DatasetRow.token_count_number,
+    'actual_token': models.DatasetRow.actual_token_number,
+}
+
+
+def encode_row_cursor(sort_by: str, sort_value, row_id: int) -> str:
+    """Encode the position after a row as an opaque keyset cursor"""
+    raw = json.dumps([sort_by, sort_value, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_row_cursor(cursor: str, sort_by: str):
+    """Decode a keyset cursor into (sort_value, row_id) for the given sort key"""
+    try:
+        cursor_sort_by, sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # 游标来自客户端：排序值只能是数字或空，行id只能是整数，否则绑定到SQL时会出错
+    valid_sort_value = sort_value is None or (isinstance(sort_value, (int, float)) and not isinstance(sort_value, bool))
+    if not valid_sort_value or not isinstance(row_id, int) or isinstance(row_id, bool):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort_by != sort_by:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort_by")
+    return sort_value, row_id
+
+
+def get_or_create_category_detail(plan_db: Session, stage_name: str, category_name: str, subcategory_name: str):
+    """Get the CategoryDetail of a subcategory, creating its stage and detail when missing"""
+    stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
+    if not stage:
+        max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
+        next_order = (max_order_result.stage_order + 1) if max_order_result else 0
+        stage = models.Stage(name=stage_name, stage_order=next_order, description="", categories=[])
+        plan_db.add(stage)
+        plan_db.flush()
+
+    category_data = plan_db.query(models.CategoryDetail).filter(
+        models.CategoryDetail.stage_id == stage.id,
+        models.CategoryDetail.category_name == category_name,
+        models.CategoryDetail.subcategory_name == subcategory_name
+    ).first()
+    if not category_data:
+        category_data = models.CategoryDetail(
+            stage_id=stage.id,
+            category_name=category_name,
+            subcategory_name=subcategory_name,
+            description=""
+        )
+        plan_db.add(category_data)
+        plan_db.flush()
+    return category_data
+
+
+def validate_dataset_row(row) -> dict:
+    """Check one incoming row and return its column values; raises ValueError"""
+    if not isinstance(row, dict):
+        raise ValueError("row must be an object")
+
+    values = {}
+    key = row.get('key')
+    if key is not None and key != '':
+        if isinstance(key, bool) or (isinstance(key, float) and not key.is_integer()):
+            raise ValueError(f"invalid key: {key!r}")
+        try:
+            values['row_key'] = int(key)
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid key: {key!r}")
+
+    for field in models.DATASET_ROW_FIELDS:
+        value = row.get(field)
+        if value is None:
+            value = ''
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        elif not isinstance(value, str):
+            raise ValueError(f"{field} must be a string")
+        values[field] = value.strip() if field in ('token_count', 'actual_token') else value
+
+    for field in ('token_count', 'actual_token'):
+        if values[field]:
+            try:
+                float(values[field])
+            except ValueError:
+                raise ValueError(f"{field} is not a number: {values[field]!r}")
+    return values
+
+
+def upsert_dataset_rows(plan_db: Session, category_data: models.CategoryDetail, rows: list,
+                        replace: bool = False, start_index: int = 0):
+    """Validate and upsert rows of a subcategory by key in the current transaction.
+
+    Rows without a key get a new one and are appended after the existing rows.
+    Totals are shifted by the difference between the old and new values of
+    the touched rows. Returns (inserted, updated, errors) where errors carry
+    the row index.
+    """
+    errors = []
+    accepted = []
+    for index, row in enumerate(rows, start=start_index):
+        try:
+            accepted.append(validate_dataset_row(row))
+        except ValueError as e:
+            errors.append({"index": index, "key": row.get('key') if isinstance(row, dict) else None, "error": str(e)})
+
+    if replace:
+        plan_db.query(models.DatasetRow).filter(
+            models.DatasetRow.detail_id == category_data.id
+        ).delete(synchronize_session=False)
+        set_category_totals(plan_db, category_data, 0.0, 0.0, 0)
+    if not accepted:
+        return 0, 0, errors
+
+    max_order, max_key = plan_db.query(
+        func.max(models.DatasetRow.row_order), func.max(models.DatasetRow.row_key)
+    ).filter(models.DatasetRow.detail_id == category_data.id).one()
+    next_order = (max_order + 1) if max_order is not None else 0
+    next_key = max([max_key or 0] + [v['row_key'] for v in accepted if 'row_key' in v]) + 1
+
+    # Current token values of the rows about to be overwritten, by key
+    current_values = {}
+    incoming_keys = [v['row_key'] for v in accepted if 'row_key' in v]
+    if not replace:
+        for start in range(0, len(incoming_keys), SQL_IN_CHUNK_SIZE):
+            existing = plan_db.query(
+                models.DatasetRow.row_key, models.DatasetRow.token_count, models.DatasetRow.actual_token
+            ).filter(
+                models.DatasetRow.detail_id == category_data.id,
+                models.DatasetRow.row_key.in_(incoming_keys[start:start + SQL_IN_CHUNK_SIZE])
+            )
+            for key, token_count, actual_token in existing:
+                current_values[key] = (parse_token_value(token_count), parse_token_value(actual_token))
+    existing_keys = set(current_values)
+
+    mappings = []
+    new_keys = set()
+    token_delta = 0.0
+    actual_delta = 0.0
+    for values in accepted:
+        if 'row_key' not in values:
+            values['row_key'] = next_key
+            next_key += 1
+        key = values['row_key']
+        if key not in existing_keys:
+            new_keys.add(key)
+        old_token, old_actual = current_values.get(key, (0.0, 0.0))
+        new_token, new_actual = parse_token_value(values['token_count']), parse_token_value(values['actual_token'])
+        token_delta += new_token - old_token
+        actual_delta += new_actual - old_actual
+        current_values[key] = (new_token, new_actual)
+        mappings.append({
+            'detail_id': category_data.id,
+            'row_order': next_order,
+            **values
+        })
+        next_order += 1
+
+    # Upsert on the (detail_id, row_key) unique index; existing rows keep their position
+    stmt = sqlite_insert(models.DatasetRow)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.DatasetRow.detail_id, models.DatasetRow.row_key],
+        set_={field: getattr(stmt.excluded, field) for field in models.DATASET_ROW_FIELDS}
+    )
+    plan_db.execute(stmt, mappings)
+    shift_category_totals(plan_db, category_data, token_delta, actual_delta, len(new_keys))
+
+    inserted = len(new_keys)
+    return inserted, len(mappings) - inserted, errors
+
+
+def format_token_total(value) -> str:
+    return f"{value or 0.0:.2f}"
+
+
+def stable_id(name: str) -> int:
+    """Deterministic id for a category tree node (hash() differs between workers and restarts)"""
+    return zlib.crc32(name.encode("utf-8")) & 0x7FFFFFFF
+
+
+def shift_category_totals(plan_db: Session, category_data: models.CategoryDetail,
+                          token_delta: float, actual_delta: float, row_delta: int = 0):
+    """Add a delta to a subcategory's totals and row count.
+
+    The increment is done in SQL (col = col + delta) so that it applies to
+    whatever value is committed, not to a copy read earlier in the request.
+    The stage and category rollups follow through their triggers.
+    """
+    touch_category_detail(plan_db, category_data)
+    if not token_delta and not actual_delta and not row_delta:
+        return
+    plan_db.query(models.CategoryDetail).filter(models.CategoryDetail.id == category_data.id).update({
+        models.CategoryDetail.token_count_sum: models.CategoryDetail.token_count_sum + token_delta,
+        models.CategoryDetail.actual_token_sum: models.CategoryDetail.actual_token_sum + actual_delta,
+        models.CategoryDetail.row_count: models.CategoryDetail.row_count + row_delta,
+    }, synchronize_session=False)
+    plan_db.expire(category_data, ['token_count_sum', 'actual_token_sum', 'row_count'])
+
+
+def set_category_totals(plan_db: Session, category_data: models.CategoryDetail,
+                        token_total: float, actual_total: float, row_count: int):
+    """Overwrite a subcategory's totals, e.g. after all of its rows were replaced"""
+    touch_category_detail(plan_db, category_data)
+    category_data.token_count_sum = token_total
+    category_data.actual_token_sum = actual_total
+    category_data.row_count = row_count
+    plan_db.flush()
+
+
+def sum_dataset_row_tokens(rows) -> tuple:
+    """Sum (token_count, actual_token) over rows given as column value pairs"""
+    token_total = 0.0
+    actual_total = 0.0
+    for token_count, actual_token in rows:
+        token_total += parse_token_value(token_count)
+        actual_total += parse_token_value(actual_token)
+    return token_total, actual_total
+
+
+def reconcile_category_totals(plan_db: Session) -> list:
+    """Recompute every subcategory's totals from its rows and fix any drift.
+
+    The stage and category rollups are rebuilt from the repaired totals.
+    Returns the subcategories whose stored totals did not match.
+    """
+    computed = {}
+    rows = plan_db.query(
+        models.DatasetRow.detail_id, models.DatasetRow.token_count, models.DatasetRow.actual_token
+    ).yield_per(EXPORT_BATCH_SIZE)
+    for detail_id, token_count, actual_token in rows:
+        token_total, actual_total, row_count = computed.get(detail_id, (0.0, 0.0, 0))
+        computed[detail_id] = (
+            token_total + parse_token_value(token_count),
+            actual_total + parse_token_value(actual_token),
+            row_count + 1
+        )
+
+    mismatches = []
+    for detail in plan_db.query(models.CategoryDetail).all():
+        token_total, actual_total, row_count = computed.get(detail.id, (0.0, 0.0, 0))
+        stored_token, stored_actual = detail.token_count_sum or 0.0, detail.actual_token_sum or 0.0
+        if not (math.isclose(stored_token, token_total, rel_tol=1e-9, abs_tol=1e-6)
+                and math.isclose(stored_actual, actual_total, rel_tol=1e-9, abs_tol=1e-6)
+                and detail.row_count == row_count):
+            mismatches.append({
+                "stage_id": detail.stage_id,
+                "category": detail.category_name,
+                "subcategory": detail.subcategory_name,
+                "stored": {"tokenCountTotal": stored_token, "actualTokenTotal": stored_actual, "rowCount": detail.row_count},
+                "actual": {"tokenCountTotal": token_total, "actualTokenTotal": actual_total, "rowCount": row_count}
+            })
+            detail.token_count_sum = token_total
+            detail.actual_token_sum = actual_total
+            detail.row_count = row_count
+    plan_db.flush()
+    rebuild_rollups(plan_db)
+    return mismatches
+
+
+def rebuild_rollups(plan_db: Session):
+    """Recompute the stage and category rollups from category_details"""
+    for model in (models.StageRollup, models.CategoryRollup):
+        for statement in model.__table__.info["backfill"]:
+            plan_db.execute(text(statement))
 
 
 # ==================== Authentication Endpoints ====================
 
 @app.post("/api/auth/login")
-def login(user: UserLogin, db: Session = Depends(get_main_db)):
-    db_user = db.query(models.User).filter(models.User.username == user.username).first()
-    if not db_user or not verify_password(user.password, db_user.hashed_password):
+async def login(user: UserLogin, request: Request, db: Session = Depends(get_main_db)):
+    # 按用户名+来源地址、以及单个来源地址限流，在做bcrypt之前就拒绝
+    client_host = request.client.host if request.client else ""
+    user_key = (user.username, client_host)
+    retry_after = max(login_limiter.retry_after(user_key), login_ip_limiter.retry_after(client_host))
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Too many login attempts",
+                            headers={"Retry-After": str(math.ceil(retry_after))})
+    login_limiter.hit(user_key)
+
+    db_user = await run_in_threadpool(
+        lambda: db.query(models.User).filter(models.User.username == user.username).first()
+    )
+    if not db_user:
+        # 单个来源地址只计失败次数：同一出口地址后的大量用户正常登录不受影响
+        login_ip_limiter.hit(client_host)
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    # bcrypt runs on its own executor, not on the threadpool that serves data requests
+    with request_timing.span("password"):
+        valid, new_hash = await passwords.verify_and_update_async(user.password, db_user.hashed_password)
+    if not valid:
+        login_ip_limiter.hit(client_host)
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # 工作因子变了，登录成功时顺便按新配置重新哈希
+        db_user.hashed_password = new_hash
+        await run_in_threadpool(db.commit)
     token = create_access_token({"sub": user.username})
     return {"access_token": token, "is_admin": db_user.is_admin}
 
 @app.post("/api/auth/register")
-def register(user: UserCreate, db: Session = Depends(get_main_db)):
-    if db.query(models.User).filter(models.User.username == user.username).first():
+async def register(user: UserCreate, db: Session = Depends(get_main_db)):
+    exists = await run_in_threadpool(
+        lambda: db.query(models.User.id).filter(models.User.username == user.username).first()
+    )
+    if exists:
         raise HTTPException(status_code=400, detail="Username already exists")
-    db_user = models.User(username=user.username, hashed_password=get_password_hash(user.password), is_admin=user.is_admin)
+    with request_timing.span("password"):
+        hashed_password = await passwords.hash_password_async(user.password)
+    db_user = models.User(username=user.username, hashed_password=hashed_password, is_admin=user.is_admin)
     db.add(db_user)
-    db.commit()
+    await run_in_threadpool(db.commit)
     return {"success": True}
 
 @app.get("/api/auth/me")
-def get_me(current_user: models.User = Depends(get_current_user)):
+def get_me(current_user: AuthenticatedUser = Depends(get_current_user)):
     return {"username": current_user.username, "is_admin": current_user.is_admin}
 
 
@@ -144,29 +731,33 @@ def get_plans(db: Session = Depends(get_main_db)):
     plans = db.query(models.Plan).all()
     result = []
     for p in plans:
-        # Get stage count from plan-specific database
-        plan_db = get_plan_session(p.name)
-        try:
-            stage_count = plan_db.query(models.Stage).count()
-        finally:
-            plan_db.close()
-
         result.append({
             "key": p.name.lower(),
             "name": p.name + " 训练计划",
             "description": p.description or "",
-            "stage_count": stage_count
+            "stage_count": p.stage_count,
+            "total_tokens": p.token_count_sum,
+            "actual_tokens": p.actual_token_sum,
+            "updated_at": p.updated_at.isoformat() if p.updated_at else None
         })
     return {"plans": result}
 
 @app.post("/api/plans")
-def create_plan(plan: PlanCreate, admin: models.User = Depends(require_admin), db: Session = Depends(get_main_db)):
+def create_plan(plan: PlanCreate, admin: AuthenticatedUser = Depends(require_admin), db: Session = Depends(get_main_db)):
     # Check if plan already exists
     existing = db.query(models.Plan).filter(models.Plan.name == plan.name.upper()).first()
     if existing:
         raise HTTPException(status_code=400, detail="Plan already exists")
 
-    db_plan = models.Plan(name=plan.name.upper(), description=plan.description)
+    db_plan = models.Plan(
+        name=plan.name.upper(),
+        description=plan.description,
+        stage_count=0,
+        token_count_sum=0.0,
+        actual_token_sum=0.0,
+        subcategory_row_histogram=subcategory_row_histogram([]),
+        updated_at=datetime.utcnow()
+    )
     db.add(db_plan)
     db.commit()
     db.refresh(db_plan)
@@ -177,16 +768,18 @@ def create_plan(plan: PlanCreate, admin: models.User = Depends(require_admin), d
     return {"key": db_plan.name.lower(), "name": db_plan.name + " 训练计划", "description": db_plan.description, "stage_count": 0}
 
 @app.put("/api/plans/{plan_name}")
-def update_plan(plan_name: str, plan: PlanUpdate, admin: models.User = Depends(require_admin), db: Session = Depends(get_main_db)):
+def update_plan(plan_name: str, plan: PlanUpdate, admin: AuthenticatedUser = Depends(require_admin), db: Session = Depends(get_main_db)):
     db_plan = db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
     if not db_plan:
         raise HTTPException(status_code=404, detail="Plan not found")
     db_plan.description = plan.description
+    db_plan.updated_at = datetime.utcnow()
     db.commit()
+    response_cache.invalidate((db_plan.name, "overview"))
     return {"success": True}
 
 @app.delete("/api/plans/{plan_name}")
-def delete_plan(plan_name: str, admin: models.User = Depends(require_admin), db: Session = Depends(get_main_db)):
+def delete_plan(plan_name: str, admin: AuthenticatedUser = Depends(require_admin), db: Session = Depends(get_main_db)):
     db_plan = db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
     if not db_plan:
         raise HTTPException(status_code=404, detail="Plan not found")
@@ -197,283 +790,352 @@ def delete_plan(plan_name: str, admin: models.User = Depends(require_admin), db:
 
     # Delete plan-specific database file
     delete_plan_database(plan_name.upper())
+    response_cache.invalidate((plan_name.upper(),))
 
     return {"success": True}
 
 
 # ==================== Plan Data Endpoints ====================
 
-@app.get("/api/plan{plan_name}")
-def get_plan(plan_name: str, main_db: Session = Depends(get_main_db)):
-    # Get or create plan in main database
+def load_plan_stages(plan_db: Session) -> dict:
+    """All stages of a plan with their overview rows and merges, in stage order"""
+    stages = plan_db.query(models.Stage).order_by(models.Stage.stage_order, models.Stage.id).all()
+
+    # 所有阶段的行一次查出，再按阶段分组
+    rows_by_stage = {stage.id: [] for stage in stages}
+    all_rows = plan_db.query(models.TableRow).order_by(models.TableRow.stage_id, models.TableRow.row_order).all()
+    for r in all_rows:
+        rows_by_stage.setdefault(r.stage_id, []).append(r)
+
+    stages_data = {}
+    for stage in stages:
+        stages_data[stage.name] = {
+            "rows": [models.table_row_to_dict(r) for r in rows_by_stage[stage.id]],
+            "merges": stage.merges if stage.merges else []
+        }
+    return stages_data
+
+
+def table_row_key(row: dict):
+    """Integer key of an incoming overview row, or None when it has none"""
+    key = row.get('key')
+    if isinstance(key, bool) or not isinstance(key, (int, str)):
+        return None
+    try:
+        return int(key)
+    except ValueError:
+        return None
+
+
+def save_plan_stages(plan_db: Session, stages: dict) -> dict:
+    """Bring the stored stages in line with the incoming ones, writing only what changed.
+
+    Rows are matched to stored rows of the same stage by key (the TableRow id).
+    New rows keep their client key as id when it is free so that the next save
+    matches them; otherwise they get a new id, and "keys" lists the row keys of
+    every such stage in order so the client can adopt them.
+    """
+    if not isinstance(stages, dict) or not all(isinstance(v, dict) for v in stages.values()):
+        raise HTTPException(status_code=400, detail="stages must map stage names to objects")
+    for stage_name, stage_data in stages.items():
+        rows = stage_data.get('rows', [])
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise HTTPException(status_code=400, detail=f"rows of stage {stage_name} must be a list of objects")
+
+    stats = {"inserted": 0, "updated": 0, "deleted": 0, "keys": {}}
+
+    # Delete stages that are no longer in the incoming data
+    existing_stages = {stage.name: stage for stage in plan_db.query(models.Stage).all()}
+    for stage_name in set(existing_stages) - set(stages):
+        stage = existing_stages.pop(stage_name)
+        stats["deleted"] += plan_db.query(models.TableRow).filter(models.TableRow.stage_id == stage.id).delete()
+        detail_ids = select(models.CategoryDetail.id).where(models.CategoryDetail.stage_id == stage.id)
+        plan_db.query(models.DatasetRow).filter(models.DatasetRow.detail_id.in_(detail_ids)).delete(synchronize_session=False)
+        plan_db.query(models.CategoryDetail).filter(models.CategoryDetail.stage_id == stage.id).delete()
+        plan_db.delete(stage)
+    plan_db.flush()
+
+    max_order = max((stage.stage_order or 0 for stage in existing_stages.values()), default=-1)
+    stored_rows = {stage.id: {} for stage in existing_stages.values()}
+    for r in plan_db.query(models.TableRow).all():
+        stored_rows.setdefault(r.stage_id, {})[r.id] = r
+    taken_ids = {row_id for rows in stored_rows.values() for row_id in rows}
+
+    inserts = []
+    updates = []
+    deletes = []
+    reassigned = {}
+    for stage_name, stage_data in stages.items():
+        stage = existing_stages.get(stage_name)
+        if not stage:
+            # New stages go after the existing ones
+            max_order += 1
+            stage = models.Stage(name=stage_name, description="", categories=[], stage_order=max_order)
+            plan_db.add(stage)
+            plan_db.flush()
+
+        current = stored_rows.get(stage.id, {})
+        seen = set()
+        row_ids = []
+        for idx, row in enumerate(stage_data.get('rows', [])):
+            values = {field: row.get(field, '') for field in models.TABLE_ROW_FIELDS}
+            key = table_row_key(row)
+            stored = current.get(key) if key not in seen else None
+            if stored is not None:
+                seen.add(key)
+                changes = {field: value for field, value in values.items() if getattr(stored, field) != value}
+                if stored.row_order != idx:
+                    changes['row_order'] = idx
+                if changes:
+                    updates.append({'id': stored.id, **changes})
+                row_ids.append(stored.id)
+                continue
+
+            mapping = {'stage_id': stage.id, 'row_order': idx, **values}
+            if key is not None and key not in taken_ids and 0 < key < 2 ** 63:
+                mapping['id'] = key
+                taken_ids.add(key)
+                seen.add(key)
+            inserts.append(mapping)
+            row_ids.append(mapping)
+            if 'id' not in mapping:
+                reassigned[stage_name] = row_ids
+
+        deletes.extend(row_id for row_id in current if row_id not in seen)
+
+        merges = stage_data.get('merges', [])
+        if stage.merges != merges:
+            stage.merges = merges
+
+    for start in range(0, len(deletes), SQL_IN_CHUNK_SIZE):
+        plan_db.query(models.TableRow).filter(
+            models.TableRow.id.in_(deletes[start:start + SQL_IN_CHUNK_SIZE])
+        ).delete(synchronize_session=False)
+    if updates:
+        plan_db.execute(update(models.TableRow), updates)
+    # Rows with a client id and rows needing a new one are inserted separately
+    with_id = [m for m in inserts if 'id' in m]
+    if with_id:
+        plan_db.execute(insert(models.TableRow), with_id)
+    for mapping in inserts:
+        if 'id' not in mapping:
+            mapping['id'] = plan_db.execute(insert(models.TableRow).values(**mapping)).inserted_primary_key[0]
+
+    stats["inserted"] = len(inserts)
+    stats["updated"] = len(updates)
+    stats["deleted"] += len(deletes)
+    stats["keys"] = {
+        stage_name: [ref['id'] if isinstance(ref, dict) else ref for ref in row_ids]
+        for stage_name, row_ids in reassigned.items()
+    }
+    return stats
+
+
+def get_or_create_plan(main_db: Session, plan_name: str):
     plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
     if not plan:
         plan = models.Plan(name=plan_name.upper(), description="")
         main_db.add(plan)
         main_db.commit()
         main_db.refresh(plan)
+    return plan
 
-    # Get plan-specific database
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        # Load all stages from plan database, sorted by stage_order
-        stages = plan_db.query(models.Stage).order_by(models.Stage.stage_order, models.Stage.id).all()
-
-        stages_data = {}
-        for stage in stages:
-            rows = plan_db.query(models.TableRow).filter(models.TableRow.stage_id == stage.id).order_by(models.TableRow.row_order).all()
-            stages_data[stage.name] = {
-                "rows": [{
-                    "key": r.id,
-                    "category": r.category,
-                    "subcategory": r.subcategory,
-                    "total_tokens": r.total_tokens,
-                    "sample_ratio": r.sample_ratio,
-                    "cumulative_ratio": r.cumulative_ratio,
-                    "sample_tokens": r.sample_tokens,
-                    "category_ratio": r.category_ratio,
-                    "part1": r.part1,
-                    "part2": r.part2,
-                    "part3": r.part3,
-                    "part4": r.part4,
-                    "part5": r.part5,
-                    "note": r.note
-                } for r in rows],
-                "merges": stage.merges if stage.merges else []
-            }
-
-        return {"description": plan.description, "stages": stages_data}
-    finally:
-        plan_db.close()
+
+@app.get("/api/plan{plan_name}")
+async def get_plan(
+    plan_name: str,
+    request: Request,
+    response: Response,
+    plan: models.Plan = Depends(get_existing_plan_async),
+    plan_db: AsyncSession = Depends(get_existing_async_plan_db)
+):
+    # 描述存在main.db里，不经过计划库版本号，用它的校验和区分
+    description = plan.description or ""
+    etag = f'"{plan.id}.{await get_plan_version_async(plan_db)}.{zlib.crc32(description.encode("utf-8")):x}"'
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+    return json_response(await get_or_build_async(
+        plan_db,
+        ("plan", plan.name, etag),
+        lambda session: {"description": plan.description, "stages": load_plan_stages(session)},
+        cache_tags(plan.name, "overview")
+    ), response)
 
 @app.post("/api/plan{plan_name}")
-def save_plan(plan_name: str, data: Plan72BData, admin: models.User = Depends(require_admin), main_db: Session = Depends(get_main_db)):
-    # Get or create plan in main database
-    plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
-    if not plan:
-        plan = models.Plan(name=plan_name.upper())
-        main_db.add(plan)
+def save_plan(plan_name: str, data: Plan72BData, admin: AuthenticatedUser = Depends(require_admin), main_db: Session = Depends(get_main_db), plan_db: Session = Depends(get_plan_db)):
+    """Save the whole plan; only rows and stages that differ from the stored ones are written"""
+    plan = get_or_create_plan(main_db, plan_name)
+
+    stats = save_plan_stages(plan_db, data.stages)
+    plan_db.commit()
+
+    if plan.description != data.description:
+        plan.description = data.description
         main_db.commit()
-        main_db.refresh(plan)
+        response_cache.invalidate((plan.name, "overview"))
+    return {"success": True, **stats}
 
-    plan.description = data.description
-    main_db.commit()
+@app.patch("/api/plan{plan_name}")
+def patch_plan(plan_name: str, operations: List[dict], admin: AuthenticatedUser = Depends(require_admin), main_db: Session = Depends(get_main_db), plan_db: Session = Depends(get_plan_db)):
+    """Apply a JSON Patch to the plan document ({description, stages}) returned by GET"""
+    plan = get_or_create_plan(main_db, plan_name)
 
-    # Get plan-specific database
-    plan_db = get_plan_session(plan_name.upper())
+    document = {"description": plan.description or "", "stages": load_plan_stages(plan_db)}
     try:
-        # Get existing stages from plan database
-        existing_stages = plan_db.query(models.Stage).all()
-        existing_stage_names = {stage.name for stage in existing_stages}
-        incoming_stage_names = set(data.stages.keys())
-
-        # Delete stages that are no longer in the incoming data
-        stages_to_delete = existing_stage_names - incoming_stage_names
-        for stage_name in stages_to_delete:
-            stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
-            if stage:
-                # Delete related data first (cascade delete should handle this, but being explicit)
-                plan_db.query(models.TableRow).filter(models.TableRow.stage_id == stage.id).delete()
-                plan_db.query(models.CategoryDetail).filter(models.CategoryDetail.stage_id == stage.id).delete()
-                plan_db.delete(stage)
-
-        # Add or update stages
-        for order, (stage_name, stage_data) in enumerate(data.stages.items()):
-            stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
-
-            if not stage:
-                # Create new stage with proper order
-                max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
-                next_order = (max_order_result.stage_order + 1) if max_order_result else 0
-
-                stage = models.Stage(
-                    name=stage_name,
-                    description="",
-                    categories=[],
-                    stage_order=next_order
-                )
-                plan_db.add(stage)
-                plan_db.commit()
-                plan_db.refresh(stage)
-
-            # Update stage data
-            plan_db.query(models.TableRow).filter(models.TableRow.stage_id == stage.id).delete()
-
-            for idx, row in enumerate(stage_data['rows']):
-                db_row = models.TableRow(
-                    stage_id=stage.id,
-                    row_order=idx,
-                    category=row.get('category', ''),
-                    subcategory=row.get('subcategory', ''),
-                    total_tokens=row.get('total_tokens', ''),
-                    sample_ratio=row.get('sample_ratio', ''),
-                    cumulative_ratio=row.get('cumulative_ratio', ''),
-                    sample_tokens=row.get('sample_tokens', ''),
-                    category_ratio=row.get('category_ratio', ''),
-                    part1=row.get('part1', ''),
-                    part2=row.get('part2', ''),
-                    part3=row.get('part3', ''),
-                    part4=row.get('part4', ''),
-                    part5=row.get('part5', ''),
-                    note=row.get('note', '')
-                )
-                plan_db.add(db_row)
+        document = json_patch.apply_patch(document, operations)
+    except json_patch.JsonPatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not isinstance(document, dict) or not isinstance(document.get("description", ""), str):
+        raise HTTPException(status_code=400, detail="Patched plan must have a string description and stages")
 
-            stage.merges = stage_data.get('merges', [])
+    stats = save_plan_stages(plan_db, document.get("stages", {}))
+    plan_db.commit()
 
-        plan_db.commit()
-        return {"success": True}
-    finally:
-        plan_db.close()
+    if plan.description != document.get("description", ""):
+        plan.description = document.get("description", "")
+        main_db.commit()
+        response_cache.invalidate((plan.name, "overview"))
+    return {"success": True, **stats}
 
 
 # ==================== Stage Endpoints ====================
 
 @app.get("/api/plans/{plan_name}/stages")
-def get_stages(plan_name: str, main_db: Session = Depends(get_main_db)):
-    # Verify plan exists in main database
-    plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
-    if not plan:
-        raise HTTPException(status_code=404, detail="Plan not found")
-
-    # Get stages from plan-specific database
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        stages = plan_db.query(models.Stage).order_by(models.Stage.stage_order).all()
-        result = []
-        for s in stages:
-            row_count = plan_db.query(models.TableRow).filter(models.TableRow.stage_id == s.id).count()
-            result.append({"id": s.id, "name": s.name, "row_count": row_count})
-        return result
-    finally:
-        plan_db.close()
+def get_stages(plan_name: str, plan_db: Session = Depends(get_existing_plan_db)):
+    # 各阶段行数用一条分组查询统计
+    row_counts = plan_db.query(
+        models.TableRow.stage_id, func.count(models.TableRow.id).label("row_count")
+    ).group_by(models.TableRow.stage_id).subquery()
+    stages = plan_db.query(
+        models.Stage.id, models.Stage.name, func.coalesce(row_counts.c.row_count, 0)
+    ).outerjoin(
+        row_counts, row_counts.c.stage_id == models.Stage.id
+    ).order_by(models.Stage.stage_order).all()
+    return [{"id": stage_id, "name": name, "row_count": row_count} for stage_id, name, row_count in stages]
 
 @app.post("/api/plans/{plan_name}/stages")
-def create_stage(plan_name: str, stage: StageCreate, admin: models.User = Depends(require_admin), main_db: Session = Depends(get_main_db)):
-    # Verify plan exists in main database
-    plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
-    if not plan:
-        raise HTTPException(status_code=404, detail="Plan not found")
+def create_stage(plan_name: str, stage: StageCreate, admin: AuthenticatedUser = Depends(require_admin), plan_db: Session = Depends(get_existing_plan_db)):
+    # Get max order
+    max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
+    next_order = (max_order_result.stage_order + 1) if max_order_result else 0
 
-    # Create stage in plan-specific database
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        # Get max order
-        max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
-        next_order = (max_order_result.stage_order + 1) if max_order_result else 0
-
-        db_stage = models.Stage(name=stage.name, stage_order=next_order, description="", categories=[])
-        plan_db.add(db_stage)
-        plan_db.commit()
-        plan_db.refresh(db_stage)
-        return {"id": db_stage.id, "name": db_stage.name}
-    finally:
-        plan_db.close()
+    db_stage = models.Stage(name=stage.name, stage_order=next_order, description="", categories=[])
+    plan_db.add(db_stage)
+    plan_db.commit()
+    plan_db.refresh(db_stage)
+    return {"id": db_stage.id, "name": db_stage.name}
 
 
 # ==================== Category Endpoints ====================
 
-@app.get("/api/plans/{plan_name}/stages/{stage_name}/categories")
-def get_stage_categories(plan_name: str, stage_name: str, main_db: Session = Depends(get_main_db)):
-    # Verify plan exists in main database
-    plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
-    if not plan:
-        plan = models.Plan(name=plan_name.upper(), description="")
-        main_db.add(plan)
-        main_db.commit()
-        main_db.refresh(plan)
-
-    # Get or create stage in plan database
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
-
-        if not stage:
-            max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
-            next_order = (max_order_result.stage_order + 1) if max_order_result else 0
-            stage = models.Stage(name=stage_name, description="", categories=[], stage_order=next_order)
-            plan_db.add(stage)
-            plan_db.commit()
-            plan_db.refresh(stage)
-
-        # Get all CategoryDetail data
-        category_details = plan_db.query(models.CategoryDetail).filter(
-            models.CategoryDetail.stage_id == stage.id
-        ).all()
-
-        # If stage.categories is empty but we have CategoryDetail data, rebuild from CategoryDetail
-        if not stage.categories and category_details:
-            category_dict = {}
-            for detail in category_details:
-                cat_name = detail.category_name
-                sub_name = detail.subcategory_name
-
-                if cat_name not in category_dict:
-                    category_dict[cat_name] = {
-                        'id': hash(cat_name) & 0x7FFFFFFF,
-                        'name': cat_name,
-                        'subcategories': []
-                    }
-
-                category_dict[cat_name]['subcategories'].append({
-                    'id': hash(f"{cat_name}_{sub_name}") & 0x7FFFFFFF,
-                    'name': sub_name
-                })
-
-            stage.categories = list(category_dict.values())
-            plan_db.commit()
-
-        # Build statistics dictionary
-        stats_dict = {}
+def load_stage_categories(plan_db: Session, stage: models.Stage) -> dict:
+    """Category tree of a stage with the token totals of every subcategory and category"""
+    # Get all CategoryDetail data
+    category_details = plan_db.query(models.CategoryDetail).filter(
+        models.CategoryDetail.stage_id == stage.id
+    ).all()
+
+    categories = stage.categories or []
+    # If stage.categories is empty but we have CategoryDetail data, rebuild from CategoryDetail
+    # (in the response only; the tree is stored when an admin saves the stage)
+    if not categories and category_details:
+        category_dict = {}
         for detail in category_details:
-            key = (detail.category_name, detail.subcategory_name)
-            stats_dict[key] = {
-                'tokenCountTotal': detail.token_count_total or '0',
-                'actualTokenTotal': detail.actual_token_total or '0'
-            }
-
-        # Merge statistics into categories
-        categories_with_stats = []
-        for category in stage.categories:
-            subcategories_with_stats = []
-            category_token_total = 0.0
-            category_actual_total = 0.0
-
-            for sub in category.get('subcategories', []):
-                key = (category['name'], sub['name'])
-                stats = stats_dict.get(key, {'tokenCountTotal': '0', 'actualTokenTotal': '0'})
+            cat_name = detail.category_name
+            sub_name = detail.subcategory_name
+
+            if cat_name not in category_dict:
+                category_dict[cat_name] = {
+                    'id': stable_id(cat_name),
+                    'name': cat_name,
+                    'subcategories': []
+                }
+
+            category_dict[cat_name]['subcategories'].append({
+                'id': stable_id(f"{cat_name}_{sub_name}"),
+                'name': sub_name
+            })
 
+        categories = list(category_dict.values())
+
+    # Build statistics dictionary
+    stats_dict = {}
+    for detail in category_details:
+        key = (detail.category_name, detail.subcategory_name)
+        stats_dict[key] = (detail.token_count_sum or 0.0, detail.actual_token_sum or 0.0)
+
+    # Merge statistics into categories
+    categories_with_stats = []
+    for category in categories:
+        subcategories_with_stats = []
+        category_token_total = 0.0
+        category_actual_total = 0.0
+
+        for sub in category.get('subcategories', []):
+            key = (category['name'], sub['name'])
+            if key in stats_dict:
+                token_total, actual_total = stats_dict[key]
                 subcategories_with_stats.append({
                     **sub,
-                    'tokenCountTotal': stats['tokenCountTotal'],
-                    'actualTokenTotal': stats['actualTokenTotal']
+                    'tokenCountTotal': format_token_total(token_total),
+                    'actualTokenTotal': format_token_total(actual_total)
                 })
+            else:
+                token_total, actual_total = 0.0, 0.0
+                subcategories_with_stats.append({**sub, 'tokenCountTotal': '0', 'actualTokenTotal': '0'})
+
+            # Add to category totals
+            category_token_total += token_total
+            category_actual_total += actual_total
+
+        categories_with_stats.append({
+            **category,
+            'subcategories': subcategories_with_stats,
+            'tokenCountTotal': f"{category_token_total:.2f}",
+            'actualTokenTotal': f"{category_actual_total:.2f}"
+        })
 
-                # Add to category totals
-                category_token_total += float(stats['tokenCountTotal'])
-                category_actual_total += float(stats['actualTokenTotal'])
+    return {
+        "description": stage.description,
+        "categories": categories_with_stats
+    }
 
-            categories_with_stats.append({
-                **category,
-                'subcategories': subcategories_with_stats,
-                'tokenCountTotal': f"{category_token_total:.2f}",
-                'actualTokenTotal': f"{category_actual_total:.2f}"
-            })
 
-        return {
-            "description": stage.description,
-            "categories": categories_with_stats
-        }
-    finally:
-        plan_db.close()
+@app.get("/api/plans/{plan_name}/stages/{stage_name}/categories")
+async def get_stage_categories(
+    plan_name: str,
+    stage_name: str,
+    request: Request,
+    response: Response,
+    plan: models.Plan = Depends(get_existing_plan_async),
+    plan_db: AsyncSession = Depends(get_existing_async_plan_db)
+):
+    stage = await plan_db.scalar(select(models.Stage).where(models.Stage.name == stage_name).limit(1))
+    if not stage:
+        # 只读：阶段还没建时返回空结构，不写库
+        cached = not_modified(request, response, f'"{plan.id}.{await get_plan_version_async(plan_db)}"')
+        return cached or {"description": "", "categories": []}
+
+    etag = f'"{plan.id}.s{stage.id}.{stage.version}"'
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+    return json_response(await get_or_build_async(
+        plan_db,
+        ("stage", plan.name, etag),
+        lambda session: load_stage_categories(session, stage),
+        cache_tags(plan.name, "stage", stage.id)
+    ), response)
 
 @app.post("/api/plans/{plan_name}/stages/{stage_name}/categories")
 def save_stage_categories(
     plan_name: str,
     stage_name: str,
     data: CategoryData,
-    admin: models.User = Depends(require_admin),
-    main_db: Session = Depends(get_main_db)
+    admin: AuthenticatedUser = Depends(require_admin),
+    main_db: Session = Depends(get_main_db),
+    plan_db: Session = Depends(get_plan_db)
 ):
     # Verify plan exists in main database
     plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
@@ -483,97 +1145,139 @@ def save_stage_categories(
         main_db.commit()
         main_db.refresh(plan)
 
-    # Get or create stage in plan database
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
-
-        if not stage:
-            max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
-            next_order = (max_order_result.stage_order + 1) if max_order_result else 0
-            stage = models.Stage(name=stage_name, stage_order=next_order)
-            plan_db.add(stage)
-            plan_db.commit()
-            plan_db.refresh(stage)
+    stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
 
-        stage.description = data.description
-        stage.categories = data.categories
+    if not stage:
+        max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
+        next_order = (max_order_result.stage_order + 1) if max_order_result else 0
+        stage = models.Stage(name=stage_name, stage_order=next_order)
+        plan_db.add(stage)
         plan_db.commit()
-        return {"success": True}
-    finally:
-        plan_db.close()
+        plan_db.refresh(stage)
+
+    stage.description = data.description
+    stage.categories = data.categories
+    plan_db.commit()
+    return {"success": True}
 
 
 # ==================== Category Detail Endpoints ====================
 
+def load_category_detail_page(plan_db: Session, category_data: models.CategoryDetail, page: int, page_size: int,
+                              sort_by: str, sort_order: str, search: Optional[str], cursor: Optional[str]) -> dict:
+    """One page of a subcategory's rows, filtered by path and sorted, with its totals"""
+    rows_query = plan_db.query(models.DatasetRow).filter(models.DatasetRow.detail_id == category_data.id)
+    if search:
+        # 按路径子串过滤
+        escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = f"%{escaped}%"
+        rows_query = rows_query.filter(or_(
+            models.DatasetRow.hdfs_path.like(pattern, escape="\\"),
+            models.DatasetRow.obs_full_path.like(pattern, escape="\\")
+        ))
+    # 未过滤时直接用维护好的行数，省掉一次COUNT扫描
+    total = rows_query.count() if search else category_data.row_count
+
+    sort_column = CATEGORY_ROW_SORTS[sort_by]
+    id_column = models.DatasetRow.id
+    if sort_order == "desc":
+        order_by = (sort_column.desc(), id_column.desc())
+    else:
+        order_by = (sort_column, id_column)
+
+    page_query = rows_query.add_columns(sort_column)
+
+    if cursor:
+        # Keyset分页：从游标位置继续，深分页不需要OFFSET扫描
+        cursor_value, cursor_id = decode_row_cursor(cursor, sort_by)
+        if sort_order == "desc":
+            page_query = page_query.filter(or_(
+                sort_column < cursor_value,
+                and_(sort_column == cursor_value, id_column < cursor_id)
+            ))
+        else:
+            page_query = page_query.filter(or_(
+                sort_column > cursor_value,
+                and_(sort_column == cursor_value, id_column > cursor_id)
+            ))
+        page_query = page_query.order_by(*order_by).limit(page_size)
+    else:
+        page_query = page_query.order_by(*order_by).offset((page - 1) * page_size).limit(page_size)
+    paged_rows = page_query.all()
+
+    next_cursor = None
+    if len(paged_rows) == page_size:
+        last_row, last_value = paged_rows[-1]
+        next_cursor = encode_row_cursor(sort_by, last_value, last_row.id)
+
+    return {
+        "description": category_data.description,
+        "rows": [models.dataset_row_to_dict(r) for r, _ in paged_rows],
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "next_cursor": next_cursor,
+        "tokenCountTotal": format_token_total(category_data.token_count_sum),
+        "actualTokenTotal": format_token_total(category_data.actual_token_sum)
+    }
+
+
 @app.get("/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}")
-def get_category_detail(
+async def get_category_detail(
     plan_name: str,
     stage_name: str,
     category_name: str,
     subcategory_name: str,
+    request: Request,
+    response: Response,
     page: int = 1,
     page_size: int = 20,
-    main_db: Session = Depends(get_main_db)
+    sort_by: str = "row_order",
+    sort_order: str = "asc",
+    search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    plan: models.Plan = Depends(get_existing_plan_async),
+    plan_db: AsyncSession = Depends(get_existing_async_plan_db)
 ):
-    # Verify plan exists in main database
-    plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
-    if not plan:
-        plan = models.Plan(name=plan_name.upper(), description="")
-        main_db.add(plan)
-        main_db.commit()
-        main_db.refresh(plan)
-
-    # Get or create stage in plan database
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
-
-        if not stage:
-            max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
-            next_order = (max_order_result.stage_order + 1) if max_order_result else 0
-            stage = models.Stage(name=stage_name, stage_order=next_order)
-            plan_db.add(stage)
-            plan_db.commit()
-            plan_db.refresh(stage)
-
-        category_data = plan_db.query(models.CategoryDetail).filter(
-            models.CategoryDetail.stage_id == stage.id,
-            models.CategoryDetail.category_name == category_name,
-            models.CategoryDetail.subcategory_name == subcategory_name
-        ).first()
-
-        # 如果CategoryDetail不存在，创建一个空的
-        if not category_data:
-            category_data = models.CategoryDetail(
-                stage_id=stage.id,
-                category_name=category_name,
-                subcategory_name=subcategory_name,
-                description="",
-                token_count_total="0.00",
-                actual_token_total="0.00"
-            )
-            plan_db.add(category_data)
-            plan_db.commit()
-            plan_db.refresh(category_data)
-
-        all_rows = category_data.rows
-        total = len(all_rows)
-        start = (page - 1) * page_size
-        end = start + page_size
-        paged_rows = all_rows[start:end]
-
-        return {
-            "description": category_data.description,
-            "rows": paged_rows,
-            "total": total,
+    if sort_by not in CATEGORY_ROW_SORTS:
+        raise HTTPException(status_code=400, detail=f"Unsupported sort_by: {sort_by}")
+    if sort_order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"Unsupported sort_order: {sort_order}")
+    page = max(page, 1)
+    page_size = max(page_size, 1)
+
+    category_data = await plan_db.scalar(select(models.CategoryDetail).join(
+        models.Stage, models.Stage.id == models.CategoryDetail.stage_id
+    ).where(
+        models.Stage.name == stage_name,
+        models.CategoryDetail.category_name == category_name,
+        models.CategoryDetail.subcategory_name == subcategory_name
+    ).limit(1))
+
+    # 只读：子类别还没有数据时返回空页，不写库
+    if not category_data:
+        cached = not_modified(request, response, f'"{plan.id}.{await get_plan_version_async(plan_db)}"')
+        return cached or {
+            "description": "",
+            "rows": [],
+            "total": 0,
             "page": page,
             "page_size": page_size,
-            "tokenCountTotal": category_data.token_count_total or "0.00",
-            "actualTokenTotal": category_data.actual_token_total or "0.00"
+            "next_cursor": None,
+            "tokenCountTotal": format_token_total(0.0),
+            "actualTokenTotal": format_token_total(0.0)
         }
-    finally:
-        plan_db.close()
+
+    etag = f'"{plan.id}.d{category_data.id}.{category_data.version}"'
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+    return json_response(await get_or_build_async(
+        plan_db,
+        ("detail", plan.name, etag, page, page_size, sort_by, sort_order, search, cursor),
+        lambda session: load_category_detail_page(session, category_data, page, page_size, sort_by, sort_order, search, cursor),
+        cache_tags(plan.name, "detail", category_data.id)
+    ), response)
 
 @app.post("/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}")
 def save_category_detail(
@@ -582,8 +1286,9 @@ def save_category_detail(
     category_name: str,
     subcategory_name: str,
     data: CategoryDetailData,
-    admin: models.User = Depends(require_admin),
-    main_db: Session = Depends(get_main_db)
+    admin: AuthenticatedUser = Depends(require_admin),
+    main_db: Session = Depends(get_main_db),
+    plan_db: Session = Depends(get_plan_db)
 ):
     # Verify plan exists in main database
     plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
@@ -593,62 +1298,51 @@ def save_category_detail(
         main_db.commit()
         main_db.refresh(plan)
 
-    # Get or create stage in plan database
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
-
-        if not stage:
-            max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
-            next_order = (max_order_result.stage_order + 1) if max_order_result else 0
-            stage = models.Stage(name=stage_name, stage_order=next_order)
-            plan_db.add(stage)
-            plan_db.commit()
-            plan_db.refresh(stage)
-
-        category_data = plan_db.query(models.CategoryDetail).filter(
-            models.CategoryDetail.stage_id == stage.id,
-            models.CategoryDetail.category_name == category_name,
-            models.CategoryDetail.subcategory_name == subcategory_name
-        ).first()
-
-        if not category_data:
-            category_data = models.CategoryDetail(
-                stage_id=stage.id,
-                category_name=category_name,
-                subcategory_name=subcategory_name
-            )
-            plan_db.add(category_data)
-
-        category_data.description = data.description
-        category_data.rows = data.rows
-
-        # 重新计算Token统计
-        token_total = 0.0
-        actual_total = 0.0
-        for r in data.rows:
-            try:
-                token_count = r.get('token_count', '') or '0'
-                token_total += float(token_count)
-            except (ValueError, TypeError):
-                pass
-            try:
-                actual_token = r.get('actual_token', '') or '0'
-                actual_total += float(actual_token)
-            except (ValueError, TypeError):
-                pass
-
-        category_data.token_count_total = f"{token_total:.2f}"
-        category_data.actual_token_total = f"{actual_total:.2f}"
+    stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
 
+    if not stage:
+        max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
+        next_order = (max_order_result.stage_order + 1) if max_order_result else 0
+        stage = models.Stage(name=stage_name, stage_order=next_order)
+        plan_db.add(stage)
         plan_db.commit()
-        return {
-            "success": True,
-            "tokenCountTotal": category_data.token_count_total,
-            "actualTokenTotal": category_data.actual_token_total
-        }
-    finally:
-        plan_db.close()
+        plan_db.refresh(stage)
+
+    category_data = plan_db.query(models.CategoryDetail).filter(
+        models.CategoryDetail.stage_id == stage.id,
+        models.CategoryDetail.category_name == category_name,
+        models.CategoryDetail.subcategory_name == subcategory_name
+    ).first()
+
+    if not category_data:
+        category_data = models.CategoryDetail(
+            stage_id=stage.id,
+            category_name=category_name,
+            subcategory_name=subcategory_name
+        )
+        plan_db.add(category_data)
+        plan_db.flush()
+
+    category_data.description = data.description
+
+    # 整表覆盖：替换该子类别的全部数据行
+    plan_db.query(models.DatasetRow).filter(
+        models.DatasetRow.detail_id == category_data.id
+    ).delete(synchronize_session=False)
+    mappings = models.dataset_row_mappings(category_data.id, data.rows)
+    if mappings:
+        plan_db.execute(insert(models.DatasetRow), mappings)
+
+    # 重新计算Token统计
+    token_total, actual_total = sum_dataset_row_tokens((m['token_count'], m['actual_token']) for m in mappings)
+    set_category_totals(plan_db, category_data, token_total, actual_total, len(mappings))
+
+    plan_db.commit()
+    return {
+        "success": True,
+        "tokenCountTotal": format_token_total(category_data.token_count_sum),
+        "actualTokenTotal": format_token_total(category_data.actual_token_sum)
+    }
 
 @app.patch("/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}/description")
 def update_description(
@@ -657,45 +1351,40 @@ def update_description(
     category_name: str,
     subcategory_name: str,
     data: dict,
-    admin: models.User = Depends(require_admin),
-    main_db: Session = Depends(get_main_db)
+    admin: AuthenticatedUser = Depends(require_admin),
+    main_db: Session = Depends(get_main_db),
+    plan_db: Session = Depends(get_plan_db)
 ):
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
-        if not stage:
-            # Create stage if it doesn't exist (consistent with GET endpoint)
-            max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
-            next_order = (max_order_result.stage_order + 1) if max_order_result else 0
-            stage = models.Stage(name=stage_name, stage_order=next_order, description="", categories=[])
-            plan_db.add(stage)
-            plan_db.commit()
-            plan_db.refresh(stage)
-
-        category_data = plan_db.query(models.CategoryDetail).filter(
-            models.CategoryDetail.stage_id == stage.id,
-            models.CategoryDetail.category_name == category_name,
-            models.CategoryDetail.subcategory_name == subcategory_name
-        ).first()
-
-        if not category_data:
-            # Create CategoryDetail if it doesn't exist
-            category_data = models.CategoryDetail(
-                stage_id=stage.id,
-                category_name=category_name,
-                subcategory_name=subcategory_name,
-                description="",
-                token_count_total="0.00",
-                actual_token_total="0.00"
-            )
-            plan_db.add(category_data)
-            plan_db.flush()
-
-        category_data.description = data.get("description", "")
+    stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
+    if not stage:
+        # Create stage if it doesn't exist
+        max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
+        next_order = (max_order_result.stage_order + 1) if max_order_result else 0
+        stage = models.Stage(name=stage_name, stage_order=next_order, description="", categories=[])
+        plan_db.add(stage)
         plan_db.commit()
-        return {"success": True}
-    finally:
-        plan_db.close()
+        plan_db.refresh(stage)
+
+    category_data = plan_db.query(models.CategoryDetail).filter(
+        models.CategoryDetail.stage_id == stage.id,
+        models.CategoryDetail.category_name == category_name,
+        models.CategoryDetail.subcategory_name == subcategory_name
+    ).first()
+
+    if not category_data:
+        # Create CategoryDetail if it doesn't exist
+        category_data = models.CategoryDetail(
+            stage_id=stage.id,
+            category_name=category_name,
+            subcategory_name=subcategory_name,
+            description=""
+        )
+        plan_db.add(category_data)
+        plan_db.flush()
+
+    category_data.description = data.get("description", "")
+    plan_db.commit()
+    return {"success": True}
 
 @app.patch("/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}/row")
 def update_row(
@@ -704,95 +1393,78 @@ def update_row(
     category_name: str,
     subcategory_name: str,
     data: RowUpdateData,
-    admin: models.User = Depends(require_admin),
-    main_db: Session = Depends(get_main_db)
+    admin: AuthenticatedUser = Depends(require_admin),
+    main_db: Session = Depends(get_main_db),
+    plan_db: Session = Depends(get_plan_db)
 ):
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
-        if not stage:
-            # Create stage if it doesn't exist (consistent with GET endpoint)
-            max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
-            next_order = (max_order_result.stage_order + 1) if max_order_result else 0
-            stage = models.Stage(name=stage_name, stage_order=next_order, description="", categories=[])
-            plan_db.add(stage)
-            plan_db.commit()
-            plan_db.refresh(stage)
-
-        category_data = plan_db.query(models.CategoryDetail).filter(
-            models.CategoryDetail.stage_id == stage.id,
-            models.CategoryDetail.category_name == category_name,
-            models.CategoryDetail.subcategory_name == subcategory_name
-        ).first()
-
-        # 如果CategoryDetail不存在，创建一个新的
-        if not category_data:
-            category_data = models.CategoryDetail(
-                stage_id=stage.id,
-                category_name=category_name,
-                subcategory_name=subcategory_name,
-                description="",
-                token_count_total="0",
-                actual_token_total="0"
-            )
-            plan_db.add(category_data)
-            plan_db.flush()  # 确保ID被分配
-
-        rows = category_data.rows
-        found = False
-        for i, row in enumerate(rows):
-            if row.get('key') == data.key:
-                rows[i] = {
-                    'key': data.key,
-                    'hdfs_path': data.hdfs_path or '',
-                    'obs_fuzzy_path': data.obs_fuzzy_path or '',
-                    'obs_full_path': data.obs_full_path or '',
-                    'token_count': data.token_count or '',
-                    'actual_usage': data.actual_usage or '',
-                    'actual_token': data.actual_token or ''
-                }
-                found = True
-                break
-
-        if not found:
-            rows.append({
-                'key': data.key,
-                'hdfs_path': data.hdfs_path or '',
-                'obs_fuzzy_path': data.obs_fuzzy_path or '',
-                'obs_full_path': data.obs_full_path or '',
-                'token_count': data.token_count or '',
-                'actual_usage': data.actual_usage or '',
-                'actual_token': data.actual_token or ''
-            })
-
-        category_data.rows = rows
-
-        # Recalculate totals
-        token_total = 0.0
-        actual_total = 0.0
-        for r in rows:
-            try:
-                token_count = r.get('token_count', '') or '0'
-                token_total += float(token_count)
-            except (ValueError, TypeError):
-                pass
-            try:
-                actual_token = r.get('actual_token', '') or '0'
-                actual_total += float(actual_token)
-            except (ValueError, TypeError):
-                pass
-
-        category_data.token_count_total = f"{token_total:.2f}"
-        category_data.actual_token_total = f"{actual_total:.2f}"
-
+    stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
+    if not stage:
+        # Create stage if it doesn't exist
+        max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
+        next_order = (max_order_result.stage_order + 1) if max_order_result else 0
+        stage = models.Stage(name=stage_name, stage_order=next_order, description="", categories=[])
+        plan_db.add(stage)
         plan_db.commit()
-        return {
-            "success": True,
-            "tokenCountTotal": category_data.token_count_total,
-            "actualTokenTotal": category_data.actual_token_total
-        }
-    finally:
-        plan_db.close()
+        plan_db.refresh(stage)
+
+    category_data = plan_db.query(models.CategoryDetail).filter(
+        models.CategoryDetail.stage_id == stage.id,
+        models.CategoryDetail.category_name == category_name,
+        models.CategoryDetail.subcategory_name == subcategory_name
+    ).first()
+
+    # 如果CategoryDetail不存在，创建一个新的
+    if not category_data:
+        category_data = models.CategoryDetail(
+            stage_id=stage.id,
+            category_name=category_name,
+            subcategory_name=subcategory_name,
+            description=""
+        )
+        plan_db.add(category_data)
+        plan_db.flush()  # 确保ID被分配
+
+    values = {field: getattr(data, field) or '' for field in models.DATASET_ROW_FIELDS}
+    row = plan_db.query(models.DatasetRow).filter(
+        models.DatasetRow.detail_id == category_data.id,
+        models.DatasetRow.row_key == data.key
+    ).first()
+
+    if row:
+        old_token, old_actual = parse_token_value(row.token_count), parse_token_value(row.actual_token)
+        added = 0
+        for field, value in values.items():
+            setattr(row, field, value)
+    else:
+        old_token, old_actual = 0.0, 0.0
+        added = 1
+        # 新行追加到末尾
+        max_order = plan_db.query(func.max(models.DatasetRow.row_order)).filter(
+            models.DatasetRow.detail_id == category_data.id
+        ).scalar()
+        row = models.DatasetRow(
+            detail_id=category_data.id,
+            row_key=data.key,
+            row_order=(max_order + 1) if max_order is not None else 0,
+            **values
+        )
+        plan_db.add(row)
+    plan_db.flush()
+
+    # Apply only this row's change to the totals
+    shift_category_totals(
+        plan_db, category_data,
+        parse_token_value(values['token_count']) - old_token,
+        parse_token_value(values['actual_token']) - old_actual,
+        added
+    )
+
+    plan_db.commit()
+    return {
+        "success": True,
+        "tokenCountTotal": format_token_total(category_data.token_count_sum),
+        "actualTokenTotal": format_token_total(category_data.actual_token_sum)
+    }
 
 @app.delete("/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}/rows")
 def delete_rows(
@@ -801,208 +1473,549 @@ def delete_rows(
     category_name: str,
     subcategory_name: str,
     data: RowDeleteData,
-    admin: models.User = Depends(require_admin),
-    main_db: Session = Depends(get_main_db)
+    admin: AuthenticatedUser = Depends(require_admin),
+    main_db: Session = Depends(get_main_db),
+    plan_db: Session = Depends(get_plan_db)
 ):
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
-        if not stage:
-            # Create stage if it doesn't exist (consistent with GET endpoint)
-            max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
-            next_order = (max_order_result.stage_order + 1) if max_order_result else 0
-            stage = models.Stage(name=stage_name, stage_order=next_order, description="", categories=[])
-            plan_db.add(stage)
-            plan_db.commit()
-            plan_db.refresh(stage)
-
-        category_data = plan_db.query(models.CategoryDetail).filter(
-            models.CategoryDetail.stage_id == stage.id,
-            models.CategoryDetail.category_name == category_name,
-            models.CategoryDetail.subcategory_name == subcategory_name
-        ).first()
-
-        if not category_data:
-            # Create CategoryDetail if it doesn't exist (empty, nothing to delete)
-            category_data = models.CategoryDetail(
-                stage_id=stage.id,
-                category_name=category_name,
-                subcategory_name=subcategory_name,
-                description="",
-                token_count_total="0.00",
-                actual_token_total="0.00"
-            )
-            plan_db.add(category_data)
-            plan_db.commit()
-            return {
-                "success": True,
-                "total": 0,
-                "tokenCountTotal": "0.00",
-                "actualTokenTotal": "0.00"
-            }
-
-        rows = [r for r in category_data.rows if r.get('key') not in data.keys]
-        category_data.rows = rows
-
-        # Recalculate totals with error handling
-        token_total = 0.0
-        actual_total = 0.0
-        for r in rows:
-            try:
-                token_count = r.get('token_count', '') or '0'
-                token_total += float(token_count)
-            except (ValueError, TypeError):
-                pass
-            try:
-                actual_token = r.get('actual_token', '') or '0'
-                actual_total += float(actual_token)
-            except (ValueError, TypeError):
-                pass
-
-        category_data.token_count_total = f"{token_total:.2f}"
-        category_data.actual_token_total = f"{actual_total:.2f}"
-
+    stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
+    if not stage:
+        # Create stage if it doesn't exist
+        max_order_result = plan_db.query(models.Stage).order_by(models.Stage.stage_order.desc()).first()
+        next_order = (max_order_result.stage_order + 1) if max_order_result else 0
+        stage = models.Stage(name=stage_name, stage_order=next_order, description="", categories=[])
+        plan_db.add(stage)
+        plan_db.commit()
+        plan_db.refresh(stage)
+
+    category_data = plan_db.query(models.CategoryDetail).filter(
+        models.CategoryDetail.stage_id == stage.id,
+        models.CategoryDetail.category_name == category_name,
+        models.CategoryDetail.subcategory_name == subcategory_name
+    ).first()
+
+    if not category_data:
+        # Create CategoryDetail if it doesn't exist (empty, nothing to delete)
+        category_data = models.CategoryDetail(
+            stage_id=stage.id,
+            category_name=category_name,
+            subcategory_name=subcategory_name,
+            description=""
+        )
+        plan_db.add(category_data)
         plan_db.commit()
         return {
             "success": True,
-            "total": len(rows),
-            "tokenCountTotal": category_data.token_count_total,
-            "actualTokenTotal": category_data.actual_token_total
+            "total": 0,
+            "tokenCountTotal": "0.00",
+            "actualTokenTotal": "0.00"
         }
+
+    keys = list(set(data.keys))
+    token_removed = 0.0
+    actual_removed = 0.0
+    rows_removed = 0
+    for start in range(0, len(keys), SQL_IN_CHUNK_SIZE):
+        chunk_filter = (
+            models.DatasetRow.detail_id == category_data.id,
+            models.DatasetRow.row_key.in_(keys[start:start + SQL_IN_CHUNK_SIZE])
+        )
+        token_total, actual_total = sum_dataset_row_tokens(
+            plan_db.query(models.DatasetRow.token_count, models.DatasetRow.actual_token).filter(*chunk_filter)
+        )
+        token_removed += token_total
+        actual_removed += actual_total
+        rows_removed += plan_db.query(models.DatasetRow).filter(*chunk_filter).delete(synchronize_session=False)
+
+    # Subtract only the removed rows from the totals
+    shift_category_totals(plan_db, category_data, -token_removed, -actual_removed, -rows_removed)
+    remaining = category_data.row_count
+
+    plan_db.commit()
+    return {
+        "success": True,
+        "total": remaining,
+        "tokenCountTotal": format_token_total(category_data.token_count_sum),
+        "actualTokenTotal": format_token_total(category_data.actual_token_sum)
+    }
+
+
+@app.post("/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}/rows")
+def bulk_upsert_rows(
+    plan_name: str,
+    stage_name: str,
+    category_name: str,
+    subcategory_name: str,
+    data: RowBulkData,
+    admin: AuthenticatedUser = Depends(require_admin),
+    main_db: Session = Depends(get_main_db),
+    plan_db: Session = Depends(get_plan_db)
+):
+    """Upsert many rows by key in one transaction (replace=True overwrites all rows)"""
+    category_data = get_or_create_category_detail(plan_db, stage_name, category_name, subcategory_name)
+    inserted, updated, errors = upsert_dataset_rows(plan_db, category_data, data.rows, replace=data.replace)
+    total = category_data.row_count
+
+    plan_db.commit()
+    return {
+        "success": True,
+        "inserted": inserted,
+        "updated": updated,
+        "rejected": len(errors),
+        "errors": errors,
+        "total": total,
+        "tokenCountTotal": format_token_total(category_data.token_count_sum),
+        "actualTokenTotal": format_token_total(category_data.actual_token_sum)
+    }
+
+
+@app.post("/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}/import")
+def import_rows(
+    plan_name: str,
+    stage_name: str,
+    category_name: str,
+    subcategory_name: str,
+    file: UploadFile = File(...),
+    replace: bool = True,
+    admin: AuthenticatedUser = Depends(require_admin),
+    main_db: Session = Depends(get_main_db),
+    plan_db: Session = Depends(get_plan_db)
+):
+    """Stream an uploaded .xlsx/.csv sheet into a subcategory in bounded batches"""
+    started = time.perf_counter()
+    category_data = get_or_create_category_detail(plan_db, stage_name, category_name, subcategory_name)
+
+    inserted = updated = rejected = 0
+    errors = []
+
+    def flush_batch(batch, lines, first):
+        nonlocal inserted, updated, rejected
+        batch_inserted, batch_updated, batch_errors = upsert_dataset_rows(
+            plan_db, category_data, batch, replace=replace and first
+        )
+        inserted += batch_inserted
+        updated += batch_updated
+        rejected += len(batch_errors)
+        for error in batch_errors:
+            if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+                errors.append({"line": lines[error["index"]], "error": error["error"]})
+
+    batch, lines, first = [], [], True
+    try:
+        for line, row in spreadsheet.iter_dataset_rows(file.file, file.filename):
+            batch.append(row)
+            lines.append(line)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush_batch(batch, lines, first)
+                batch, lines, first = [], [], False
+    except spreadsheet.SpreadsheetError as e:
+        plan_db.rollback()
+        metrics.import_requests.inc(result="error")
+        raise HTTPException(status_code=400, detail=str(e))
+    if batch:
+        flush_batch(batch, lines, first)
+    elif first:
+        metrics.import_requests.inc(result="error")
+        raise HTTPException(status_code=400, detail="File contains no data rows")
+
+    total = category_data.row_count
+
+    plan_db.commit()
+    metrics.import_requests.inc(result="ok")
+    for outcome, count in (("inserted", inserted), ("updated", updated), ("rejected", rejected)):
+        metrics.import_rows.inc(count, outcome=outcome)
+    metrics.import_seconds.observe(time.perf_counter() - started)
+    return {
+        "success": True,
+        "inserted": inserted,
+        "updated": updated,
+        "rejected": rejected,
+        "errors": errors,
+        "total": total,
+        "tokenCountTotal": format_token_total(category_data.token_count_sum),
+        "actualTokenTotal": format_token_total(category_data.actual_token_sum)
+    }
+
+
+@app.get("/api/admin/plan-engines")
+def get_plan_engine_stats(admin: AuthenticatedUser = Depends(require_admin)):
+    """Cache statistics of the per-plan engine pool"""
+    return plan_engines.stats()
+
+
+@app.get("/api/admin/response-cache")
+def get_response_cache_stats(admin: AuthenticatedUser = Depends(require_admin)):
+    """Hit/miss statistics of the read payload cache"""
+    return response_cache.stats()
+
+
+@app.get("/api/admin/auth")
+def get_auth_stats(admin: AuthenticatedUser = Depends(require_admin)):
+    """Token cache statistics and rejected requests by reason"""
+    return auth_stats()
+
+
+@app.get("/api/admin/profiles")
+def list_profiles(admin: AuthenticatedUser = Depends(require_admin)):
+    """Stored request profiles, newest first"""
+    return profile_store.list()
+
+
+@app.get("/api/admin/profiles/{profile_id}")
+def download_profile(profile_id: str, admin: AuthenticatedUser = Depends(require_admin)):
+    """A request profile as speedscope JSON"""
+    path = profile_store.path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json", filename=f"{profile_id}.speedscope.json")
+
+
+# ==================== Metrics ====================
+
+@metrics.register_collector
+def collect_plan_engine_metrics() -> list:
+    stats = plan_engines.stats()
+    lines = []
+    for key, documentation in (("engines", "Open plan database engines"),
+                               ("capacity", "Plan engines kept open at most"),
+                               ("connections_in_use", "Checked-out plan database connections"),
+                               ("open_connections", "Open plan database connections")):
+        lines += metrics.sample_lines(f"plan_engine_{key}", documentation, "gauge", [((), stats[key])])
+    for key in ("hits", "misses", "evictions"):
+        lines += metrics.sample_lines(f"plan_engine_{key}_total", f"Plan engine cache {key}", "counter", [((), stats[key])])
+    return lines
+
+
+@metrics.register_collector
+def collect_cache_metrics() -> list:
+    caches = (("response", response_cache.stats()), ("token", token_cache.stats()))
+    lines = metrics.sample_lines(
+        "cache_entries", "Entries held by the cache", "gauge", [((("cache", name),), stats["entries"]) for name, stats in caches]
+    )
+    for key in ("hits", "misses", "evictions", "expirations", "invalidations"):
+        lines += metrics.sample_lines(
+            f"cache_{key}_total", f"Cache {key}", "counter", [((("cache", name),), stats[key]) for name, stats in caches]
+        )
+    return lines
+
+
+@metrics.register_collector
+def collect_subcategory_row_metrics() -> list:
+    """Distribution of row counts over the subcategories of all plans.
+
+    Built from the per-plan histograms kept in main.db with the plan summary,
+    so a scrape never opens a plan database.
+    """
+    main_db = MainSessionLocal()
+    try:
+        histograms = [histogram for (histogram,) in main_db.query(models.Plan.subcategory_row_histogram) if histogram]
     finally:
-        plan_db.close()
+        main_db.close()
 
+    counts = [0] * (len(SUBCATEGORY_ROW_BUCKETS) + 1)
+    rows = 0
+    for histogram in map(json.loads, histograms):
+        # Summaries taken with other bounds are left out until the plan is written again
+        if histogram["bounds"] != list(SUBCATEGORY_ROW_BUCKETS):
+            continue
+        counts = [total + count for total, count in zip(counts, histogram["buckets"])]
+        rows += histogram["sum"]
 
-# ==================== Visualization Endpoints ====================
+    lines = metrics.header_lines("subcategory_rows", "Dataset rows per subcategory over all plans", "histogram")
+    return lines + metrics.histogram_sample_lines("subcategory_rows", (), SUBCATEGORY_ROW_BUCKETS, counts, rows, sum(counts))
 
-@app.get("/api/plans/{plan_name}/visualization")
-def get_visualization_data(plan_name: str, main_db: Session = Depends(get_main_db)):
-    # Verify plan exists in main database
-    plan = main_db.query(models.Plan).filter(models.Plan.name == plan_name.upper()).first()
-    if not plan:
-        raise HTTPException(status_code=404, detail="Plan not found")
 
-    # Get data from plan-specific database
-    plan_db = get_plan_session(plan_name.upper())
-    try:
-        # Get all stages for this plan, sorted by stage_order
-        stages = plan_db.query(models.Stage).order_by(models.Stage.stage_order, models.Stage.id).all()
-
-        # Initialize statistics
-        total_token_count = 0
-        total_actual_token = 0
-        stage_stats = []
-        category_stats = []
-        subcategory_stats = []
-        category_distribution = {}
-        token_trends = []
-        cumulative_token = 0
-        cumulative_actual = 0
-
-        for stage in stages:
-            stage_token_count = 0
-            stage_actual_token = 0
-            stage_dataset_count = 0
-
-            # Get all category details for this stage
-            category_details = plan_db.query(models.CategoryDetail).filter(
-                models.CategoryDetail.stage_id == stage.id
-            ).all()
-
-            # Process each category detail
-            for cat_detail in category_details:
-                token_count = float(cat_detail.token_count_total or 0)
-                actual_token = float(cat_detail.actual_token_total or 0)
-                dataset_count = len(cat_detail.rows) if cat_detail.rows else 0
-
-                stage_token_count += token_count
-                stage_actual_token += actual_token
-                stage_dataset_count += dataset_count
-
-                # Aggregate by category name
-                category_key = f"{stage.name}_{cat_detail.category_name}"
-                if category_key not in category_distribution:
-                    category_distribution[category_key] = {
-                        'category': cat_detail.category_name,
-                        'stage': stage.name,
-                        'tokenCount': 0,
-                        'actualToken': 0,
-                        'datasetCount': 0,
-                        'subcategoryCount': 0
-                    }
-
-                category_distribution[category_key]['tokenCount'] += token_count
-                category_distribution[category_key]['actualToken'] += actual_token
-                category_distribution[category_key]['datasetCount'] += dataset_count
-                category_distribution[category_key]['subcategoryCount'] += 1
-
-                # Add to subcategory stats
-                subcategory_stats.append({
-                    'name': f"{cat_detail.category_name}/{cat_detail.subcategory_name} ({stage.name.upper()})",
-                    'stage': stage.name,
-                    'category': cat_detail.category_name,
-                    'subcategory': cat_detail.subcategory_name,
-                    'tokenCount': token_count,
-                    'actualToken': actual_token,
-                    'datasetCount': dataset_count
-                })
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus text exposition of request latencies, SQLite, engine, cache and import/export metrics"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-            # Add stage statistics
-            stage_stats.append({
-                'stage': stage.name.upper(),
-                'tokenCount': round(stage_token_count, 2),
-                'actualToken': round(stage_actual_token, 2),
-                'datasetCount': stage_dataset_count
-            })
 
-            total_token_count += stage_token_count
-            total_actual_token += stage_actual_token
+@app.post("/api/plans/{plan_name}/totals/reconcile")
+def reconcile_totals(plan_name: str, admin: AuthenticatedUser = Depends(require_admin), plan_db: Session = Depends(get_plan_db)):
+    """Verify the incrementally maintained token totals against the rows and repair drift"""
+    mismatches = reconcile_category_totals(plan_db)
+    plan_db.commit()
+    return {"success": True, "fixed": len(mismatches), "mismatches": mismatches}
 
-            # Calculate cumulative trends
-            cumulative_token += stage_token_count
-            cumulative_actual += stage_actual_token
-            token_trends.append({
-                'stage': stage.name.upper(),
-                'cumulativeTokenCount': round(cumulative_token, 2),
-                'cumulativeActualToken': round(cumulative_actual, 2)
-            })
 
-        # Process category distribution for pie chart
-        category_pie_data = []
-        for cat_key, cat_data in category_distribution.items():
-            category_pie_data.append({
-                'name': f"{cat_data['category']} ({cat_data['stage'].upper()})",
-                'value': cat_data['tokenCount']
-            })
+# ==================== Export Endpoints ====================
 
-            # Calculate usage rate
-            usage_rate = (cat_data['actualToken'] / cat_data['tokenCount'] * 100) if cat_data['tokenCount'] > 0 else 0
-
-            category_stats.append({
-                'category': cat_data['category'],
-                'stage': cat_data['stage'].upper(),
-                'subcategoryCount': cat_data['subcategoryCount'],
-                'datasetCount': cat_data['datasetCount'],
-                'tokenCount': cat_data['tokenCount'],
-                'actualToken': cat_data['actualToken'],
-                'usageRate': round(usage_rate, 2)
-            })
+def iter_dataset_row_values(plan_db: Session, detail_id: int, prefix: tuple = ()):
+    """Yield the cell values of a subcategory's rows, fetched in batches"""
+    columns = [getattr(models.DatasetRow, field) for field in models.DATASET_ROW_FIELDS]
+    query = plan_db.query(*columns).filter(
+        models.DatasetRow.detail_id == detail_id
+    ).order_by(models.DatasetRow.row_order, models.DatasetRow.id).yield_per(EXPORT_BATCH_SIZE)
+    count = 0
+    try:
+        for values in query:
+            count += 1
+            yield [*prefix, *(value or '' for value in values)]
+    finally:
+        metrics.export_rows.inc(count)
 
-        # Sort subcategory stats by token count
-        subcategory_stats.sort(key=lambda x: x['tokenCount'], reverse=True)
 
-        return {
-            'overview': {
-                'totalStages': len(stages),
-                'totalCategories': len(category_distribution),
-                'totalTokenCount': round(total_token_count, 2),
-                'totalActualToken': round(total_actual_token, 2)
-            },
-            'stageStats': stage_stats,
-            'categoryStats': category_stats,
-            'subcategoryStats': subcategory_stats,
-            'categoryDistribution': category_pie_data,
-            'tokenTrends': token_trends
-        }
+def iter_overview_row_values(plan_db: Session, stage_id: int):
+    """Yield the cell values of a stage's overview table rows"""
+    columns = [getattr(models.TableRow, field) for field in spreadsheet.OVERVIEW_FIELDS]
+    query = plan_db.query(*columns).filter(
+        models.TableRow.stage_id == stage_id
+    ).order_by(models.TableRow.row_order, models.TableRow.id).yield_per(EXPORT_BATCH_SIZE)
+    count = 0
+    try:
+        for values in query:
+            count += 1
+            yield [value or '' for value in values]
     finally:
-        plan_db.close()
+        metrics.export_rows.inc(count)
+
+
+def load_export_stages(plan_db: Session, stages: list) -> list:
+    """Collect (stage name, stage id, [(detail id, category, subcategory)]) for export"""
+    details_by_stage = {}
+    stage_ids = [stage.id for stage in stages]
+    if stage_ids:
+        details = plan_db.query(
+            models.CategoryDetail.stage_id, models.CategoryDetail.id,
+            models.CategoryDetail.category_name, models.CategoryDetail.subcategory_name
+        ).filter(models.CategoryDetail.stage_id.in_(stage_ids)).order_by(models.CategoryDetail.id).all()
+        for stage_id, detail_id, category_name, subcategory_name in details:
+            details_by_stage.setdefault(stage_id, []).append((detail_id, category_name, subcategory_name))
+    return [(stage.name, stage.id, details_by_stage.get(stage.id, [])) for stage in stages]
+
+
+def build_stage_export(plan_db: Session, export_stages: list, export_format: str, stage_prefix: bool):
+    """Export stages as one overview sheet plus one sheet per subcategory (or one CSV);
+    see spreadsheet.xlsx_stream for when the xlsx bytes start flowing"""
+    if export_format == "csv":
+        header = ['阶段', '类别', '子类别'] + spreadsheet.DATASET_COLUMN_TITLES
+
+        def csv_rows():
+            for stage_name, _, details in export_stages:
+                for detail_id, category_name, subcategory_name in details:
+                    yield from iter_dataset_row_values(
+                        plan_db, detail_id, prefix=(stage_name, category_name, subcategory_name)
+                    )
+        return spreadsheet.csv_stream(header, csv_rows())
+
+    def sheets():
+        for stage_name, stage_id, details in export_stages:
+            title_prefix = f"{stage_name}-" if stage_prefix else ""
+            yield (f"{title_prefix}概览", spreadsheet.OVERVIEW_COLUMN_TITLES, iter_overview_row_values(plan_db, stage_id))
+            for detail_id, category_name, subcategory_name in details:
+                yield (
+                    f"{title_prefix}{category_name}-{subcategory_name}",
+                    spreadsheet.DATASET_COLUMN_TITLES,
+                    iter_dataset_row_values(plan_db, detail_id)
+                )
+    return spreadsheet.xlsx_stream(sheets())
+
+
+def export_response(plan_name: str, filename: str, export_format: str, build):
+    """Stream build(plan_db) as a download; the plan session lives as long as the response"""
+    def generate():
+        started = time.perf_counter()
+        sent_bytes = 0
+        result = "error"
+        plan_db = get_plan_session(plan_name.upper())
+        try:
+            for chunk in build(plan_db):
+                sent_bytes += len(chunk)
+                yield chunk
+            result = "ok"
+        except GeneratorExit:
+            # 客户端中途断开
+            result = "aborted"
+            raise
+        finally:
+            plan_db.close()
+            metrics.export_requests.inc(format=export_format, result=result)
+            metrics.export_bytes.inc(sent_bytes, format=export_format)
+            if result == "ok":
+                metrics.export_seconds.observe(time.perf_counter() - started, format=export_format)
+
+    return StreamingResponse(
+        generate(),
+        media_type=spreadsheet.EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"}
+    )
+
+
+def check_export_format(export_format: str):
+    if export_format not in spreadsheet.EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {export_format}")
+
+
+@app.get("/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}/export")
+def export_category_detail(
+    plan_name: str,
+    stage_name: str,
+    category_name: str,
+    subcategory_name: str,
+    export_format: str = Query("xlsx", alias="format"),
+    plan_db: Session = Depends(get_existing_plan_db)
+):
+    check_export_format(export_format)
+    detail_id = plan_db.query(models.CategoryDetail.id).join(
+        models.Stage, models.Stage.id == models.CategoryDetail.stage_id
+    ).filter(
+        models.Stage.name == stage_name,
+        models.CategoryDetail.category_name == category_name,
+        models.CategoryDetail.subcategory_name == subcategory_name
+    ).scalar()
+    if detail_id is None:
+        raise HTTPException(status_code=404, detail="Category not found")
+
+    def build(plan_db):
+        rows = iter_dataset_row_values(plan_db, detail_id)
+        if export_format == "csv":
+            return spreadsheet.csv_stream(spreadsheet.DATASET_COLUMN_TITLES, rows)
+        return spreadsheet.xlsx_stream([(subcategory_name, spreadsheet.DATASET_COLUMN_TITLES, rows)])
+
+    filename = f"{plan_name}_{stage_name}_{category_name}_{subcategory_name}_数据表.{export_format}"
+    return export_response(plan_name, filename, export_format, build)
+
+
+@app.get("/api/plans/{plan_name}/stages/{stage_name}/export")
+def export_stage(plan_name: str, stage_name: str, export_format: str = Query("xlsx", alias="format"), plan_db: Session = Depends(get_existing_plan_db)):
+    check_export_format(export_format)
+    stage = plan_db.query(models.Stage).filter(models.Stage.name == stage_name).first()
+    if not stage:
+        raise HTTPException(status_code=404, detail="Stage not found")
+    export_stages = load_export_stages(plan_db, [stage])
+
+    filename = f"{plan_name}_{stage_name}_数据表.{export_format}"
+    return export_response(
+        plan_name, filename, export_format,
+        lambda plan_db: build_stage_export(plan_db, export_stages, export_format, stage_prefix=False)
+    )
+
+
+@app.get("/api/plans/{plan_name}/export")
+def export_plan(plan_name: str, export_format: str = Query("xlsx", alias="format"), plan_db: Session = Depends(get_existing_plan_db)):
+    check_export_format(export_format)
+    stages = plan_db.query(models.Stage).order_by(models.Stage.stage_order, models.Stage.id).all()
+    export_stages = load_export_stages(plan_db, stages)
+
+    filename = f"{plan_name}_数据表.{export_format}"
+    return export_response(
+        plan_name, filename, export_format,
+        lambda plan_db: build_stage_export(plan_db, export_stages, export_format, stage_prefix=True)
+    )
+
+
+# ==================== Visualization Endpoints ====================
+
+def load_visualization_data(plan_db: Session) -> dict:
+    """Chart data of a plan: per-stage totals, category distribution and token trends"""
+    # Get all stages for this plan, sorted by stage_order
+    stages = plan_db.query(models.Stage).order_by(models.Stage.stage_order, models.Stage.id).all()
+    stage_names = {stage.id: stage.name for stage in stages}
+    stage_order = (models.Stage.stage_order, models.Stage.id)
+
+    # 所有统计都读预先汇总好的rollup表，不再逐个子类别累加
+    stage_rollups = {
+        rollup.stage_id: rollup
+        for rollup in plan_db.query(models.StageRollup).all()
+    }
+    category_rollups = plan_db.query(models.CategoryRollup).join(
+        models.Stage, models.Stage.id == models.CategoryRollup.stage_id
+    ).filter(models.CategoryRollup.subcategory_count > 0).order_by(*stage_order, models.CategoryRollup.id).all()
+    category_details = plan_db.query(
+        models.CategoryDetail.stage_id,
+        models.CategoryDetail.category_name,
+        models.CategoryDetail.subcategory_name,
+        models.CategoryDetail.token_count_sum,
+        models.CategoryDetail.actual_token_sum,
+        models.CategoryDetail.row_count
+    ).join(
+        models.Stage, models.Stage.id == models.CategoryDetail.stage_id
+    ).order_by(models.CategoryDetail.token_count_sum.desc(), *stage_order, models.CategoryDetail.id).all()
+
+    total_token_count = 0
+    total_actual_token = 0
+    stage_stats = []
+    token_trends = []
+    for stage in stages:
+        rollup = stage_rollups.get(stage.id)
+        stage_token_count = rollup.token_count_sum if rollup else 0.0
+        stage_actual_token = rollup.actual_token_sum if rollup else 0.0
+        stage_stats.append({
+            'stage': stage.name.upper(),
+            'tokenCount': round(stage_token_count, 2),
+            'actualToken': round(stage_actual_token, 2),
+            'datasetCount': rollup.dataset_count if rollup else 0
+        })
+
+        # Calculate cumulative trends
+        total_token_count += stage_token_count
+        total_actual_token += stage_actual_token
+        token_trends.append({
+            'stage': stage.name.upper(),
+            'cumulativeTokenCount': round(total_token_count, 2),
+            'cumulativeActualToken': round(total_actual_token, 2)
+        })
+
+    category_stats = []
+    category_pie_data = []
+    for rollup in category_rollups:
+        stage_name = stage_names[rollup.stage_id]
+        category_pie_data.append({
+            'name': f"{rollup.category_name} ({stage_name.upper()})",
+            'value': rollup.token_count_sum
+        })
+
+        # Calculate usage rate
+        usage_rate = (rollup.actual_token_sum / rollup.token_count_sum * 100) if rollup.token_count_sum > 0 else 0
+
+        category_stats.append({
+            'category': rollup.category_name,
+            'stage': stage_name.upper(),
+            'subcategoryCount': rollup.subcategory_count,
+            'datasetCount': rollup.dataset_count,
+            'tokenCount': rollup.token_count_sum,
+            'actualToken': rollup.actual_token_sum,
+            'usageRate': round(usage_rate, 2)
+        })
+
+    # Subcategory stats come back sorted by token count
+    subcategory_stats = []
+    for stage_id, category_name, subcategory_name, token_count, actual_token, dataset_count in category_details:
+        stage_name = stage_names[stage_id]
+        subcategory_stats.append({
+            'name': f"{category_name}/{subcategory_name} ({stage_name.upper()})",
+            'stage': stage_name,
+            'category': category_name,
+            'subcategory': subcategory_name,
+            'tokenCount': token_count,
+            'actualToken': actual_token,
+            'datasetCount': dataset_count
+        })
+
+    return {
+        'overview': {
+            'totalStages': len(stages),
+            'totalCategories': len(category_stats),
+            'totalTokenCount': round(total_token_count, 2),
+            'totalActualToken': round(total_actual_token, 2)
+        },
+        'stageStats': stage_stats,
+        'categoryStats': category_stats,
+        'subcategoryStats': subcategory_stats,
+        'categoryDistribution': category_pie_data,
+        'tokenTrends': token_trends
+    }
+
+
+@app.get("/api/plans/{plan_name}/visualization")
+async def get_visualization_data(
+    plan_name: str,
+    plan: models.Plan = Depends(get_existing_plan_async),
+    plan_db: AsyncSession = Depends(get_existing_async_plan_db)
+):
+    return json_response(await get_or_build_async(
+        plan_db,
+        ("visualization", plan.name, plan.id, await get_plan_version_async(plan_db)),
+        load_visualization_data,
+        cache_tags(plan.name, "overview")
+    ))
@@ -0,0 +1,148 @@
+"""Counters and histograms of the service in the Prometheus text exposition format.
+
+A small in-process registry, so no client library is needed: metrics are
+updated where things happen and rendered by GET /metrics. Values that
+already live elsewhere (engine and cache stats) are read at scrape time by
+collectors registered with register_collector.
+"""
+from bisect import bisect_left
+import threading
+
+# Seconds; covers cached reads (~1ms) up to whole-plan exports
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels) -> str:
+    """{name="value",...} of (name, value) pairs; empty for no labels"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def header_lines(name: str, documentation: str, metric_type: str) -> list:
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+
+
+def sample_lines(name: str, documentation: str, metric_type: str, samples) -> list:
+    """Exposition lines of a metric from (labels, value) samples; labels are (name, value) pairs"""
+    lines = header_lines(name, documentation, metric_type)
+    lines += [f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples]
+    return lines
+
+
+def histogram_sample_lines(name: str, labels, buckets, bucket_counts, total, count) -> list:
+    """Cumulative _bucket, _sum and _count lines; bucket_counts has one more entry than buckets (+Inf)"""
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip((*buckets, float("inf")), bucket_counts):
+        cumulative += bucket_count
+        bucket_labels = (*labels, ("le", _format_value(float(bound))))
+        lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(float(total))}")
+    lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return lines
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        samples = [(tuple(zip(self.labelnames, key)), value) for key, value in values]
+        return sample_lines(self.name, self.documentation, "counter", samples)
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self) -> list:
+        with self._lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        lines = header_lines(self.name, self.documentation, "histogram")
+        for key, (counts, total, count) in series:
+            lines += histogram_sample_lines(self.name, tuple(zip(self.labelnames, key)), self.buckets, counts, total, count)
+        return lines
+
+
+_metrics = []
+_collectors = []
+
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(collector):
+    """Add a function returning exposition lines, called on every scrape"""
+    _collectors.append(collector)
+    return collector
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines += metric.collect()
+    for collector in _collectors:
+        lines += collector()
+    return "\n".join(lines) + "\n"
+
+
+http_requests = register(Counter(
+    "http_requests_total", "HTTP requests by route template and status", ("method", "route", "status")
+))
+http_request_seconds = register(Histogram(
+    "http_request_duration_seconds", "Time to the last byte of HTTP responses by route template", ("method", "route")
+))
+sqlite_write_seconds = register(Histogram(
+    "sqlite_write_statement_duration_seconds",
+    "Duration of write statements; includes waiting for the write lock (busy_timeout)", ("database",)
+))
+sqlite_busy_errors = register(Counter(
+    "sqlite_busy_errors_total", "Statements that failed with database is locked/busy", ("database",)
+))
+import_requests = register(Counter("import_requests_total", "Sheet imports by result", ("result",)))
+import_rows = register(Counter("import_rows_total", "Imported rows by outcome", ("outcome",)))
+import_seconds = register(Histogram("import_duration_seconds", "Duration of successful sheet imports"))
+export_requests = register(Counter("export_requests_total", "Exports by format and result", ("format", "result")))
+export_rows = register(Counter("export_rows_total", "Rows written to exports"))
+export_bytes = register(Counter("export_bytes_total", "Bytes streamed by exports", ("format",)))
+export_seconds = register(Histogram("export_duration_seconds", "Duration of completed exports", ("format",)))
@@ -7,14 +7,14 @@ Migration script to move data from old data_version.db to new database structure
 
 import os
 import sys
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, insert
 from sqlalchemy.orm import sessionmaker
 
 # Add parent directory to path to import models
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 import models
-from database import init_main_database, get_plan_engine, MainBase, PlanBase
+from database import init_main_database, get_plan_engine, get_plan_session, MainBase, PlanBase, DATABASES_DIR
 
 def migrate_data():
     """Migrate data from old single database to new multi-database structure"""
@@ -217,11 +217,15 @@ def migrate_data():
                             category_name=old_detail.category_name,
                             subcategory_name=old_detail.subcategory_name,
                             description=old_detail.description or "",
-                            token_count_total=old_detail.token_count_total or "0",
-                            actual_token_total=old_detail.actual_token_total or "0"
+                            token_count_sum=float(old_detail.token_count_total or 0),
+                            actual_token_sum=float(old_detail.actual_token_total or 0)
                         )
-                        new_detail.rows = old_detail.rows
                         plan_db.add(new_detail)
+                        plan_db.flush()
+                        mappings = models.dataset_row_mappings(new_detail.id, old_detail.rows)
+                        if mappings:
+                            plan_db.execute(insert(models.DatasetRow), mappings)
+                        new_detail.row_count = len(mappings)
                     print(f"    ✓ Migrated {len(old_details)} category details for stage {old_stage_id}")
 
                 plan_db.commit()
@@ -248,5 +252,71 @@ def migrate_data():
         old_db.close()
         raise
 
+def migrate_category_rows(plan_name):
+    """Move CategoryDetail JSON row blobs of one plan into the dataset_rows table.
+
+    Rows that are already in dataset_rows keep their current values; blob
+    rows with other keys are added after them.
+    """
+    # The plan session listeners in main bump the plan version and sync the main.db summary on commit
+    import main
+    plan_db = get_plan_session(plan_name)
+
+    try:
+        details = plan_db.query(models.CategoryDetail).filter(
+            models.CategoryDetail._rows.isnot(None),
+            models.CategoryDetail._rows.notin_(["", "[]"])
+        ).all()
+
+        migrated = 0
+        for detail in details:
+            existing = dict(plan_db.query(models.DatasetRow.row_key, models.DatasetRow.row_order).filter(
+                models.DatasetRow.detail_id == detail.id
+            ).all())
+            mappings = [m for m in models.dataset_row_mappings(detail.id, detail.legacy_rows) if m['row_key'] not in existing]
+            next_order = max(existing.values(), default=-1) + 1
+            for offset, mapping in enumerate(mappings):
+                mapping['row_order'] = next_order + offset
+            if mappings:
+                plan_db.execute(insert(models.DatasetRow), mappings)
+            migrated += len(mappings)
+            # Totals come from the migrated rows, not the legacy formatted strings;
+            # a detail that already has rows keeps their totals and adds the merged ones
+            token_total = sum(models.parse_token_value(m['token_count']) for m in mappings)
+            actual_total = sum(models.parse_token_value(m['actual_token']) for m in mappings)
+            if existing:
+                detail.token_count_sum = (detail.token_count_sum or 0.0) + token_total
+                detail.actual_token_sum = (detail.actual_token_sum or 0.0) + actual_total
+                detail.row_count = len(existing) + len(mappings)
+                print(f"    ✓ Merged {len(mappings)} rows into existing rows: {detail.category_name}/{detail.subcategory_name}")
+            else:
+                detail.token_count_sum = token_total
+                detail.actual_token_sum = actual_total
+                detail.row_count = len(mappings)
+                print(f"    ✓ Migrated {len(mappings)} rows: {detail.category_name}/{detail.subcategory_name}")
+            detail.legacy_rows = []
+
+        plan_db.commit()
+        return migrated
+    finally:
+        plan_db.close()
+
+
+def migrate_all_category_rows():
+    """Move JSON row blobs into dataset_rows for every plan database"""
+    if not os.path.isdir(DATABASES_DIR):
+        return
+
+    print("\nMigrating category detail rows into dataset_rows...")
+    for filename in sorted(os.listdir(DATABASES_DIR)):
+        if not filename.endswith(".db"):
+            continue
+        plan_name = filename[:-len(".db")].upper()
+        print(f"  Plan: {plan_name}")
+        migrated = migrate_category_rows(plan_name)
+        print(f"  ✓ {migrated} rows migrated for plan: {plan_name}")
+
+
 if __name__ == "__main__":
     migrate_data()
+    migrate_all_category_rows()
@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Boolean, Float, DateTime, Index, UniqueConstraint, cast
+from sqlalchemy.orm import relationship, deferred
 from database import MainBase, PlanBase
-import json
+import fast_json
 
 # ==================== Main Database Models ====================
 # These models are stored in main.db
@@ -15,10 +15,21 @@ class User(MainBase):
 
 class Plan(MainBase):
     __tablename__ = "plans"
+    # Never reuse the id of a deleted plan: ETags and cached payloads are keyed
+    # on it, and a recreated plan's database starts again at version 0
+    __table_args__ = {"sqlite_autoincrement": True}
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
     description = Column(Text, default="")
     # Note: No stages relationship here - stages are in separate databases
+    # Summary of the plan database, refreshed on every commit that writes to it
+    # so the plan list never opens the plan files. NULL until first computed.
+    stage_count = Column(Integer)
+    token_count_sum = Column(Float)
+    actual_token_sum = Column(Float)
+    # JSON {"bounds", "buckets", "sum"} of the subcategories' row counts, for /metrics
+    subcategory_row_histogram = Column(Text)
+    updated_at = Column(DateTime)
 
 
 # ==================== Per-Plan Database Models ====================
@@ -34,25 +45,31 @@ class Stage(PlanBase):
     rows = relationship("TableRow", back_populates="stage", cascade="all, delete-orphan")
     _merges = Column("merges", Text, default="[]")
     _categories = Column("categories", Text, default="[]")
+    # Plan version (PRAGMA user_version) of the last commit that changed this
+    # stage or one of its subcategories; the ETag of the category tree read
+    version = Column(Integer, nullable=False, default=0, server_default="0")
 
     @property
     def merges(self):
-        return json.loads(self._merges) if self._merges else []
+        return fast_json.loads(self._merges) if self._merges else []
 
     @merges.setter
     def merges(self, value):
-        self._merges = json.dumps(value)
+        self._merges = fast_json.dumps(value)
 
     @property
     def categories(self):
-        return json.loads(self._categories) if self._categories else []
+        return fast_json.loads(self._categories) if self._categories else []
 
     @categories.setter
     def categories(self, value):
-        self._categories = json.dumps(value)
+        self._categories = fast_json.dumps(value)
 
 class TableRow(PlanBase):
     __tablename__ = "table_rows"
+    __table_args__ = (
+        Index("ix_table_rows_stage_order", "stage_id", "row_order"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     stage_id = Column(Integer, ForeignKey("stages.id"))
     stage = relationship("Stage", back_populates="rows")
@@ -81,14 +98,179 @@ class CategoryDetail(PlanBase):
     category_name = Column(String, index=True)
     subcategory_name = Column(String, index=True)
     description = Column(Text, default="")
-    _rows = Column("rows", Text, default="[]")
+    # Legacy JSON blob of dataset rows; rows now live in dataset_rows and this
+    # column is only read by migrate_database.py when moving old data over.
+    _rows = deferred(Column("rows", Text, default="[]"))
+    # Legacy formatted totals, superseded by the numeric *_sum columns below
     token_count_total = Column(String, default="0")
     actual_token_total = Column(String, default="0")
+    # Token totals of all rows, maintained incrementally by the row endpoints
+    token_count_sum = Column(Float, nullable=False, default=0.0, server_default="0",
+                             info={"backfill": "COALESCE(CAST(token_count_total AS REAL), 0)"})
+    actual_token_sum = Column(Float, nullable=False, default=0.0, server_default="0",
+                              info={"backfill": "COALESCE(CAST(actual_token_total AS REAL), 0)"})
+    # Number of dataset rows, kept in step with the sums above
+    row_count = Column(Integer, nullable=False, default=0, server_default="0",
+                       info={"backfill": "(SELECT COUNT(*) FROM dataset_rows WHERE dataset_rows.detail_id = category_details.id)"})
+    # Plan version of the last commit that changed this subcategory or its rows
+    version = Column(Integer, nullable=False, default=0, server_default="0")
 
     @property
-    def rows(self):
-        return json.loads(self._rows) if self._rows else []
+    def legacy_rows(self):
+        return fast_json.loads(self._rows) if self._rows else []
+
+    @legacy_rows.setter
+    def legacy_rows(self, value):
+        self._rows = fast_json.dumps(value)
+
+class DatasetRow(PlanBase):
+    __tablename__ = "dataset_rows"
+    __table_args__ = (
+        UniqueConstraint("detail_id", "row_key", name="uq_dataset_rows_detail_key"),
+        Index("ix_dataset_rows_detail_order", "detail_id", "row_order"),
+    )
+    id = Column(Integer, primary_key=True)
+    # One CategoryDetail per stage/category/subcategory, so detail_id scopes the row
+    detail_id = Column(Integer, ForeignKey("category_details.id"), nullable=False)
+    row_key = Column(Integer, nullable=False)
+    row_order = Column(Integer, default=0)
+    hdfs_path = Column(Text, default="")
+    obs_fuzzy_path = Column(Text, default="")
+    obs_full_path = Column(Text, default="")
+    token_count = Column(String, default="")
+    actual_usage = Column(String, default="")
+    actual_token = Column(String, default="")
+
+# Token columns are free-form strings; sorting uses their numeric value, so
+# index the same CAST expression the category detail endpoint orders by.
+DatasetRow.token_count_number = cast(DatasetRow.token_count, Float)
+DatasetRow.actual_token_number = cast(DatasetRow.actual_token, Float)
+Index("ix_dataset_rows_detail_token_count", DatasetRow.detail_id, DatasetRow.token_count_number)
+Index("ix_dataset_rows_detail_actual_token", DatasetRow.detail_id, DatasetRow.actual_token_number)
+
+
+# Materialized per-stage and per-category aggregates of category_details.
+# Triggers on category_details keep them current in the same transaction as
+# every write, so reads never have to scan the details or their rows.
+class StageRollup(PlanBase):
+    __tablename__ = "stage_rollups"
+    __table_args__ = (
+        {"info": {"backfill": [
+            "DELETE FROM stage_rollups",
+            "INSERT INTO stage_rollups (stage_id, token_count_sum, actual_token_sum, dataset_count, subcategory_count) "
+            "SELECT stage_id, SUM(token_count_sum), SUM(actual_token_sum), SUM(row_count), COUNT(*) "
+            "FROM category_details GROUP BY stage_id"
+        ]}},
+    )
+    id = Column(Integer, primary_key=True)
+    stage_id = Column(Integer, ForeignKey("stages.id"), nullable=False, unique=True)
+    token_count_sum = Column(Float, nullable=False, default=0.0)
+    actual_token_sum = Column(Float, nullable=False, default=0.0)
+    dataset_count = Column(Integer, nullable=False, default=0)
+    subcategory_count = Column(Integer, nullable=False, default=0)
+
+class CategoryRollup(PlanBase):
+    __tablename__ = "category_rollups"
+    __table_args__ = (
+        UniqueConstraint("stage_id", "category_name", name="uq_category_rollups_stage_category"),
+        {"info": {"backfill": [
+            "DELETE FROM category_rollups",
+            "INSERT INTO category_rollups (stage_id, category_name, token_count_sum, actual_token_sum, dataset_count, subcategory_count) "
+            "SELECT stage_id, category_name, SUM(token_count_sum), SUM(actual_token_sum), SUM(row_count), COUNT(*) "
+            "FROM category_details GROUP BY stage_id, category_name"
+        ]}},
+    )
+    id = Column(Integer, primary_key=True)
+    stage_id = Column(Integer, ForeignKey("stages.id"), nullable=False)
+    category_name = Column(String, nullable=False)
+    token_count_sum = Column(Float, nullable=False, default=0.0)
+    actual_token_sum = Column(Float, nullable=False, default=0.0)
+    dataset_count = Column(Integer, nullable=False, default=0)
+    subcategory_count = Column(Integer, nullable=False, default=0)
+
+
+def _rollup_statements(sign: str, ref: str) -> str:
+    """Statements adding (sign '+') or removing (sign '-') one detail row, NEW or OLD, from the rollups"""
+    values = (f"{sign}{ref}.token_count_sum, {sign}{ref}.actual_token_sum, "
+              f"{sign}{ref}.row_count, {sign}1")
+    increments = ("token_count_sum = token_count_sum + excluded.token_count_sum, "
+                  "actual_token_sum = actual_token_sum + excluded.actual_token_sum, "
+                  "dataset_count = dataset_count + excluded.dataset_count, "
+                  "subcategory_count = subcategory_count + excluded.subcategory_count")
+    return (
+        "INSERT INTO stage_rollups (stage_id, token_count_sum, actual_token_sum, dataset_count, subcategory_count) "
+        f"VALUES ({ref}.stage_id, {values}) ON CONFLICT (stage_id) DO UPDATE SET {increments}; "
+        "INSERT INTO category_rollups (stage_id, category_name, token_count_sum, actual_token_sum, dataset_count, subcategory_count) "
+        f"VALUES ({ref}.stage_id, {ref}.category_name, {values}) "
+        f"ON CONFLICT (stage_id, category_name) DO UPDATE SET {increments};"
+    )
+
+_ROLLUP_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS category_details_rollup_insert AFTER INSERT ON category_details "
+    f"BEGIN {_rollup_statements('+', 'NEW')} END",
+    "CREATE TRIGGER IF NOT EXISTS category_details_rollup_delete AFTER DELETE ON category_details "
+    f"BEGIN {_rollup_statements('-', 'OLD')} END",
+    "CREATE TRIGGER IF NOT EXISTS category_details_rollup_update "
+    "AFTER UPDATE OF stage_id, category_name, token_count_sum, actual_token_sum, row_count ON category_details "
+    f"BEGIN {_rollup_statements('-', 'OLD')} {_rollup_statements('+', 'NEW')} END",
+    # 删除阶段时一并清掉它的汇总
+    "CREATE TRIGGER IF NOT EXISTS stages_rollup_delete AFTER DELETE ON stages BEGIN "
+    "DELETE FROM stage_rollups WHERE stage_id = OLD.id; "
+    "DELETE FROM category_rollups WHERE stage_id = OLD.id; END",
+)
+
+CategoryRollup.__table__.info["triggers"] = _ROLLUP_TRIGGERS
+
+
+TABLE_ROW_FIELDS = ('category', 'subcategory', 'total_tokens', 'sample_ratio', 'cumulative_ratio', 'sample_tokens',
+                    'category_ratio', 'part1', 'part2', 'part3', 'part4', 'part5', 'note')
+
+def table_row_to_dict(row):
+    """Shape a stage overview TableRow for the plan page; its id is the row key"""
+    result = {'key': row.id}
+    for field in TABLE_ROW_FIELDS:
+        result[field] = getattr(row, field)
+    return result
+
+DATASET_ROW_FIELDS = ('hdfs_path', 'obs_fuzzy_path', 'obs_full_path', 'token_count', 'actual_usage', 'actual_token')
+
+def dataset_row_to_dict(row):
+    """Shape a DatasetRow the way the frontend table expects it"""
+    result = {'key': row.row_key}
+    for field in DATASET_ROW_FIELDS:
+        result[field] = getattr(row, field) or ''
+    return result
+
+def parse_token_value(value) -> float:
+    """Numeric value of a token cell; blank or non-numeric cells count as 0"""
+    try:
+        return float(value or '0')
+    except (ValueError, TypeError):
+        return 0.0
+
+def dataset_row_mappings(detail_id, rows):
+    """Build dataset_rows insert mappings from client row dicts, keeping their order.
+
+    Rows without a usable integer key, or repeating a key already seen, get a
+    fresh key so that (detail_id, row_key) stays unique.
+    """
+    keys = []
+    for row in rows:
+        try:
+            keys.append(int(row.get('key')))
+        except (TypeError, ValueError):
+            keys.append(None)
+    next_key = max([k for k in keys if k is not None], default=0) + 1
 
-    @rows.setter
-    def rows(self, value):
-        self._rows = json.dumps(value)
+    mappings = []
+    seen_keys = set()
+    for order, (row, key) in enumerate(zip(rows, keys)):
+        if key is None or key in seen_keys:
+            key = next_key
+            next_key += 1
+        seen_keys.add(key)
+        mapping = {'detail_id': detail_id, 'row_key': key, 'row_order': order}
+        for field in DATASET_ROW_FIELDS:
+            mapping[field] = str(row.get(field, '') or '')
+        mappings.append(mapping)
+    return mappings
@@ -0,0 +1,65 @@
+"""Password hashing on a dedicated, bounded executor.
+
+bcrypt costs tens to hundreds of milliseconds of CPU per call. Running it on
+its own small pool keeps a burst of logins from occupying the threadpool that
+serves data requests. This module has no database imports, so a process pool
+can import it cheaply.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from passlib.context import CryptContext
+import asyncio
+import os
+import threading
+
+# bcrypt work factor; stored hashes with another factor are rehashed on the next login
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+# "thread" or "process"; bcrypt releases the GIL, so threads already run in parallel
+PASSWORD_HASH_EXECUTOR = os.environ.get("PASSWORD_HASH_EXECUTOR", "thread")
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(password, hashed_password)
+
+
+def verify_and_update(password: str, hashed_password: str):
+    """(matches, new_hash); new_hash is set when the stored hash uses an outdated work factor"""
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if PASSWORD_HASH_EXECUTOR == "process":
+                _executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+            elif PASSWORD_HASH_EXECUTOR == "thread":
+                _executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+            else:
+                raise ValueError(f"Unknown password hash executor: {PASSWORD_HASH_EXECUTOR!r}")
+        return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+async def hash_password_async(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), hash_password, password)
+
+
+async def verify_and_update_async(password: str, hashed_password: str):
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), verify_and_update, password, hashed_password)
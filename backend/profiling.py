@@ -0,0 +1,214 @@
+"""On-demand request profiles, saved as speedscope JSON for download.
+
+A request is profiled when an admin asks for it (X-Profile: 1 header or
+?profile=1) or when it falls into the configured sample rate. Profiles are
+taken by sampling the stacks of every thread instead of with cProfile:
+cProfile only sees the thread that enabled it, while a request runs its
+async part on the event loop and its sync dependencies and endpoint on the
+threadpool. Open the files at https://www.speedscope.app.
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from urllib.parse import parse_qs
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROFILE_ID_PATTERN = re.compile(r"^\d{8}-\d{6}-[0-9a-f]{8}$")
+PROFILE_SUFFIX = ".speedscope.json"
+
+TRUTHY = ("1", "true", "yes")
+
+
+class SamplingProfiler:
+    """Samples thread stacks every interval seconds until stopped.
+
+    Threadpool threads are kept while they run code of this app. The thread
+    that started the profiler (the event loop) is kept only while it runs the
+    given frame or the task that started the profiler (AsyncSession.run_sync
+    runs in a greenlet whose frames do not lead back to the request), so
+    other requests' coroutines are left out; sync code of concurrent
+    requests on other threads can still show up.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.frames = []  # (name, file, line)
+        self._frame_index = {}
+        self.samples = {}  # thread id -> ([stack as frame indexes], [weights])
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, request_frame):
+        self._request_frame = request_frame
+        self._owner = threading.get_ident()
+        try:
+            self._loop = asyncio.get_running_loop()
+            self._task = asyncio.current_task()
+        except RuntimeError:
+            self._loop = self._task = None
+        self.started = time.perf_counter()
+        self._last = self.started
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        now = time.perf_counter()
+        weight, self._last = now - self._last, now
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self._thread.ident:
+                continue
+            stack = []
+            in_request = in_app = False
+            while frame is not None:
+                code = frame.f_code
+                in_request = in_request or frame is self._request_frame
+                in_app = in_app or code.co_filename.startswith(APP_DIR)
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if thread_id == self._owner:
+                in_task = self._task is not None and asyncio.current_task(self._loop) is self._task
+                if not (in_request or in_app and in_task):
+                    continue
+            elif not in_app:
+                continue
+            samples, weights = self.samples.setdefault(thread_id, ([], []))
+            samples.append([self._index(key) for key in reversed(stack)])
+            weights.append(weight * 1000)
+
+    def _index(self, key) -> int:
+        index = self._frame_index.get(key)
+        if index is None:
+            index = self._frame_index[key] = len(self.frames)
+            self.frames.append(key)
+        return index
+
+    def speedscope(self, name: str) -> dict:
+        """The samples in the speedscope file format, one profile per thread"""
+        frames = [{"name": name_, "file": os.path.relpath(file, APP_DIR) if file.startswith(APP_DIR) else file, "line": line}
+                  for name_, file, line in self.frames]
+        profiles = [{
+            "type": "sampled",
+            "name": "event loop" if thread_id == self._owner else f"thread {thread_id}",
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": round(self.elapsed * 1000, 3),
+            "samples": samples,
+            "weights": weights,
+        } for thread_id, (samples, weights) in self.samples.items()]
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "profiling.py",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+
+class ProfileStore:
+    """Profiles as files in a directory, keeping the newest keep of them"""
+
+    def __init__(self, directory: str, keep: int):
+        self.directory = directory
+        self.keep = keep
+
+    def new_id(self) -> str:
+        return time.strftime("%Y%m%d-%H%M%S") + "-" + secrets.token_hex(4)
+
+    def path(self, profile_id: str):
+        """File of a stored profile, None for unknown or malformed ids"""
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        path = os.path.join(self.directory, profile_id + PROFILE_SUFFIX)
+        return path if os.path.exists(path) else None
+
+    def save(self, profile_id: str, profile: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, profile_id + PROFILE_SUFFIX)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(profile, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+        for stale in self.list()[self.keep:]:
+            try:
+                os.remove(os.path.join(self.directory, stale["id"] + PROFILE_SUFFIX))
+            except FileNotFoundError:
+                pass
+
+    def list(self) -> list:
+        """Stored profiles, newest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for filename in os.listdir(self.directory):
+            profile_id = filename[:-len(PROFILE_SUFFIX)]
+            if filename.endswith(PROFILE_SUFFIX) and PROFILE_ID_PATTERN.match(profile_id):
+                size = os.path.getsize(os.path.join(self.directory, filename))
+                profiles.append({"id": profile_id, "bytes": size})
+        return sorted(profiles, key=lambda profile: profile["id"], reverse=True)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling requested or sampled HTTP requests.
+
+    authorize(token) tells whether a bearer token may ask for a profile; it
+    runs in a worker thread, only for requests that ask. The id of the
+    profile is returned in the X-Profile-Id response header.
+    """
+
+    def __init__(self, app, store: ProfileStore, authorize, sample_rate: float = 0.0, interval_ms: float = 2):
+        self.app = app
+        self.store = store
+        self.authorize = authorize
+        self.sample_rate = sample_rate
+        self.interval = interval_ms / 1000
+
+    async def should_profile(self, scope) -> bool:
+        headers = dict(scope["headers"])
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        requested = (headers.get(b"x-profile", b"").decode("latin-1").lower() in TRUTHY
+                     or query.get("profile", [""])[-1].lower() in TRUTHY)
+        if requested:
+            scheme, _, token = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+            return scheme.lower() == "bearer" and await asyncio.to_thread(self.authorize, token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not await self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = self.store.new_id()
+        profiler = SamplingProfiler(self.interval)
+        status = 500
+
+        async def send_with_profile_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile_id.encode())]}
+            await send(message)
+
+        profiler.start(sys._getframe())
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profiler.stop()
+            route = getattr(scope.get("route"), "path", scope["path"])
+            name = f"{scope['method']} {route} {status} {profiler.elapsed * 1000:.0f}ms"
+            await asyncio.to_thread(self.store.save, profile_id, profiler.speedscope(name))
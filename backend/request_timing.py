@@ -0,0 +1,167 @@
+"""Per-request timing: wall time, SQL statements, auth and bytes sent, as Server-Timing headers.
+
+The timing of the request in flight lives in a context variable. Starlette
+copies the context into the threadpool that runs sync endpoints and
+dependencies, so engine events and auth can add to it from any thread.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import os
+import sqlite3
+import time
+
+from sqlalchemy import event
+
+import metrics
+
+logger = logging.getLogger("request_timing")
+
+# Path parameters shown in the slow request log, outermost first
+LOGGED_PATH_PARAMS = ("plan_name", "stage_name", "category_name", "subcategory_name")
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+class RequestTiming:
+    __slots__ = ("started", "sql_count", "sql_seconds", "spans")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.spans = {}  # name -> seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self, content_length=None) -> str:
+        total = self.elapsed()
+        metrics = [f'db;dur={self.sql_seconds * 1000:.1f};desc="{self.sql_count} queries"']
+        metrics += [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.spans.items()]
+        # 其余时间：接口本身的Python代码和序列化
+        app_seconds = total - self.sql_seconds - sum(self.spans.values())
+        metrics += [f"app;dur={max(app_seconds, 0.0) * 1000:.1f}", f"total;dur={total * 1000:.1f}"]
+        if content_length is not None:
+            metrics.append(f'size;desc="{content_length} bytes"')
+        return ", ".join(metrics)
+
+
+current_timing: ContextVar = ContextVar("request_timing", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """Add the time spent in the block to the current request under name.
+
+    SQL run inside the block stays under db, so the metrics add up to the total.
+    """
+    timing = current_timing.get()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    sql_before = timing.sql_seconds
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started - (timing.sql_seconds - sql_before)
+        timing.spans[name] = timing.spans.get(name, 0.0) + seconds
+
+
+def database_label(engine) -> str:
+    """"main" for main.db, "plan" for the plan databases (bounded label values for metrics)"""
+    return "main" if os.path.basename(engine.url.database or "") == "main.db" else "plan"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("request_timing_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["request_timing_started"].pop()
+    timing = current_timing.get()
+    if timing is not None:
+        timing.sql_count += 1
+        timing.sql_seconds += seconds
+    if statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+        # WAL下写锁在第一条写语句时获取，等锁的时间算在这里
+        metrics.sqlite_write_seconds.observe(seconds, database=database_label(conn.engine))
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute不会为失败的语句触发
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("request_timing_started"):
+        connection.info["request_timing_started"].pop()
+    error = exception_context.original_exception
+    if isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error)):
+        metrics.sqlite_busy_errors.inc(database=database_label(exception_context.engine))
+
+
+def track_queries(engine):
+    """Count the statements of a (sync) engine toward the current request and the SQLite metrics"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+class RequestTimingMiddleware:
+    """ASGI middleware adding Server-Timing to every HTTP response and logging slow requests.
+
+    The header is written when the response starts, so for streamed exports
+    it covers the time to the first byte; the slow request log is written
+    after the last byte and includes the bytes sent.
+    """
+
+    def __init__(self, app, slow_request_ms: float = 1000):
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = current_timing.set(timing)
+        status = 500
+        sent_bytes = 0
+
+        async def send_with_timing(message):
+            nonlocal status, sent_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                # 流式导出没有Content-Length，大小只出现在慢请求日志里
+                content_length = next((value.decode("latin-1") for name, value in headers
+                                       if name.lower() == b"content-length"), None)
+                headers.append((b"server-timing", timing.server_timing(content_length).encode("latin-1")))
+                message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body":
+                sent_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_timing.reset(token)
+            elapsed = timing.elapsed()
+            # 未匹配路由的路径不做标签，避免随意的URL撑大指标
+            route = getattr(scope.get("route"), "path", "unmatched")
+            metrics.http_requests.inc(method=scope["method"], route=route, status=status)
+            metrics.http_request_seconds.observe(elapsed, method=scope["method"], route=route)
+            if elapsed * 1000 >= self.slow_request_ms:
+                self.log_slow_request(scope, timing, status, elapsed * 1000, sent_bytes)
+
+    @staticmethod
+    def log_slow_request(scope, timing: RequestTiming, status: int, elapsed_ms: float, sent_bytes: int):
+        route = scope.get("route")
+        path_params = scope.get("path_params", {})
+        where = "/".join(str(path_params[name]) for name in LOGGED_PATH_PARAMS if name in path_params)
+        spans = "".join(f" {name}={seconds * 1000:.1f}ms" for name, seconds in timing.spans.items())
+        logger.warning(
+            "slow request %s %s (%s) status=%s total=%.1fms sql=%d/%.1fms%s bytes=%d",
+            scope["method"], getattr(route, "path", scope["path"]), where or "-", status, elapsed_ms,
+            timing.sql_count, timing.sql_seconds * 1000, spans, sent_bytes
+        )
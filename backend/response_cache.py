@@ -0,0 +1,264 @@
+"""Caches of read endpoint payloads: in-process, or shared by all workers through SQLite"""
+from collections import OrderedDict
+import json
+import fast_json
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """Thread-safe LRU cache with a TTL and tag-based invalidation.
+
+    Keys carry the data version they were built from, so a stale entry is
+    never returned after a write; invalidating by tag only frees the memory
+    early. Each entry is filed under its tags, e.g. the plan and the stage or
+    subcategory it shows, so a write drops just the entries it affects.
+    """
+
+    # Calls only take an in-process lock, so async code may make them directly
+    blocking = False
+
+    def __init__(self, capacity: int, ttl: float, clock=time.monotonic):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tagged = {}  # tag -> set of keys
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Cached value of key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= self._clock():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, tags=()):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (self._clock() + self.ttl, value, tuple(tags))
+            for tag in tags:
+                self._tagged.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.capacity:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_build(self, key, build, tags=()):
+        """Cached value of key, calling build() and storing its result on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value, tags)
+        return value
+
+    def invalidate(self, *tags):
+        """Drop every entry filed under any of the tags"""
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tagged.get(tag, ())):
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tagged.clear()
+
+    def _drop(self, key):
+        """Remove an entry and its tag references (lock held)"""
+        expires_at, value, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+class SQLiteResponseCache:
+    """Response cache shared by every worker process through one SQLite file.
+
+    Same interface as ResponseCache. Payloads are stored as JSON, so a
+    payload built by one uvicorn worker is served by all of them, and an
+    invalidation by the worker that wrote reaches the others too. Keys still
+    carry the data version, so even a missed invalidation cannot serve stale
+    data. Entries beyond capacity are dropped oldest first; the hit and miss
+    counters are per process.
+    """
+
+    # Calls do file I/O and may wait out another worker's write lock (up to the
+    # 5 s timeout), so async code must make them off the event loop
+    blocking = True
+
+    def __init__(self, path: str, capacity: int, ttl: float, clock=time.time):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # 缓存丢了可以重建，不需要fsync
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_entries_expires ON cache_entries (expires_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_tags ("
+            "tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_tags_key ON cache_tags (key)")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _encode(key) -> str:
+        return json.dumps(key, ensure_ascii=False, separators=(",", ":"))
+
+    def get(self, key):
+        """Cached value of key, or None on a miss"""
+        encoded = self._encode(key)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE key = ?", (encoded,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[1] <= self._clock():
+                self._delete_keys([encoded])
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+        return fast_json.loads(row[0])
+
+    def put(self, key, value, tags=()):
+        if self.capacity <= 0:
+            return
+        encoded = self._encode(key)
+        payload = fast_json.dumps(value)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM cache_tags WHERE key = ?", (encoded,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+                    (encoded, payload, self._clock() + self.ttl)
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)",
+                    [(self._encode(tag), encoded) for tag in tags]
+                )
+                overflow = self._conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0] - self.capacity
+                if overflow > 0:
+                    oldest = [row[0] for row in self._conn.execute(
+                        "SELECT key FROM cache_entries ORDER BY expires_at LIMIT ?", (overflow,)
+                    )]
+                    self._delete_keys(oldest)
+                    self.evictions += len(oldest)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get_or_build(self, key, build, tags=()):
+        """Cached value of key, calling build() and storing its result on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value, tags)
+        return value
+
+    def invalidate(self, *tags):
+        """Drop every entry filed under any of the tags, in all workers"""
+        if not tags:
+            return
+        encoded = [self._encode(tag) for tag in tags]
+        placeholders = ",".join("?" * len(encoded))
+        with self._lock:
+            keys = [row[0] for row in self._conn.execute(
+                f"SELECT DISTINCT key FROM cache_tags WHERE tag IN ({placeholders})", encoded
+            )]
+            if keys:
+                self._delete_keys(keys)
+                self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache_entries")
+            self._conn.execute("DELETE FROM cache_tags")
+
+    def _delete_keys(self, keys: list):
+        """Remove entries and their tags (lock held)"""
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            self._conn.execute(f"DELETE FROM cache_entries WHERE key IN ({placeholders})", chunk)
+            self._conn.execute(f"DELETE FROM cache_tags WHERE key IN ({placeholders})", chunk)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "backend": "sqlite",
+                "path": self.path,
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+def create_response_cache(backend: str, capacity: int, ttl: float, path: str = "./response_cache.db"):
+    """Response cache for the configured backend: "memory" (per worker) or "sqlite" (shared)"""
+    if backend == "memory":
+        return ResponseCache(capacity, ttl)
+    if backend == "sqlite":
+        return SQLiteResponseCache(path, capacity, ttl)
+    raise ValueError(f"Unknown response cache backend: {backend!r}")
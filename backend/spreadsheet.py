@@ -0,0 +1,160 @@
+"""Streaming Excel/CSV reading and writing for dataset row import/export"""
+import csv
+import io
+import os
+import re
+import tempfile
+import zipfile
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+
+import models
+
+# Column order of the dataset table template (see CategoryDetail.jsx downloadTemplate)
+DATASET_COLUMN_TITLES = ['v3词表hdfs路径', 'obs模糊路径', 'obs补全路径', '数据集总token', '实际使用', '实际使用token']
+
+# Column order of the stage overview table (see PlanDetail.jsx columns)
+OVERVIEW_COLUMN_TITLES = ['类别', '子类别', '总token数', '本次采样比例', '累计比例', '本次采样token数', '本次采样后类别占比',
+                          '交付part1', '交付part2', '交付part3', '交付part4', '交付part5', '备注']
+OVERVIEW_FIELDS = ('category', 'subcategory', 'total_tokens', 'sample_ratio', 'cumulative_ratio', 'sample_tokens',
+                   'category_ratio', 'part1', 'part2', 'part3', 'part4', 'part5', 'note')
+
+SUPPORTED_EXTENSIONS = ('.xlsx', '.xlsm', '.csv')
+
+EXPORT_MEDIA_TYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Excel limits sheet titles to 31 characters and forbids these
+_INVALID_SHEET_TITLE_CHARS = re.compile(r'[\\/*?:\[\]]')
+
+
+class SpreadsheetError(ValueError):
+    """Raised when an uploaded file cannot be read as a dataset sheet"""
+
+
+def format_cell_value(value, number_format=None):
+    """Render a cell value as the text shown in the spreadsheet"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        if number_format and '%' in number_format:
+            return f"{value * 100:.10g}%"
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+    return str(value).strip()
+
+
+def _iter_xlsx_lines(file):
+    # read_only streams the sheet XML instead of building the whole workbook
+    try:
+        workbook = load_workbook(file, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError) as e:
+        raise SpreadsheetError(f"Invalid Excel file: {e}")
+    try:
+        sheet = workbook.worksheets[0]
+        for line, cells in enumerate(sheet.iter_rows(), start=1):
+            yield line, [format_cell_value(cell.value, getattr(cell, 'number_format', None)) for cell in cells]
+    finally:
+        workbook.close()
+
+
+def _iter_csv_lines(file):
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    try:
+        for line, values in enumerate(csv.reader(text), start=1):
+            yield line, [value.strip() for value in values]
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise SpreadsheetError(f"Invalid CSV file: {e}")
+    finally:
+        text.detach()
+
+
+def iter_dataset_rows(file, filename: str):
+    """Yield (line number, row dict) for each non-empty data row of an uploaded sheet.
+
+    The first line is the header and is skipped; columns are read by position
+    in the template order. Raises SpreadsheetError for unsupported or broken files.
+    """
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension not in SUPPORTED_EXTENSIONS:
+        raise SpreadsheetError(f"Unsupported file type: {extension or filename}")
+
+    lines = _iter_csv_lines(file) if extension == '.csv' else _iter_xlsx_lines(file)
+    for line, values in lines:
+        if line == 1 or not any(values):
+            continue
+        values = list(values[:len(models.DATASET_ROW_FIELDS)])
+        values += [''] * (len(models.DATASET_ROW_FIELDS) - len(values))
+        yield line, dict(zip(models.DATASET_ROW_FIELDS, values))
+
+
+def unique_sheet_title(title: str, used: set) -> str:
+    """Make a valid, unused Excel sheet title from an arbitrary name"""
+    base = _INVALID_SHEET_TITLE_CHARS.sub('_', title or 'Sheet')[:31] or 'Sheet'
+    candidate = base
+    suffix = 2
+    while candidate.lower() in used:
+        tail = f"~{suffix}"
+        candidate = base[:31 - len(tail)] + tail
+        suffix += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def xlsx_stream(sheets):
+    """Write (title, header, rows) sheets into a write-only workbook and yield the file.
+
+    Rows are consumed lazily and spooled to disk by openpyxl, so memory stays
+    bounded by one row regardless of sheet size. Each sheet is closed once its
+    rows are written, so only one spool file is open at a time however many
+    sheets there are.
+
+    The download itself is not streamed while the rows are read: an xlsx is a
+    zip archive that openpyxl can only write whole, so the workbook is saved to
+    a temporary file first and the first chunk is yielded after every row has
+    been written. Memory stays flat, but the time to first byte grows with the
+    export, and the temporary file needs as much disk as the finished workbook.
+    CSV exports (csv_stream) are yielded as the rows are read.
+    """
+    workbook = Workbook(write_only=True)
+    used_titles = set()
+    for title, header, rows in sheets:
+        worksheet = workbook.create_sheet(unique_sheet_title(title, used_titles))
+        worksheet.append(header)
+        for row in rows:
+            worksheet.append(row)
+        worksheet.close()
+    if not used_titles:
+        workbook.create_sheet('Data')
+
+    with tempfile.TemporaryFile() as tmp:
+        workbook.save(tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def csv_stream(header, rows):
+    """Yield a UTF-8 CSV (with BOM so Excel detects the encoding) in chunks"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
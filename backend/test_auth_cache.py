@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+认证缓存测试 - 已验证的token直接命中缓存，用户变更后立即失效，失败按原因计数
+
+运行: cd backend && pytest test_auth_cache.py
+"""
+import pytest
+from jose import jwt
+
+import models
+import auth
+import database
+from database import MainSessionLocal
+
+
+def test_token_cache_hits_and_user_change(client, user_headers):
+    headers = user_headers("ac_user", True)
+    assert client.get("/api/auth/me", headers=headers).json() == {"username": "ac_user", "is_admin": True}
+    hits = auth.token_cache.stats()["hits"]
+    assert client.get("/api/auth/me", headers=headers).status_code == 200
+    assert auth.token_cache.stats()["hits"] == hits + 1
+
+    # 撤销管理员后，缓存的用户不能再通过管理员校验
+    db = MainSessionLocal()
+    try:
+        db.query(models.User).filter(models.User.username == "ac_user").first().is_admin = False
+        db.commit()
+    finally:
+        db.close()
+    assert client.get("/api/admin/auth", headers=headers).status_code == 403
+
+
+def test_cache_hit_opens_no_main_session(client, user_headers, monkeypatch):
+    headers = user_headers("ac_lazy")
+    assert client.get("/api/auth/me", headers=headers).status_code == 200
+
+    def no_session():
+        raise AssertionError("cache hit opened a main.db session")
+
+    monkeypatch.setattr(auth, "MainSessionLocal", no_session)
+    monkeypatch.setattr(database, "MainSessionLocal", no_session)
+    assert client.get("/api/auth/me", headers=headers).json() == {"username": "ac_lazy", "is_admin": False}
+
+
+def test_failures_are_counted_by_reason(client):
+    before = dict(auth.auth_failures)
+    assert client.get("/api/auth/me", headers={"Authorization": "Bearer not-a-jwt"}).status_code == 401
+    expired = jwt.encode({"sub": "ac_user", "exp": 1}, auth.SECRET_KEY, algorithm=auth.ALGORITHM)
+    assert client.get("/api/auth/me", headers={"Authorization": "Bearer " + expired}).status_code == 401
+    ghost = auth.create_access_token({"sub": "ac_ghost"})
+    assert client.get("/api/auth/me", headers={"Authorization": "Bearer " + ghost}).status_code == 401
+    assert auth.auth_failures["invalid_token"] == before["invalid_token"] + 1
+    assert auth.auth_failures["expired_token"] == before["expired_token"] + 1
+    assert auth.auth_failures["unknown_user"] == before["unknown_user"] + 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+批量行写入测试 - POST .../rows按key在一个事务里插入或更新，坏行逐行报告而不影响其它行
+
+运行: cd backend && pytest test_bulk_rows.py
+"""
+import pytest
+
+import main
+import models
+from database import get_plan_session
+
+DETAIL = "/api/plans/bulkplan/stages/s/categories/c/x"
+
+
+def stored_rows(plan_name, subcategory_name="x"):
+    """(row_key, token_count) of a subcategory's rows in display order"""
+    plan_db = get_plan_session(plan_name)
+    try:
+        return [(key, token) for key, token in plan_db.query(
+            models.DatasetRow.row_key, models.DatasetRow.token_count
+        ).join(models.CategoryDetail, models.CategoryDetail.id == models.DatasetRow.detail_id).filter(
+            models.CategoryDetail.subcategory_name == subcategory_name
+        ).order_by(models.DatasetRow.row_order)]
+    finally:
+        plan_db.close()
+
+
+def test_bad_rows_are_rejected_one_by_one(client, admin_headers):
+    client.post("/api/plans", json={"name": "bulkplan"}, headers=admin_headers)
+    rows = [{"key": i + 1, "hdfs_path": f"/data/{i + 1}", "token_count": "1", "actual_token": "0.5"} for i in range(105)]
+    rows[50]["key"] = "abc"
+    rows[80]["token_count"] = "lots"
+
+    response = client.post(DETAIL + "/rows", json={"rows": rows}, headers=admin_headers)
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert (result["inserted"], result["updated"], result["rejected"], result["total"]) == (103, 0, 2, 103)
+    assert [(e["index"], e["key"]) for e in result["errors"]] == [(50, "abc"), (80, 81)]
+    assert "lots" in result["errors"][1]["error"]
+    assert (result["tokenCountTotal"], result["actualTokenTotal"]) == ("103.00", "51.50")
+    assert [key for key, _ in stored_rows("BULKPLAN")] == [k for k in range(1, 106) if k not in (51, 81)]
+
+
+def test_upsert_across_lookup_chunks(client, admin_headers):
+    client.post("/api/plans", json={"name": "bulkchunk"}, headers=admin_headers)
+    detail = "/api/plans/bulkchunk/stages/s/categories/c/x"
+    client.post(detail + "/rows", json={"rows": [{"key": k, "token_count": "1"} for k in (700, 3, 2)]}, headers=admin_headers)
+
+    # 已有key的查找按SQL_IN_CHUNK_SIZE分批，超过一批的key也都能找到
+    count = main.SQL_IN_CHUNK_SIZE + 100
+    rows = [{"key": k, "token_count": "2"} for k in range(1, count + 1)] + [{"key": 700, "token_count": "5"}]
+    rows += [{"token_count": "3"}, {"key": "", "token_count": "3"}]
+    result = client.post(detail + "/rows", json={"rows": rows}, headers=admin_headers).json()
+    assert (result["inserted"], result["updated"], result["rejected"]) == (count, 3, 0)
+    assert result["total"] == count + 3
+    assert result["tokenCountTotal"] == f"{count * 2 + 5 + 6:.2f}"
+
+    stored = stored_rows("BULKCHUNK")
+    # 已有行保持原位置，新行按请求顺序追加，无key的行拿到最大key之后的新key
+    assert [key for key, _ in stored[:3]] == [700, 3, 2]
+    assert stored[3] == (1, "2")
+    assert stored[-2:] == [(701, "3"), (702, "3")]
+    assert dict(stored)[700] == "5"
+
+
+def test_replace_overwrites_all_rows(client, admin_headers):
+    client.post("/api/plans", json={"name": "bulkreplace"}, headers=admin_headers)
+    detail = "/api/plans/bulkreplace/stages/s/categories/c/x"
+    client.post(detail + "/rows", json={"rows": [{"key": k, "token_count": "10"} for k in range(1, 6)]}, headers=admin_headers)
+
+    result = client.post(detail + "/rows", json={"rows": [{"key": 9, "token_count": "4"}, {"key": 2, "token_count": "1"}],
+                                                 "replace": True}, headers=admin_headers).json()
+    assert (result["inserted"], result["updated"], result["total"], result["tokenCountTotal"]) == (2, 0, 2, "5.00")
+    assert stored_rows("BULKREPLACE") == [(9, "4"), (2, "1")]
+
+    # 全是坏行时replace也照样清空
+    result = client.post(detail + "/rows", json={"rows": [{"key": 1.5}], "replace": True}, headers=admin_headers).json()
+    assert (result["rejected"], result["total"], result["tokenCountTotal"]) == (1, 0, "0.00")
+
+
+def test_validation(client, admin_headers, user_headers):
+    client.post("/api/plans", json={"name": "bulkplan"}, headers=admin_headers)
+    for row, message in [
+        ("not a row", "row must be an object"),
+        ({"key": True}, "invalid key"),
+        ({"key": 2.5}, "invalid key"),
+        ({"hdfs_path": ["a"]}, "hdfs_path must be a string"),
+        ({"actual_token": "1e"}, "actual_token is not a number"),
+    ]:
+        with pytest.raises(ValueError, match=message):
+            main.validate_dataset_row(row)
+    # 数字和空白在入库前规范成字符串
+    assert main.validate_dataset_row({"key": "7", "token_count": 12, "actual_token": " 3 "}) == {
+        "row_key": 7, "hdfs_path": "", "obs_fuzzy_path": "", "obs_full_path": "",
+        "token_count": "12", "actual_usage": "", "actual_token": "3"
+    }
+
+    assert client.post(DETAIL + "/rows", json={"rows": "x"}, headers=admin_headers).status_code == 422
+    assert client.post(DETAIL + "/rows", json={"rows": []}, headers=user_headers("bulk_reader")).status_code == 403
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+子类别数据页测试 - 排序（按数值）、路径搜索（%和_按字面匹配）、游标分页正反两个方向都不漏不重
+
+运行: cd backend && pytest test_category_detail.py
+"""
+import base64
+import json
+
+import pytest
+
+DETAIL = "/api/plans/pageplan/stages/s/categories/c/x"
+
+# (key, hdfs_path, obs_full_path, token_count, actual_token)
+ROWS = [
+    (1, "/data/a_1", "", "10", "1"),
+    (2, "/data/ab1", "", "9", "2"),
+    (3, "/data/100%", "", "10", "3"),
+    (4, "/data/1000", "obs://b/a_1", "", "4"),
+    (5, "/data/x", "", "2.5", "5"),
+    (6, "/data/y", "", "100", "6"),
+    (7, "/data/z", "", "10", "7"),
+    (8, "/data/w", "", "x", "0.5"),
+]
+
+
+@pytest.fixture(scope="module")
+def detail(client, admin_headers):
+    client.post("/api/plans", json={"name": "pageplan"}, headers=admin_headers)
+    rows = [{"key": key, "hdfs_path": hdfs, "obs_full_path": obs, "token_count": token, "actual_token": actual}
+            for key, hdfs, obs, token, actual in ROWS]
+    response = client.post(DETAIL, json={"description": "", "rows": rows}, headers=admin_headers)
+    assert response.status_code == 200, response.text
+    return DETAIL
+
+
+def encoded_cursor(*parts):
+    return base64.urlsafe_b64encode(json.dumps(parts).encode()).decode()
+
+
+def keys(response):
+    assert response.status_code == 200, response.text
+    return [row["key"] for row in response.json()["rows"]]
+
+
+def test_default_order_and_offset_pages(client, detail):
+    assert keys(client.get(detail + "?page_size=100")) == [1, 2, 3, 4, 5, 6, 7, 8]
+    page = client.get(detail + "?page=2&page_size=3")
+    assert keys(page) == [4, 5, 6]
+    assert page.json()["total"] == 8
+
+
+@pytest.mark.parametrize("query,expected", [
+    # 按数值而不是字符串排序；空值和非数字按0排，相同值按写入顺序
+    ("sort_by=token_count", [4, 8, 5, 2, 1, 3, 7, 6]),
+    ("sort_by=token_count&sort_order=desc", [6, 7, 3, 1, 2, 5, 8, 4]),
+    ("sort_by=actual_token&sort_order=desc", [7, 6, 5, 4, 3, 2, 1, 8]),
+])
+def test_sort(client, detail, query, expected):
+    assert keys(client.get(f"{detail}?{query}&page_size=100")) == expected
+
+
+@pytest.mark.parametrize("query", ["sort_by=hdfs_path", "sort_order=up"])
+def test_unsupported_sort_is_rejected(client, detail, query):
+    assert client.get(f"{detail}?{query}").status_code == 400
+
+
+@pytest.mark.parametrize("search,expected", [
+    # _和%不当通配符：a_1不匹配ab1，100%不匹配1000
+    ("a_1", [1, 4]),
+    ("100%", [3]),
+    ("/data/", [1, 2, 3, 4, 5, 6, 7, 8]),
+    ("nothing", []),
+])
+def test_search_matches_paths_literally(client, detail, search, expected):
+    response = client.get(detail, params={"search": search, "page_size": 100})
+    assert keys(response) == expected
+    assert response.json()["total"] == len(expected)
+
+
+@pytest.mark.parametrize("sort_order,pages", [
+    ("asc", [[4, 8, 5], [2, 1, 3], [7, 6]]),
+    ("desc", [[6, 7, 3], [1, 2, 5], [8, 4]]),
+])
+def test_cursor_pages_cover_every_row_once(client, detail, sort_order, pages):
+    params = {"sort_by": "token_count", "sort_order": sort_order, "page_size": 3}
+    seen = []
+    response = client.get(detail, params=params)
+    while True:
+        seen.append(keys(response))
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+        response = client.get(detail, params={**params, "cursor": cursor})
+    assert seen == pages
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    encoded_cursor("row_order", 1),
+    # 格式对但值不是标量/整数
+    encoded_cursor("row_order", [1], 3),
+    encoded_cursor("row_order", "1", 3),
+    encoded_cursor("row_order", 1, 3.5),
+    encoded_cursor("row_order", True, 3),
+])
+def test_malformed_cursor_is_rejected(client, detail, cursor):
+    assert client.get(detail, params={"cursor": cursor}).status_code == 400
+
+
+def test_cursor_of_another_sort_is_rejected(client, detail):
+    cursor = client.get(detail, params={"sort_by": "token_count", "page_size": 3}).json()["next_cursor"]
+    assert client.get(detail, params={"sort_by": "actual_token", "cursor": cursor}).status_code == 400
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+子类别合计测试 - 增、改、删、覆盖导入后增量维护的token_count_sum/row_count与按行全量重算一致，核对接口报告0偏差
+
+运行: cd backend && pytest test_category_totals.py
+"""
+import pytest
+from sqlalchemy import text
+
+import main
+import models
+import spreadsheet
+from database import get_plan_session
+
+PLAN = "totalsplan"
+
+
+def detail_path(subcategory_name):
+    return f"/api/plans/{PLAN}/stages/s/categories/c/{subcategory_name}"
+
+
+def stored_and_recounted(plan_name):
+    """{subcategory: (token sum, actual sum, row count)} as stored, and as recounted from the rows"""
+    plan_db = get_plan_session(plan_name)
+    try:
+        stored = {}
+        recounted = {}
+        for detail in plan_db.query(models.CategoryDetail).all():
+            stored[detail.subcategory_name] = (detail.token_count_sum, detail.actual_token_sum, detail.row_count)
+            rows = plan_db.query(models.DatasetRow.token_count, models.DatasetRow.actual_token).filter(
+                models.DatasetRow.detail_id == detail.id
+            ).all()
+            recounted[detail.subcategory_name] = main.sum_dataset_row_tokens(rows) + (len(rows),)
+        return stored, recounted
+    finally:
+        plan_db.close()
+
+
+def assert_totals_match(plan_name):
+    stored, recounted = stored_and_recounted(plan_name)
+    assert stored.keys() == recounted.keys()
+    for name, (token_sum, actual_sum, row_count) in recounted.items():
+        assert stored[name] == (pytest.approx(token_sum), pytest.approx(actual_sum), row_count), name
+    return stored
+
+
+def test_totals_follow_every_row_change(client, admin_headers):
+    client.post("/api/plans", json={"name": PLAN}, headers=admin_headers)
+
+    # 新增
+    rows = [{"key": k, "token_count": f"{k}.25", "actual_token": str(k)} for k in range(1, 21)]
+    client.post(detail_path("x") + "/rows", json={"rows": rows}, headers=admin_headers)
+    client.post(detail_path("y") + "/rows", json={"rows": [{"key": 1, "token_count": "7"}]}, headers=admin_headers)
+    assert assert_totals_match(PLAN.upper())["x"][2] == 20
+
+    # 单行修改、单行新增、批量更新已有key
+    client.patch(detail_path("x") + "/row", json={"key": 3, "token_count": "100", "actual_token": ""}, headers=admin_headers)
+    client.patch(detail_path("x") + "/row", json={"key": 50, "token_count": "abc", "actual_token": "2"}, headers=admin_headers)
+    client.post(detail_path("x") + "/rows", json={"rows": [{"key": k, "token_count": "1"} for k in (4, 5, 60)]},
+                headers=admin_headers)
+    assert assert_totals_match(PLAN.upper())["x"][2] == 22
+
+    # 删除（包括不存在的key）
+    response = client.request("DELETE", detail_path("x") + "/rows", json={"keys": [1, 3, 3, 50, 999]}, headers=admin_headers)
+    assert response.json()["total"] == 19
+    assert_totals_match(PLAN.upper())
+
+    # 覆盖导入（坏行被拒，不计入），再整表保存
+    lines = [",".join(spreadsheet.DATASET_COLUMN_TITLES), "/a,,,5,,1", "/b,,,1.5,,x"]
+    client.post(detail_path("x") + "/import", headers=admin_headers,
+                files={"file": ("rows.csv", ("\n".join(lines) + "\n").encode("utf-8"), "text/csv")})
+    assert assert_totals_match(PLAN.upper())["x"] == (5.0, 1.0, 1)
+    client.post(detail_path("y"), json={"description": "", "rows": [{"key": 1, "token_count": "2", "actual_token": "2"}] * 2},
+                headers=admin_headers)
+    assert assert_totals_match(PLAN.upper())["y"] == (4.0, 4.0, 2)
+
+    result = client.post(f"/api/plans/{PLAN}/totals/reconcile", headers=admin_headers).json()
+    assert (result["fixed"], result["mismatches"]) == (0, [])
+
+
+def test_reconcile_repairs_drift(client, admin_headers):
+    client.post("/api/plans", json={"name": "driftplan"}, headers=admin_headers)
+    client.post("/api/plans/driftplan/stages/s/categories/c/x/rows",
+                json={"rows": [{"key": 1, "token_count": "3", "actual_token": "1"}]}, headers=admin_headers)
+
+    plan_db = get_plan_session("DRIFTPLAN")
+    try:
+        plan_db.execute(text("UPDATE category_details SET token_count_sum = 40, row_count = 5"))
+        plan_db.commit()
+    finally:
+        plan_db.close()
+
+    result = client.post("/api/plans/driftplan/totals/reconcile", headers=admin_headers).json()
+    assert result["fixed"] == 1
+    assert result["mismatches"][0]["stored"] == {"tokenCountTotal": 40.0, "actualTokenTotal": 1.0, "rowCount": 5}
+    assert result["mismatches"][0]["actual"] == {"tokenCountTotal": 3.0, "actualTokenTotal": 1.0, "rowCount": 1}
+    assert_totals_match("DRIFTPLAN")
+    assert client.post("/api/plans/driftplan/totals/reconcile", headers=admin_headers).json()["fixed"] == 0
+
+
+def test_shift_applies_to_the_committed_value(client, admin_headers):
+    client.post("/api/plans", json={"name": "shiftplan"}, headers=admin_headers)
+    client.post("/api/plans/shiftplan/stages/s/categories/c/x/rows", json={"rows": [{"key": 1, "token_count": "10"}]},
+                headers=admin_headers)
+
+    # 两个会话都先读到10，各自加增量后提交，结果不丢其中任何一个
+    first, second = get_plan_session("SHIFTPLAN"), get_plan_session("SHIFTPLAN")
+    try:
+        detail_a = first.query(models.CategoryDetail).one()
+        detail_b = second.query(models.CategoryDetail).one()
+        assert detail_a.token_count_sum == detail_b.token_count_sum == 10.0
+        main.shift_category_totals(first, detail_a, 5.0, 0.0, 1)
+        first.commit()
+        main.shift_category_totals(second, detail_b, -3.0, 2.0)
+        second.commit()
+        assert (detail_b.token_count_sum, detail_b.actual_token_sum, detail_b.row_count) == (12.0, 2.0, 2)
+    finally:
+        first.close()
+        second.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+条件请求测试 - 计划/阶段/子类别的GET带ETag，未变化时304，写入后ETag随之变化
+
+运行: cd backend && pytest test_conditional_get.py
+"""
+import pytest
+
+import main
+
+PLAN = "/api/planetag"
+STAGE_A = "/api/plans/etag/stages/a/categories"
+STAGE_B = "/api/plans/etag/stages/b/categories"
+DETAIL_A = "/api/plans/etag/stages/a/categories/c/x"
+DETAIL_B = "/api/plans/etag/stages/b/categories/c/x"
+
+
+def etags(client, *paths):
+    tags = {}
+    for path in paths:
+        response = client.get(path)
+        assert response.status_code == 200, response.text
+        tags[path] = response.headers["etag"]
+        # 带上刚拿到的ETag再请求一次应当是304
+        assert client.get(path, headers={"If-None-Match": tags[path]}).status_code == 304, path
+    return tags
+
+
+def test_etags_change_only_for_what_was_written(client, admin_headers):
+    client.post("/api/plans", json={"name": "etag"}, headers=admin_headers)
+    stages = {name: {"rows": [{"category": "c", "subcategory": "x"}], "merges": []} for name in ("a", "b")}
+    client.post(PLAN, json={"description": "", "stages": stages}, headers=admin_headers)
+    for path in (DETAIL_A, DETAIL_B):
+        client.post(path + "/rows", json={"rows": [{"key": 1, "hdfs_path": "/p", "token_count": "1"}]}, headers=admin_headers)
+
+    before = etags(client, PLAN, STAGE_A, STAGE_B, DETAIL_A, DETAIL_B)
+    response = client.patch(DETAIL_A + "/row", json={"key": 1, "hdfs_path": "/q", "token_count": "1"}, headers=admin_headers)
+    assert response.status_code == 200, response.text
+    after = etags(client, PLAN, STAGE_A, STAGE_B, DETAIL_A, DETAIL_B)
+
+    assert after[PLAN] != before[PLAN]
+    assert after[STAGE_A] != before[STAGE_A]
+    assert after[DETAIL_A] != before[DETAIL_A]
+    assert after[STAGE_B] == before[STAGE_B]
+    assert after[DETAIL_B] == before[DETAIL_B]
+    assert client.get(DETAIL_A, headers={"If-None-Match": before[DETAIL_A]}).status_code == 200
+
+
+def test_plan_etag_follows_description(client, admin_headers):
+    client.post("/api/plans", json={"name": "etagdesc"}, headers=admin_headers)
+    before = etags(client, "/api/planetagdesc")["/api/planetagdesc"]
+    client.put("/api/plans/etagdesc", json={"description": "changed"}, headers=admin_headers)
+    response = client.get("/api/planetagdesc", headers={"If-None-Match": before})
+    assert response.status_code == 200 and response.json()["description"] == "changed"
+
+
+def test_identical_writes_keep_etags(client, admin_headers):
+    plan, stage, detail = "/api/planetagsame", "/api/plans/etagsame/stages/a/categories", "/api/plans/etagsame/stages/a/categories/c/x"
+    client.post("/api/plans", json={"name": "etagsame"}, headers=admin_headers)
+    categories = {"description": "d", "categories": [{"category": "c", "subcategory": "x"}]}
+    client.post(stage, json=categories, headers=admin_headers)
+    client.patch(detail + "/description", json={"description": "text"}, headers=admin_headers)
+    before = etags(client, plan, stage, detail)
+
+    # 子类别页每次打开都会自动保存描述；内容没变时不应让缓存失效
+    assert client.patch(detail + "/description", json={"description": "text"}, headers=admin_headers).status_code == 200
+    assert client.post(stage, json=categories, headers=admin_headers).status_code == 200
+    for path in (plan, stage, detail):
+        assert client.get(path, headers={"If-None-Match": before[path]}).status_code == 304, path
+
+    client.patch(detail + "/description", json={"description": "new text"}, headers=admin_headers)
+    assert client.get(detail, headers={"If-None-Match": before[detail]}).status_code == 200
+
+
+def test_recreated_plan_gets_new_etags_and_cache_keys(client, admin_headers, monkeypatch):
+    plan, stage, detail = "/api/planetagre", "/api/plans/etagre/stages/a/categories", "/api/plans/etagre/stages/a/categories/c/x"
+
+    def build(token_count):
+        client.post("/api/plans", json={"name": "etagre"}, headers=admin_headers)
+        stages = {"a": {"rows": [{"category": "c", "subcategory": "x"}], "merges": []}}
+        client.post(plan, json={"description": "", "stages": stages}, headers=admin_headers)
+        client.post(detail + "/rows", json={"rows": [{"key": 1, "token_count": token_count}]}, headers=admin_headers)
+        return etags(client, plan, stage, detail)
+
+    before = build("1")
+    # 删除发生在另一个worker上：本进程的响应缓存没收到失效
+    with monkeypatch.context() as patch:
+        patch.setattr(main.response_cache, "invalidate", lambda *args, **kwargs: None)
+        assert client.delete("/api/plans/etagre", headers=admin_headers).status_code == 200
+    # 同样的写入顺序让新库的版本号、阶段和子类别id都与旧库相同，只有计划id不同
+    after = build("2")
+
+    for path in (plan, stage, detail):
+        assert after[path] != before[path], path
+        assert client.get(path, headers={"If-None-Match": before[path]}).status_code == 200, path
+    assert client.get(detail).json()["tokenCountTotal"] == "2.00"
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+快速JSON编码测试 - 大响应绕过jsonable_encoder后内容与默认编码一致，ETag照旧；模型JSON列用同一编码
+
+运行: cd backend && pytest test_fast_json.py
+"""
+import json
+from datetime import datetime
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import main
+import models
+import fast_json
+from database import get_plan_session
+
+
+def test_heavy_endpoints_match_the_default_encoding(client, admin_headers):
+    client.post("/api/plans", json={"name": "fjplan"}, headers=admin_headers)
+    stages = {"阶段一": {"rows": [{"category": "代码", "subcategory": f"子类{i}", "total_tokens": "1.5"} for i in range(5)],
+                         "merges": [{"row": 0, "col": 0, "rowspan": 5, "colspan": 1}]}}
+    client.post("/api/planfjplan", json={"description": "说明", "stages": stages}, headers=admin_headers)
+    client.post("/api/plans/fjplan/stages/阶段一/categories/代码/子类0/rows",
+                json={"rows": [{"key": 1, "hdfs_path": "/数据/1", "token_count": "12"}]}, headers=admin_headers)
+
+    plan_db = get_plan_session("FJPLAN")
+    try:
+        expected = {
+            "/api/planfjplan": {"description": "说明", "stages": main.load_plan_stages(plan_db)},
+            "/api/plans/fjplan/visualization": main.load_visualization_data(plan_db),
+        }
+    finally:
+        plan_db.close()
+
+    for path, payload in expected.items():
+        response = client.get(path)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json"
+        assert response.json() == json.loads(JSONResponse(jsonable_encoder(payload)).body)
+
+    # ETag仍随响应发出，带上后304
+    detail = "/api/plans/fjplan/stages/阶段一/categories/代码/子类0"
+    response = client.get(detail)
+    assert response.json()["rows"][0]["hdfs_path"] == "/数据/1"
+    assert client.get(detail, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+
+def test_codec_and_stdlib_fallback_agree():
+    value = {"名称": "代码", 1: [1.5, None, True], "when": datetime(2024, 5, 1, 12, 30, 15, 250)}
+    encoded = fast_json.dumps_bytes(value)
+    assert json.loads(encoded) == json.loads(fast_json.stdlib_dumps_bytes(value))
+    assert fast_json.loads(encoded) == {"名称": "代码", "1": [1.5, None, True], "when": "2024-05-01T12:30:15.000250"}
+    assert "名称".encode("utf-8") in encoded
+
+
+def test_model_json_columns_round_trip():
+    stage = models.Stage(name="S")
+    stage.categories = [{"name": "代码", "subcategories": [{"name": "子类"}]}]
+    stage.merges = [{"row": 0, "col": 0, "rowspan": 2, "colspan": 1}]
+    assert stage.categories == [{"name": "代码", "subcategories": [{"name": "子类"}]}]
+    assert stage.merges[0]["rowspan"] == 2
+    # 存的文本仍是普通JSON，旧数据（标准库json写的）也能读
+    assert json.loads(stage._categories) == stage.categories
+    stage._merges = json.dumps([{"row": 1}])
+    assert stage.merges == [{"row": 1}]
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
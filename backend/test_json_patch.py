@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+JSON Patch测试 - RFC 6902的add/remove/replace/move/copy/test，出错时整个补丁不生效
+
+运行: cd backend && pytest test_json_patch.py
+"""
+import pytest
+
+from json_patch import JsonPatchError, apply_patch
+
+
+def test_operations():
+    document = {"description": "", "stages": {"s1": {"rows": [{"key": 1}, {"key": 2}], "merges": []}}}
+    patched = apply_patch(document, [
+        {"op": "add", "path": "/stages/s1/rows/-", "value": {"key": 3}},
+        {"op": "add", "path": "/stages/s1/rows/0", "value": {"key": 0}},
+        {"op": "replace", "path": "/description", "value": "新说明"},
+        {"op": "remove", "path": "/stages/s1/rows/1"},
+        {"op": "copy", "from": "/stages/s1", "path": "/stages/s2"},
+        {"op": "move", "from": "/stages/s2/rows/0", "path": "/stages/s2/rows/-"},
+        {"op": "test", "path": "/stages/s2/rows/2", "value": {"key": 0}},
+        {"op": "add", "path": "/stages/a~1b~0c", "value": {}},
+    ])
+    assert patched == {
+        "description": "新说明",
+        "stages": {
+            "s1": {"rows": [{"key": 0}, {"key": 2}, {"key": 3}], "merges": []},
+            "s2": {"rows": [{"key": 2}, {"key": 3}, {"key": 0}], "merges": []},
+            "a/b~c": {},
+        }
+    }
+    # 输入不被修改，copy出来的值也不与原值共享
+    assert document["stages"]["s1"]["rows"] == [{"key": 1}, {"key": 2}]
+    patched["stages"]["s2"]["merges"].append(1)
+    assert patched["stages"]["s1"]["merges"] == []
+    # 空路径替换整个文档
+    assert apply_patch(document, [{"op": "replace", "path": "", "value": [1]}]) == [1]
+
+
+@pytest.mark.parametrize("operations,message", [
+    ({"op": "add"}, "patch must be a list"),
+    (["add"], "must be an object"),
+    ([{"op": "add", "path": "description", "value": 1}], "invalid path"),
+    ([{"op": "add", "path": "/x"}], "missing value"),
+    ([{"op": "remove", "path": "/missing"}], "path not found"),
+    ([{"op": "replace", "path": "/missing", "value": 1}], "path not found"),
+    ([{"op": "remove", "path": "/rows/2"}], "out of range"),
+    ([{"op": "add", "path": "/rows/01", "value": 1}], "invalid array index"),
+    ([{"op": "remove", "path": "/rows/-"}], "invalid array index"),
+    ([{"op": "move", "from": "/rows", "path": "/rows/0"}], "into itself"),
+    ([{"op": "remove", "path": ""}], "whole document"),
+    ([{"op": "test", "path": "/rows/0", "value": 2}], "test failed"),
+    ([{"op": "merge", "path": "/rows"}], "unsupported op"),
+])
+def test_errors(operations, message):
+    with pytest.raises(JsonPatchError, match=message):
+        apply_patch({"rows": [1, 2]}, operations)
+
+
+def test_failed_patch_is_atomic():
+    document = {"rows": [1, 2]}
+    with pytest.raises(JsonPatchError, match="operation 1"):
+        apply_patch(document, [{"op": "add", "path": "/rows/-", "value": 3}, {"op": "test", "path": "/rows/0", "value": 9}])
+    assert document == {"rows": [1, 2]}
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
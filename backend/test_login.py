@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+登录测试 - 旧工作因子的密码登录时被重新哈希，密码哈希在专用线程池上运行，频繁登录按用户名+地址限流，按地址只限流失败的登录
+
+运行: cd backend && pytest test_login.py
+"""
+import threading
+
+import pytest
+from passlib.context import CryptContext
+
+import main
+import models
+import auth
+import passwords
+from database import MainSessionLocal
+
+
+def stored_hash(username):
+    db = MainSessionLocal()
+    try:
+        return db.query(models.User).filter(models.User.username == username).first().hashed_password
+    finally:
+        db.close()
+
+
+def test_login_rehashes_outdated_work_factor(client):
+    weak = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("secret")
+    db = MainSessionLocal()
+    try:
+        db.add(models.User(username="lg_user", hashed_password=weak, is_admin=False))
+        db.commit()
+    finally:
+        db.close()
+
+    assert client.post("/api/auth/login", json={"username": "lg_user", "password": "wrong"}).status_code == 401
+    assert stored_hash("lg_user") == weak
+    response = client.post("/api/auth/login", json={"username": "lg_user", "password": "secret"})
+    assert response.status_code == 200 and response.json()["access_token"]
+    assert stored_hash("lg_user").startswith(f"$2b${passwords.BCRYPT_ROUNDS:02d}$")
+    assert passwords.verify_password("secret", stored_hash("lg_user"))
+
+
+def test_register_hashes_off_the_request_thread(client, monkeypatch):
+    threads = []
+    hash_password = passwords.hash_password
+
+    def recording_hash(password):
+        threads.append(threading.current_thread())
+        return hash_password(password)
+
+    monkeypatch.setattr(passwords, "hash_password", recording_hash)
+    assert client.post("/api/auth/register", json={"username": "lg_new", "password": "pw"}).status_code == 200
+    # 在密码专用线程池上哈希，不是事件循环线程也不是处理请求的线程池
+    assert len(threads) == 1 and threads[0].name.startswith("password-hash")
+    assert client.post("/api/auth/register", json={"username": "lg_new", "password": "pw"}).status_code == 400
+    assert passwords.verify_password("pw", stored_hash("lg_new"))
+
+
+def test_login_is_rate_limited(client):
+    for _ in range(auth.LOGIN_RATE_LIMIT):
+        assert client.post("/api/auth/login", json={"username": "lg_ghost", "password": "x"}).status_code == 401
+    response = client.post("/api/auth/login", json={"username": "lg_ghost", "password": "x"})
+    assert response.status_code == 429 and int(response.headers["retry-after"]) > 0
+    # 其他用户不受影响
+    assert client.post("/api/auth/login", json={"username": "lg_other", "password": "x"}).status_code == 401
+
+
+
+def test_login_is_rate_limited_per_address(client, monkeypatch):
+    monkeypatch.setattr(main, "login_ip_limiter", auth.RateLimiter(3, auth.LOGIN_RATE_WINDOW))
+    # 每次换一个用户名，按用户名+地址的限流拦不住，按地址的限流拦住
+    for i in range(3):
+        assert client.post("/api/auth/login", json={"username": f"lg_spray{i}", "password": "x"}).status_code == 401
+    response = client.post("/api/auth/login", json={"username": "lg_spray3", "password": "x"})
+    assert response.status_code == 429 and int(response.headers["retry-after"]) > 0
+    assert main.login_ip_limiter.rejected == 1
+
+
+def test_successful_logins_do_not_count_against_the_address(client, monkeypatch):
+    monkeypatch.setattr(main, "login_ip_limiter", auth.RateLimiter(auth.LOGIN_IP_RATE_LIMIT, auth.LOGIN_RATE_WINDOW))
+    # 低工作因子只为让60次登录跑得快
+    monkeypatch.setattr(passwords, "pwd_context", CryptContext(schemes=["bcrypt"], bcrypt__rounds=4))
+    usernames = [f"lg_office{i}" for i in range(6)]
+    db = MainSessionLocal()
+    try:
+        db.add_all(models.User(username=name, hashed_password=passwords.hash_password(name)) for name in usernames)
+        db.commit()
+    finally:
+        db.close()
+
+    # 同一出口地址后的多个用户，60次成功登录超过了按地址的上限也不被拦
+    assert 60 > auth.LOGIN_IP_RATE_LIMIT
+    for _ in range(10):
+        for name in usernames:
+            assert client.post("/api/auth/login", json={"username": name, "password": name}).status_code == 200
+    # 这个地址之后的失败仍按完整的额度计数
+    assert client.post("/api/auth/login", json={"username": "lg_office_typo", "password": "x"}).status_code == 401
+    assert main.login_ip_limiter.rejected == 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
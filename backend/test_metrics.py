@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+指标接口测试 - /metrics输出Prometheus文本格式：按路由模板的请求耗时、子类别行数分布、导入导出计数
+
+运行: cd backend && pytest test_metrics.py
+"""
+import re
+
+import pytest
+
+import spreadsheet
+from database import plan_engines
+
+DETAIL = "/api/plans/metricsplan/stages/s/categories/c/x"
+
+
+def scrape(client) -> dict:
+    """Samples of the exposition as "name{labels}" -> value"""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    samples = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_request_latency_is_labelled_by_route_template(client, admin_headers):
+    client.post("/api/plans", json={"name": "metricsplan"}, headers=admin_headers)
+    client.post(DETAIL + "/rows", json={"rows": [{"key": 1, "token_count": "1"}]}, headers=admin_headers)
+    client.get(DETAIL)
+
+    samples = scrape(client)
+    route = "/api/plans/{plan_name}/stages/{stage_name}/categories/{category_name}/{subcategory_name}"
+    count = f'http_request_duration_seconds_count{{method="GET",route="{route}"}}'
+    assert samples[count] >= 1
+    assert samples[f'http_request_duration_seconds_bucket{{method="GET",route="{route}",le="+Inf"}}'] == samples[count]
+    assert samples[f'http_requests_total{{method="GET",route="{route}",status="200"}}'] >= 1
+    # 具体的计划名不进标签
+    assert not any("metricsplan" in name for name in samples)
+
+    # 子类别行数分布覆盖刚建的子类别
+    assert samples['subcategory_rows_count'] >= 1
+    assert samples['subcategory_rows_bucket{le="10.0"}'] >= 1
+    assert "plan_engine_engines" in samples and 'cache_entries{cache="token"}' in samples
+
+
+def test_import_and_export_are_counted(client, admin_headers):
+    client.post("/api/plans", json={"name": "metricsplan"}, headers=admin_headers)
+    before = scrape(client)
+
+    lines = [",".join(spreadsheet.DATASET_COLUMN_TITLES)] + [f"/data/{i},,,{i},,1" for i in range(3)]
+    response = client.post(
+        DETAIL + "/import", headers=admin_headers,
+        files={"file": ("rows.csv", ("\n".join(lines) + "\n").encode("utf-8"), "text/csv")}
+    )
+    assert response.status_code == 200, response.text
+    exported = client.get(DETAIL + "/export?format=csv")
+    assert exported.status_code == 200
+
+    after = scrape(client)
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    assert delta('import_requests_total{result="ok"}') == 1
+    assert delta('import_rows_total{outcome="inserted"}') + delta('import_rows_total{outcome="updated"}') == 3
+    assert delta("import_duration_seconds_count") == 1
+    assert delta('export_requests_total{format="csv",result="ok"}') == 1
+    assert delta("export_rows_total") == 3
+    assert delta('export_bytes_total{format="csv"}') == len(exported.content)
+    assert any(re.match(r"sqlite_write_statement_duration_seconds_count\{database=\"plan\"\}", name) for name in after)
+
+
+def test_scrape_never_opens_a_plan_database(client, admin_headers, monkeypatch):
+    before = scrape(client)
+    client.post("/api/plans", json={"name": "metricshist"}, headers=admin_headers)
+    rows = [{"key": k, "token_count": "1"} for k in range(1, 51)]
+    client.post("/api/plans/metricshist/stages/s/categories/c/x/rows", json={"rows": rows}, headers=admin_headers)
+    client.post("/api/plans/metricshist/stages/s/categories/c/y/rows", json={"rows": rows[:3]}, headers=admin_headers)
+
+    def open_plan_database(plan_name):
+        raise AssertionError(f"scrape opened plan database {plan_name}")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(plan_engines, "_entry", open_plan_database)
+        after = scrape(client)
+
+        def delta(name):
+            return after[name] - before.get(name, 0)
+
+        # 直方图来自main.db里随每次提交更新的计划汇总
+        assert delta("subcategory_rows_count") == 2
+        assert delta("subcategory_rows_sum") == 53
+        assert delta('subcategory_rows_bucket{le="10.0"}') == 1
+        assert delta('subcategory_rows_bucket{le="100.0"}') == 2
+
+        assert client.delete("/api/plans/metricshist", headers=admin_headers).status_code == 200
+        assert scrape(client)["subcategory_rows_count"] == before["subcategory_rows_count"]
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
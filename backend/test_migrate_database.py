@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+数据迁移测试 - CategoryDetail旧的_rows JSON被搬进dataset_rows（已有行的按key合并），行数和Token合计按搬过去的行重算，计划版本和列表汇总随之更新；旧plans表重建为AUTOINCREMENT
+
+运行: cd backend && pytest test_migrate_database.py
+"""
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import insert, inspect, text
+
+import models
+import migrate_database
+from database import MainBase, create_sqlite_engine, create_tables, get_plan_session
+
+LEGACY_ROWS = [
+    {'key': 3, 'hdfs_path': '/old/3', 'token_count': '1000.5', 'actual_token': '900'},
+    {'hdfs_path': '/old/nokey', 'token_count': '200', 'actual_token': '200'},
+    {'key': 3, 'hdfs_path': '/old/dup', 'token_count': 'n/a', 'actual_token': ''},
+    {'key': 1, 'hdfs_path': '/old/1', 'obs_full_path': 'obs://old/1', 'token_count': '300', 'actual_usage': '50%', 'actual_token': '150'},
+]
+
+
+def test_legacy_rows_are_migrated_with_totals():
+    plan_db = get_plan_session("MIGPLAN")
+    try:
+        stage = models.Stage(name="S", stage_order=0, description="", categories=[])
+        plan_db.add(stage)
+        plan_db.flush()
+        # 旧数据：行只在_rows里，合计列还是0
+        detail = models.CategoryDetail(stage_id=stage.id, category_name="C", subcategory_name="X", description="")
+        detail.legacy_rows = LEGACY_ROWS
+        plan_db.add(detail)
+        plan_db.commit()
+        stage_id, detail_id = stage.id, detail.id
+    finally:
+        plan_db.close()
+
+    assert migrate_database.migrate_category_rows("MIGPLAN") == 4
+
+    plan_db = get_plan_session("MIGPLAN")
+    try:
+        rows = plan_db.query(models.DatasetRow).filter(
+            models.DatasetRow.detail_id == detail_id
+        ).order_by(models.DatasetRow.row_order).all()
+        # 缺key和重复key的行拿到新key，顺序不变
+        assert [(row.row_key, row.hdfs_path) for row in rows] == [(3, '/old/3'), (4, '/old/nokey'), (5, '/old/dup'), (1, '/old/1')]
+        assert models.dataset_row_to_dict(rows[3]) == {
+            'key': 1, 'hdfs_path': '/old/1', 'obs_fuzzy_path': '', 'obs_full_path': 'obs://old/1',
+            'token_count': '300', 'actual_usage': '50%', 'actual_token': '150'
+        }
+
+        detail = plan_db.get(models.CategoryDetail, detail_id)
+        assert detail.row_count == 4
+        assert detail.token_count_sum == pytest.approx(1500.5)
+        assert detail.actual_token_sum == pytest.approx(1250.0)
+        assert detail.legacy_rows == []
+
+        # 阶段汇总由触发器跟着合计列更新
+        rollup = plan_db.query(models.StageRollup).filter(models.StageRollup.stage_id == stage_id).one()
+        assert (rollup.token_count_sum, rollup.actual_token_sum, rollup.dataset_count) == (pytest.approx(1500.5), pytest.approx(1250.0), 4)
+    finally:
+        plan_db.close()
+
+    # 再跑一次不会重复搬
+    assert migrate_database.migrate_category_rows("MIGPLAN") == 0
+
+
+def add_legacy_detail(plan_name, legacy_rows, existing_rows=()):
+    """A subcategory whose rows are still in the _rows blob, optionally with some already in dataset_rows"""
+    plan_db = get_plan_session(plan_name)
+    try:
+        stage = models.Stage(name="S", stage_order=0, description="", categories=[])
+        plan_db.add(stage)
+        plan_db.flush()
+        detail = models.CategoryDetail(stage_id=stage.id, category_name="C", subcategory_name="X", description="")
+        detail.legacy_rows = legacy_rows
+        plan_db.add(detail)
+        plan_db.flush()
+        mappings = models.dataset_row_mappings(detail.id, list(existing_rows))
+        if mappings:
+            plan_db.execute(insert(models.DatasetRow), mappings)
+        detail.token_count_sum = sum(models.parse_token_value(m['token_count']) for m in mappings)
+        detail.actual_token_sum = sum(models.parse_token_value(m['actual_token']) for m in mappings)
+        detail.row_count = len(mappings)
+        plan_db.commit()
+        return detail.id
+    finally:
+        plan_db.close()
+
+
+def test_blob_rows_are_merged_into_existing_rows():
+    # 部分行已在dataset_rows里（并且改过），其余只在_rows里
+    existing = [{'key': 1, 'hdfs_path': '/new/1', 'token_count': '10', 'actual_token': '1'}]
+    legacy = [
+        {'key': 1, 'hdfs_path': '/old/1', 'token_count': '300', 'actual_token': '150'},
+        {'key': 2, 'hdfs_path': '/old/2', 'token_count': '20', 'actual_token': '2'},
+    ]
+    detail_id = add_legacy_detail("MIGMERGE", legacy, existing)
+
+    assert migrate_database.migrate_category_rows("MIGMERGE") == 1
+
+    plan_db = get_plan_session("MIGMERGE")
+    try:
+        rows = plan_db.query(models.DatasetRow).filter(
+            models.DatasetRow.detail_id == detail_id
+        ).order_by(models.DatasetRow.row_order).all()
+        assert [(row.row_key, row.hdfs_path) for row in rows] == [(1, '/new/1'), (2, '/old/2')]
+        detail = plan_db.get(models.CategoryDetail, detail_id)
+        assert (detail.row_count, detail.token_count_sum, detail.actual_token_sum) == (2, pytest.approx(30.0), pytest.approx(3.0))
+        assert detail.legacy_rows == []
+    finally:
+        plan_db.close()
+
+
+def test_migration_bumps_plan_version_and_list_summary(client, admin_headers):
+    client.post("/api/plans", json={"name": "migsync"}, headers=admin_headers)
+    add_legacy_detail("MIGSYNC", LEGACY_ROWS)
+    etag = client.get("/api/planmigsync").headers["etag"]
+    entry = next(plan for plan in client.get("/api/plans").json()["plans"] if plan["key"] == "migsync")
+    assert entry["total_tokens"] == 0.0
+
+    migrate_database.migrate_category_rows("MIGSYNC")
+
+    assert client.get("/api/planmigsync", headers={"If-None-Match": etag}).status_code == 200
+    entry = next(plan for plan in client.get("/api/plans").json()["plans"] if plan["key"] == "migsync")
+    assert (entry["stage_count"], entry["total_tokens"], entry["actual_tokens"]) == (1, pytest.approx(1500.5), pytest.approx(1250.0))
+
+
+def test_plans_table_is_rebuilt_with_autoincrement():
+    # 旧版main.db的plans表没有AUTOINCREMENT，删掉最新的计划后新计划会拿到同一个id
+    engine = create_sqlite_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "old_main.db"))
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE plans (id INTEGER NOT NULL, name VARCHAR, description TEXT, PRIMARY KEY (id))"))
+        conn.execute(text("CREATE INDEX ix_plans_id ON plans (id)"))
+        conn.execute(text("CREATE UNIQUE INDEX ix_plans_name ON plans (name)"))
+        conn.execute(text("INSERT INTO plans (id, name, description) VALUES (1, 'A', 'a'), (2, 'B', 'b')"))
+
+    create_tables(engine, MainBase.metadata)
+    create_tables(engine, MainBase.metadata)
+
+    with engine.begin() as conn:
+        assert "AUTOINCREMENT" in conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'plans'")).scalar()
+        assert conn.execute(text("SELECT id, name, description, stage_count FROM plans ORDER BY id")).all() == [
+            (1, 'A', 'a', None), (2, 'B', 'b', None)
+        ]
+        conn.execute(text("DELETE FROM plans WHERE id = 2"))
+        conn.execute(text("INSERT INTO plans (name) VALUES ('B')"))
+        assert conn.execute(text("SELECT id FROM plans WHERE name = 'B'")).scalar() == 3
+    assert {index["name"] for index in inspect(engine).get_indexes("plans")} == {"ix_plans_id", "ix_plans_name"}
+    assert "_plans_old" not in inspect(engine).get_table_names()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
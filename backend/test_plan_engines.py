@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+计划引擎缓存测试 - 并发首次请求只建一次引擎，超出容量时淘汰最久未用的空闲引擎，有连接在用的引擎不淘汰
+
+运行: cd backend && pytest test_plan_engines.py
+"""
+import threading
+import time
+
+import pytest
+
+import database
+from database import PlanEngineRegistry
+
+
+@pytest.fixture
+def registry():
+    registry = PlanEngineRegistry(2)
+    yield registry
+    registry.clear()
+
+
+def test_concurrent_first_requests_create_one_engine(registry, monkeypatch):
+    calls = []
+    create_tables = database.create_tables
+
+    def slow_create_tables(engine, metadata):
+        calls.append(engine)
+        time.sleep(0.05)
+        create_tables(engine, metadata)
+
+    monkeypatch.setattr(database, "create_tables", slow_create_tables)
+    engines = []
+    threads = [threading.Thread(target=lambda: engines.append(registry.get("ENGSINGLE"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(engines) == 8 and all(engine is engines[0] for engine in engines)
+    assert (registry.misses, registry.hits) == (1, 7)
+
+
+def test_least_recently_used_engine_is_evicted(registry):
+    first = registry.get("ENGA")
+    registry.get("ENGB")
+    # 访问A之后B成了最久未用的
+    assert registry.get("ENGA") is first
+    registry.get("ENGC")
+    assert registry.stats()["engines"] == 2
+    assert registry.evictions == 1
+
+    misses = registry.misses
+    registry.get("ENGA")
+    assert registry.misses == misses
+    registry.get("ENGB")
+    assert registry.misses == misses + 1
+
+
+def test_engine_in_use_is_not_evicted(registry):
+    busy = registry.get("ENGBUSY")
+    registry.get("ENGIDLE")
+    connection = busy.connect()
+    try:
+        # 超出容量时跳过有连接在用的引擎，淘汰下一个空闲的
+        registry.get("ENGNEW")
+        assert registry.evictions == 1
+        misses = registry.misses
+        assert registry.get("ENGBUSY") is busy
+        assert registry.misses == misses
+
+        stats = registry.stats()
+        assert stats["connections_in_use"] == 1
+        assert stats["open_connections"] >= 1
+    finally:
+        connection.close()
+    assert registry.stats()["connections_in_use"] == 0
+
+
+def test_stats(registry):
+    registry.get("ENGSTATS")
+    registry.get("ENGSTATS")
+    registry.remove("ENGSTATS")
+    assert registry.stats() == {
+        "capacity": 2, "engines": 0, "hits": 1, "misses": 1, "evictions": 0,
+        "connections_in_use": 0, "open_connections": 0,
+    }
+
+
+def test_stats_endpoint_is_admin_only(client, admin_headers, user_headers):
+    response = client.get("/api/admin/plan-engines", headers=admin_headers)
+    assert response.status_code == 200
+    assert {"capacity", "engines", "hits", "misses", "evictions", "connections_in_use", "open_connections"} <= set(response.json())
+    assert client.get("/api/admin/plan-engines", headers=user_headers("engine_reader")).status_code == 403
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
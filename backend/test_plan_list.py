@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+计划列表测试 - 列表里的阶段数、Token合计和更新时间来自main.db中的汇总，随阶段和数据行的写入更新；缺汇总的旧计划在启动时补算，读列表不写库
+
+运行: cd backend && pytest test_plan_list.py
+"""
+import pytest
+
+import main
+import models
+from database import MainSessionLocal, main_engine
+
+DETAIL = "/api/plans/listplan/stages/s2/categories/c/x"
+
+
+def plan_entry(client, key):
+    return next(plan for plan in client.get("/api/plans").json()["plans"] if plan["key"] == key)
+
+
+def summary(entry):
+    return entry["stage_count"], entry["total_tokens"], entry["actual_tokens"]
+
+
+def test_plan_list_follows_writes(client, admin_headers):
+    client.post("/api/plans", json={"name": "listplan"}, headers=admin_headers)
+    entry = plan_entry(client, "listplan")
+    assert summary(entry) == (0, 0.0, 0.0)
+    updated_at = entry["updated_at"]
+    assert updated_at is not None
+
+    # 新建阶段
+    client.post("/api/plans/listplan/stages", json={"name": "s1"}, headers=admin_headers)
+    entry = plan_entry(client, "listplan")
+    assert summary(entry) == (1, 0.0, 0.0)
+    assert entry["updated_at"] > updated_at
+    updated_at = entry["updated_at"]
+
+    # 写入数据行（连带新建阶段s2）
+    rows = [{"key": 1, "token_count": "1.5", "actual_token": "1"}, {"key": 2, "token_count": "2", "actual_token": "0.5"}]
+    client.post(DETAIL + "/rows", json={"rows": rows}, headers=admin_headers)
+    entry = plan_entry(client, "listplan")
+    assert summary(entry) == (2, pytest.approx(3.5), pytest.approx(1.5))
+    assert entry["updated_at"] > updated_at
+
+    # 修改、删除数据行
+    client.patch(DETAIL + "/row", json={"key": 1, "token_count": "10", "actual_token": "4"}, headers=admin_headers)
+    assert summary(plan_entry(client, "listplan")) == (2, pytest.approx(12.0), pytest.approx(4.5))
+    client.request("DELETE", DETAIL + "/rows", json={"keys": [2]}, headers=admin_headers)
+    assert summary(plan_entry(client, "listplan")) == (2, pytest.approx(10.0), pytest.approx(4.0))
+
+    # 读接口不改汇总
+    updated_at = plan_entry(client, "listplan")["updated_at"]
+    client.get(DETAIL)
+    client.get("/api/plans/listplan/visualization")
+    assert plan_entry(client, "listplan")["updated_at"] == updated_at
+
+
+def test_missing_summaries_are_backfilled_at_startup(client, admin_headers, statement_recorder):
+    client.post("/api/plans", json={"name": "listold"}, headers=admin_headers)
+    client.post("/api/plans/listold/stages/s/categories/c/x/rows",
+                json={"rows": [{"key": 1, "token_count": "2", "actual_token": "1"}]}, headers=admin_headers)
+    # 模拟汇总列加入之前保存的计划
+    db = MainSessionLocal()
+    try:
+        db.query(models.Plan).filter(models.Plan.name == "LISTOLD").update(
+            {"stage_count": None, "subcategory_row_histogram": None}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+    with statement_recorder(main_engine, prefixes=("INSERT", "UPDATE", "DELETE")) as writes:
+        assert plan_entry(client, "listold")["stage_count"] is None
+    assert writes == []
+
+    main.backfill_plan_summaries()
+    assert summary(plan_entry(client, "listold")) == (1, pytest.approx(2.0), pytest.approx(1.0))
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+请求性能剖析测试 - 管理员带X-Profile头的请求被采样剖析，结果存为speedscope JSON供下载
+
+运行: cd backend && pytest test_profiling.py
+"""
+import json
+import sys
+import threading
+
+import pytest
+
+import models
+from profiling import SamplingProfiler
+
+DETAIL = "/api/plans/profplan/stages/s/categories/c/x"
+
+
+def test_admin_can_profile_a_request_and_download_it(client, admin_headers):
+    client.post("/api/plans", json={"name": "profplan"}, headers=admin_headers)
+    client.post(DETAIL + "/rows", json={"rows": [{"key": i, "token_count": str(i)} for i in range(200)]}, headers=admin_headers)
+
+    response = client.get(DETAIL, headers={**admin_headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    profile_id = response.headers["x-profile-id"]
+    assert client.get(DETAIL + "?profile=1", headers=admin_headers).headers.get("x-profile-id")
+
+    listed = client.get("/api/admin/profiles", headers=admin_headers).json()
+    assert profile_id in [profile["id"] for profile in listed]
+    downloaded = client.get(f"/api/admin/profiles/{profile_id}", headers=admin_headers)
+    assert downloaded.status_code == 200
+    profile = json.loads(downloaded.content)
+    assert profile["$schema"].startswith("https://www.speedscope.app/")
+    assert profile["name"].startswith("GET /api/plans/{plan_name}/stages/")
+    for thread_profile in profile["profiles"]:
+        assert len(thread_profile["samples"]) == len(thread_profile["weights"])
+
+    # 非法或不存在的id
+    assert client.get("/api/admin/profiles/../main", headers=admin_headers).status_code == 404
+    assert client.get("/api/admin/profiles/20000101-000000-00000000", headers=admin_headers).status_code == 404
+
+
+def test_only_admins_trigger_profiles(client, user_headers):
+    viewer = user_headers("prof_viewer", False)
+    assert "x-profile-id" not in client.get(DETAIL, headers={**viewer, "X-Profile": "1"}).headers
+    assert "x-profile-id" not in client.get(DETAIL, headers={"X-Profile": "1", "Authorization": "Bearer bad"}).headers
+    assert client.get("/api/admin/profiles", headers=viewer).status_code == 403
+
+
+def test_sampler_sees_threadpool_work_in_models():
+    # 另一线程里反复解码阶段的JSON属性，剖析结果里应出现models.py的属性解码
+    stage = models.Stage(name="S")
+    stage.categories = [{"name": f"c{i}", "subcategories": list(range(5))} for i in range(20)]
+    done = threading.Event()
+
+    def decode():
+        while not done.is_set():
+            for _ in range(1000):
+                stage.categories
+
+    profiler = SamplingProfiler(0.001)
+    profiler.start(sys._getframe())
+    worker = threading.Thread(target=decode)
+    worker.start()
+    try:
+        threading.Event().wait(0.2)
+    finally:
+        done.set()
+        worker.join()
+        profiler.stop()
+
+    frames = profiler.speedscope("decode")["shared"]["frames"]
+    assert {"name": "categories", "file": "models.py"}.items() <= next(
+        frame for frame in frames if frame["name"] == "categories"
+    ).items()
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+查询次数测试 - 确认计划/阶段接口的SQL条数不随阶段数增长（防止退回N+1）
+
+运行: cd backend && pytest test_query_count.py
+"""
+import pytest
+
+from database import get_plan_engine
+
+
+def create_plan(client, headers, plan_name, stage_count, rows_per_stage=3):
+    client.post("/api/plans", json={"name": plan_name}, headers=headers)
+    stages = {
+        f"s{i}": {"rows": [{"category": f"c{j}", "subcategory": "x"} for j in range(rows_per_stage)], "merges": []}
+        for i in range(stage_count)
+    }
+    response = client.post(f"/api/plan{plan_name}", json={"description": "", "stages": stages}, headers=headers)
+    assert response.status_code == 200, response.text
+
+
+def query_count(client, statement_recorder, plan_name, path):
+    # 先请求一次，让引擎初始化（建表等）不计入
+    client.get(path)
+    with statement_recorder(get_plan_engine(plan_name.upper())) as statements:
+        response = client.get(path)
+    assert response.status_code == 200, response.text
+    return len(statements), response.json()
+
+
+def test_get_stages_query_count(client, admin_headers, statement_recorder):
+    create_plan(client, admin_headers, "qcstages2", 2)
+    create_plan(client, admin_headers, "qcstages20", 20)
+    small, small_result = query_count(client, statement_recorder, "qcstages2", "/api/plans/qcstages2/stages")
+    large, large_result = query_count(client, statement_recorder, "qcstages20", "/api/plans/qcstages20/stages")
+    assert [s["row_count"] for s in large_result] == [3] * 20
+    assert small == large, f"get_stages ran {small} queries for 2 stages but {large} for 20"
+
+
+def test_get_plan_query_count(client, admin_headers, statement_recorder):
+    create_plan(client, admin_headers, "qcplan2", 2)
+    create_plan(client, admin_headers, "qcplan20", 20)
+    small, small_result = query_count(client, statement_recorder, "qcplan2", "/api/planqcplan2")
+    large, large_result = query_count(client, statement_recorder, "qcplan20", "/api/planqcplan20")
+    assert list(large_result["stages"]) == [f"s{i}" for i in range(20)]
+    assert all(len(stage["rows"]) == 3 for stage in large_result["stages"].values())
+    assert small == large, f"get_plan ran {small} queries for 2 stages but {large} for 20"
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+只读接口测试 - 确认计划/阶段/子类别的GET请求不会写库（不建计划、阶段或空的CategoryDetail）
+
+运行: cd backend && pytest test_read_only.py
+"""
+import os
+
+import pytest
+
+import models
+from database import MainSessionLocal, main_engine, main_async_engine, get_plan_engine, get_plan_db_path, plan_engines
+
+WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "CREATE", "ALTER")
+
+
+def test_reads_of_missing_stage_and_subcategory_do_not_write(client, admin_headers, statement_recorder):
+    client.post("/api/plans", json={"name": "roplan"}, headers=admin_headers)
+    # GET接口走aiosqlite引擎，同步和异步引擎都要盯着
+    engines = (main_engine, main_async_engine.sync_engine, get_plan_engine("ROPLAN"),
+               plan_engines.get_async("ROPLAN").sync_engine)
+    with statement_recorder(*engines, prefixes=WRITE_PREFIXES) as writes:
+        plan = client.get("/api/planroplan")
+        categories = client.get("/api/plans/roplan/stages/nostage/categories")
+        detail = client.get("/api/plans/roplan/stages/nostage/categories/c/x")
+    assert plan.status_code == 200 and plan.json()["stages"] == {}
+    assert categories.json() == {"description": "", "categories": []}
+    assert detail.json()["rows"] == [] and detail.json()["total"] == 0
+    assert writes == []
+
+    plan_db = get_plan_engine("ROPLAN").connect()
+    try:
+        assert plan_db.exec_driver_sql("SELECT COUNT(*) FROM stages").scalar() == 0
+        assert plan_db.exec_driver_sql("SELECT COUNT(*) FROM category_details").scalar() == 0
+    finally:
+        plan_db.close()
+
+
+def test_reads_of_missing_plan_answer_404_without_creating_it(client):
+    for path in ("/api/planghost", "/api/plans/ghost/stages/s/categories", "/api/plans/ghost/stages/s/categories/c/x"):
+        assert client.get(path).status_code == 404, path
+    assert not os.path.exists(get_plan_db_path("GHOST"))
+    db = MainSessionLocal()
+    try:
+        assert db.query(models.Plan).filter(models.Plan.name == "GHOST").first() is None
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+请求计时测试 - 每个响应带Server-Timing（SQL条数/耗时、认证、总耗时），超过阈值的请求写日志
+
+运行: cd backend && pytest test_request_timing.py
+"""
+import logging
+import re
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from database import create_sqlite_engine
+from request_timing import RequestTimingMiddleware
+
+
+def server_timing(response) -> dict:
+    """Server-Timing metrics as name -> (duration or None, description or None)"""
+    metrics = {}
+    for metric in response.headers["server-timing"].split(", "):
+        name = metric.split(";")[0]
+        duration = re.search(r"dur=([0-9.]+)", metric)
+        description = re.search(r'desc="([^"]*)"', metric)
+        metrics[name] = (float(duration.group(1)) if duration else None, description.group(1) if description else None)
+    return metrics
+
+
+def test_responses_carry_server_timing(client, admin_headers):
+    client.post("/api/plans", json={"name": "rtplan"}, headers=admin_headers)
+    detail = "/api/plans/rtplan/stages/s/categories/c/x"
+    client.post(detail + "/rows", json={"rows": [{"key": 1, "token_count": "1"}]}, headers=admin_headers)
+
+    # 异步读接口走aiosqlite引擎，SQL也要计入
+    metrics = server_timing(client.get(detail))
+    assert int(metrics["db"][1].split()[0]) >= 2
+    assert metrics["total"][0] >= metrics["db"][0]
+    assert metrics["size"][1].endswith("bytes")
+
+    # 管理员接口单独记认证耗时
+    metrics = server_timing(client.post(detail + "/rows", json={"rows": [{"key": 2}]}, headers=admin_headers))
+    assert "auth" in metrics and int(metrics["db"][1].split()[0]) >= 1
+
+
+def test_slow_requests_are_logged_with_their_path(caplog):
+    engine = create_sqlite_engine("sqlite://")
+    app = FastAPI()
+
+    @app.get("/api/plans/{plan_name}/stages/{stage_name}")
+    def read(plan_name: str, stage_name: str):
+        with engine.connect() as connection:
+            return {"value": connection.execute(text("SELECT 1")).scalar()}
+
+    app.add_middleware(RequestTimingMiddleware, slow_request_ms=0)
+    with caplog.at_level(logging.WARNING, logger="request_timing"):
+        response = TestClient(app).get("/api/plans/P1/stages/S1")
+    assert response.json() == {"value": 1}
+    message = caplog.records[-1].getMessage()
+    assert "/api/plans/{plan_name}/stages/{stage_name} (P1/S1)" in message
+    assert "sql=1/" in message and "bytes=11" in message
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
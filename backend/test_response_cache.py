@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+响应缓存测试 - 读接口命中缓存，写入后只失效受影响的条目，且不会返回旧数据
+
+运行: cd backend && pytest test_response_cache.py
+"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+import main
+from response_cache import ResponseCache, SQLiteResponseCache
+
+
+def test_cache_bounds_and_tags():
+    now = [0.0]
+    cache = ResponseCache(capacity=2, ttl=10, clock=lambda: now[0])
+    cache.put("a", 1, tags=[("P",), ("P", "stage", 1)])
+    cache.put("b", 2, tags=[("P",), ("P", "stage", 2)])
+    assert cache.get("a") == 1
+    cache.put("c", 3, tags=[("Q",)])
+    # b是最久未用的，被挤出
+    assert cache.get("b") is None and cache.stats()["evictions"] == 1
+    cache.invalidate(("P", "stage", 1))
+    assert cache.get("a") is None and cache.get("c") == 3
+    now[0] = 11
+    assert cache.get("c") is None and cache.stats()["expirations"] == 1
+
+
+def test_sqlite_cache_is_shared_between_workers():
+    # 两个实例打开同一个文件，相当于两个uvicorn worker
+    path = os.path.join(tempfile.mkdtemp(), "shared_cache.db")
+    now = [100.0]
+    worker_a = SQLiteResponseCache(path, capacity=2, ttl=10, clock=lambda: now[0])
+    worker_b = SQLiteResponseCache(path, capacity=2, ttl=10, clock=lambda: now[0])
+
+    worker_a.put(["stage", "P", '"1.s1.3"'], {"categories": [{"name": "c"}]}, tags=[("P",), ("P", "stage", 1)])
+    assert worker_b.get(["stage", "P", '"1.s1.3"']) == {"categories": [{"name": "c"}]}
+
+    worker_a.put("other", 1, tags=[("Q",)])
+    worker_b.invalidate(("P", "stage", 1))
+    assert worker_a.get(["stage", "P", '"1.s1.3"']) is None
+    assert worker_a.get("other") == 1
+
+    now[0] += 1
+    worker_b.put("newer", 2)
+    worker_b.put("newest", 3)
+    # 容量为2，最早过期的条目被挤出
+    assert worker_a.get("other") is None and worker_a.get("newest") == 3
+    now[0] += 20
+    assert worker_b.get("newest") is None and worker_b.stats()["expirations"] == 1
+
+
+def test_writes_invalidate_only_affected_entries(client, admin_headers):
+    client.post("/api/plans", json={"name": "rcplan"}, headers=admin_headers)
+    stages = {name: {"rows": [{"category": "c", "subcategory": "x"}], "merges": []} for name in ("a", "b")}
+    client.post("/api/planrcplan", json={"description": "", "stages": stages}, headers=admin_headers)
+    detail_a = "/api/plans/rcplan/stages/a/categories/c/x"
+    detail_b = "/api/plans/rcplan/stages/b/categories/c/x"
+    for path in (detail_a, detail_b):
+        client.post(path + "/rows", json={"rows": [{"key": 1, "token_count": "1"}]}, headers=admin_headers)
+
+    paths = ["/api/planrcplan", "/api/plans/rcplan/visualization", detail_a, detail_b]
+    for path in paths:
+        client.get(path)
+    hits = main.response_cache.stats()["hits"]
+    for path in paths:
+        client.get(path)
+    assert main.response_cache.stats()["hits"] == hits + len(paths)
+
+    client.patch(detail_a + "/row", json={"key": 1, "token_count": "5"}, headers=admin_headers)
+    stats = main.response_cache.stats()
+    assert client.get(detail_a).json()["tokenCountTotal"] == "5.00"
+    assert client.get("/api/plans/rcplan/visualization").json()["overview"]["totalTokenCount"] == 6
+    client.get(detail_b)
+    after = main.response_cache.stats()
+    assert after["misses"] == stats["misses"] + 2
+    assert after["hits"] == stats["hits"] + 1
+
+
+def test_sqlite_backend_is_called_off_the_event_loop(client, admin_headers, monkeypatch):
+    cache = SQLiteResponseCache(os.path.join(tempfile.mkdtemp(), "loop_cache.db"), capacity=16, ttl=60)
+    calls = []
+
+    def recorded(method):
+        def call(*args):
+            try:
+                asyncio.get_running_loop()
+                calls.append((method.__name__, "event loop"))
+            except RuntimeError:
+                calls.append((method.__name__, "thread"))
+            return method(*args)
+        return call
+
+    monkeypatch.setattr(cache, "get", recorded(cache.get))
+    monkeypatch.setattr(cache, "put", recorded(cache.put))
+    monkeypatch.setattr(main, "response_cache", cache)
+
+    client.post("/api/plans", json={"name": "rcloop"}, headers=admin_headers)
+    client.post("/api/plans/rcloop/stages/a/categories/c/x/rows", json={"rows": [{"key": 1}]}, headers=admin_headers)
+    for _ in range(2):
+        assert client.get("/api/plans/rcloop/stages/a/categories/c/x").status_code == 200
+    # 第一次未命中写入，第二次命中；都不在事件循环线程上
+    assert calls == [("get", "thread"), ("put", "thread"), ("get", "thread")]
+    assert cache.stats()["hits"] == 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
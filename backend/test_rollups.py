@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+汇总表测试 - 行的增、改、删、覆盖导入以及删阶段之后，触发器维护的StageRollup/CategoryRollup与全量重算一致
+
+运行: cd backend && pytest test_rollups.py
+"""
+import pytest
+
+import main
+import models
+import spreadsheet
+from database import get_plan_session
+
+PLAN = "rollupplan"
+
+
+def detail_path(stage_name, category_name, subcategory_name):
+    return f"/api/plans/{PLAN}/stages/{stage_name}/categories/{category_name}/{subcategory_name}"
+
+
+def rollups_and_recount(plan_name):
+    """Stage and category rollups as stored, and as recounted from the dataset rows"""
+    plan_db = get_plan_session(plan_name)
+    try:
+        stored = {
+            "stage": {r.stage_id: (r.token_count_sum, r.actual_token_sum, r.dataset_count, r.subcategory_count)
+                      for r in plan_db.query(models.StageRollup)},
+            "category": {(r.stage_id, r.category_name): (r.token_count_sum, r.actual_token_sum, r.dataset_count, r.subcategory_count)
+                         for r in plan_db.query(models.CategoryRollup)},
+        }
+        recounted = {"stage": {}, "category": {}}
+        for detail in plan_db.query(models.CategoryDetail):
+            rows = plan_db.query(models.DatasetRow.token_count, models.DatasetRow.actual_token).filter(
+                models.DatasetRow.detail_id == detail.id
+            ).all()
+            token_sum, actual_sum = main.sum_dataset_row_tokens(rows)
+            for level, key in (("stage", detail.stage_id), ("category", (detail.stage_id, detail.category_name))):
+                totals = recounted[level].get(key, (0.0, 0.0, 0, 0))
+                recounted[level][key] = (totals[0] + token_sum, totals[1] + actual_sum, totals[2] + len(rows), totals[3] + 1)
+        return stored, recounted
+    finally:
+        plan_db.close()
+
+
+def assert_rollups_match(plan_name):
+    stored, recounted = rollups_and_recount(plan_name)
+    for level in ("stage", "category"):
+        # 子类别全被删掉的汇总行允许留着，但必须归零
+        for key in set(stored[level]) - set(recounted[level]):
+            assert stored[level][key] == (pytest.approx(0.0), pytest.approx(0.0), 0, 0), (level, key)
+        for key, (token_sum, actual_sum, dataset_count, subcategory_count) in recounted[level].items():
+            assert stored[level][key] == (pytest.approx(token_sum), pytest.approx(actual_sum), dataset_count, subcategory_count), (level, key)
+    return recounted
+
+
+def test_rollups_follow_row_changes(client, admin_headers):
+    client.post("/api/plans", json={"name": PLAN}, headers=admin_headers)
+
+    # 新增：两个阶段、同一类别下多个子类别
+    for stage_name, category_name, subcategory_name, count in (("s1", "c1", "x", 10), ("s1", "c1", "y", 4),
+                                                               ("s1", "c2", "x", 3), ("s2", "c1", "x", 5)):
+        rows = [{"key": k, "token_count": str(k * 1.5), "actual_token": str(k)} for k in range(1, count + 1)]
+        client.post(detail_path(stage_name, category_name, subcategory_name) + "/rows", json={"rows": rows}, headers=admin_headers)
+    recounted = assert_rollups_match(PLAN.upper())
+    assert sorted(counts[3] for counts in recounted["stage"].values()) == [1, 3]
+
+    # 修改、删除
+    client.patch(detail_path("s1", "c1", "x") + "/row", json={"key": 2, "token_count": "99", "actual_token": "0"}, headers=admin_headers)
+    client.request("DELETE", detail_path("s1", "c1", "y") + "/rows", json={"keys": [1, 2, 3, 4]}, headers=admin_headers)
+    client.request("DELETE", detail_path("s1", "c2", "x") + "/rows", json={"keys": [2]}, headers=admin_headers)
+    assert_rollups_match(PLAN.upper())
+
+    # 覆盖导入、整表保存
+    lines = [",".join(spreadsheet.DATASET_COLUMN_TITLES)] + [f"/data/{i},,,{i},,1" for i in range(7)]
+    client.post(detail_path("s2", "c1", "x") + "/import", headers=admin_headers,
+                files={"file": ("rows.csv", ("\n".join(lines) + "\n").encode("utf-8"), "text/csv")})
+    client.post(detail_path("s1", "c2", "x"), json={"description": "", "rows": [{"key": 1, "token_count": "8"}]}, headers=admin_headers)
+    assert_rollups_match(PLAN.upper())
+
+    # 可视化接口读的就是汇总表
+    visualization = client.get(f"/api/plans/{PLAN}/visualization").json()
+    recounted = rollups_and_recount(PLAN.upper())[1]
+    assert visualization["overview"]["totalTokenCount"] == pytest.approx(sum(t[0] for t in recounted["stage"].values()))
+
+    # 删除阶段时它的汇总一并清掉，其余阶段不受影响
+    plan = client.get(f"/api/plan{PLAN}").json()
+    stages = {name: stage for name, stage in plan["stages"].items() if name != "s1"}
+    assert client.post(f"/api/plan{PLAN}", json={"description": "", "stages": stages}, headers=admin_headers).status_code == 200
+    stored, recounted = rollups_and_recount(PLAN.upper())
+    assert len(stored["stage"]) == len(recounted["stage"]) == 1
+    assert {stage_id for stage_id, _ in stored["category"]} == set(stored["stage"])
+    assert_rollups_match(PLAN.upper())
+
+    # 触发器维护的结果与backfill重建的一致
+    before = rollups_and_recount(PLAN.upper())[0]
+    plan_db = get_plan_session(PLAN.upper())
+    try:
+        main.rebuild_rollups(plan_db)
+        plan_db.commit()
+    finally:
+        plan_db.close()
+    assert rollups_and_recount(PLAN.upper())[0] == before
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+计划保存测试 - 整体保存只写有变化的行和阶段，新行尽量沿用客户端key；JSON Patch接口走同一套差量保存
+
+运行: cd backend && pytest test_save_plan.py
+"""
+import pytest
+
+import models
+from database import get_plan_engine, get_plan_session
+
+WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE")
+
+
+def overview_row(key, category, total_tokens=""):
+    row = {field: "" for field in models.TABLE_ROW_FIELDS}
+    row.update({"key": key, "category": category, "subcategory": "x", "total_tokens": total_tokens})
+    return row
+
+
+def save(client, headers, plan_name, stages, description=""):
+    response = client.post(f"/api/plan{plan_name}", json={"description": description, "stages": stages}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_only_changes_are_written(client, admin_headers, statement_recorder):
+    client.post("/api/plans", json={"name": "saveplan"}, headers=admin_headers)
+    stages = {"s1": {"rows": [overview_row(9001, "a"), overview_row(9002, "b"), overview_row(9003, "c")], "merges": []}}
+    result = save(client, admin_headers, "saveplan", stages)
+    assert (result["inserted"], result["updated"], result["deleted"], result["keys"]) == (3, 0, 0, {})
+    stored = client.get("/api/plansaveplan").json()["stages"]
+    assert stored == stages
+
+    # 原样再存一次：不写任何表
+    with statement_recorder(get_plan_engine("SAVEPLAN"), prefixes=WRITE_PREFIXES) as writes:
+        result = save(client, admin_headers, "saveplan", stored)
+    assert (result["inserted"], result["updated"], result["deleted"]) == (0, 0, 0)
+    assert not [w for w in writes if "table_rows" in w or "stages" in w], writes
+
+    # 改一行、换顺序、删一行、加两行（一个没key，一个key被别的阶段占用）
+    rows = stored["s1"]["rows"]
+    rows[0]["total_tokens"] = "10"
+    edited = [rows[2], rows[0], overview_row(None, "d"), overview_row(9004, "e")]
+    stages = {"s1": {"rows": edited, "merges": [{"row": 0, "col": 0, "rowspan": 2, "colspan": 1}]},
+              "s2": {"rows": [overview_row(9001, "f")], "merges": []}}
+    result = save(client, admin_headers, "saveplan", stages)
+    assert (result["inserted"], result["updated"], result["deleted"]) == (3, 2, 1)
+
+    # 拿到新id的阶段返回该阶段按顺序的全部key
+    stored = client.get("/api/plansaveplan").json()["stages"]
+    assert result["keys"] == {stage: [row["key"] for row in stored[stage]["rows"]] for stage in ("s1", "s2")}
+    assert [row["key"] for row in stored["s1"]["rows"]][:2] == [9003, 9001]
+    assert stored["s1"]["rows"][3]["key"] == 9004
+    assert stored["s2"]["rows"][0]["key"] not in (9001, 9002, 9003, 9004)
+    assert [row["category"] for row in stored["s1"]["rows"]] == ["c", "a", "d", "e"]
+    assert stored["s1"]["rows"][1]["total_tokens"] == "10"
+    assert stored["s1"]["merges"][0]["rowspan"] == 2
+
+
+def test_removed_stage_takes_its_data_along(client, admin_headers):
+    client.post("/api/plans", json={"name": "savedrop"}, headers=admin_headers)
+    save(client, admin_headers, "savedrop", {"s1": {"rows": [overview_row(1, "a")], "merges": []},
+                                             "s2": {"rows": [overview_row(2, "b")], "merges": []}})
+    client.post("/api/plans/savedrop/stages/s1/categories/a/x/rows", json={"rows": [{"key": 1, "token_count": "5"}]},
+                headers=admin_headers)
+
+    result = save(client, admin_headers, "savedrop", {"s2": {"rows": [overview_row(2, "b")], "merges": []}})
+    assert (result["inserted"], result["updated"], result["deleted"]) == (0, 0, 1)
+    plan_db = get_plan_session("SAVEDROP")
+    try:
+        assert [stage.name for stage in plan_db.query(models.Stage)] == ["s2"]
+        assert plan_db.query(models.CategoryDetail).count() == 0
+        assert plan_db.query(models.DatasetRow).count() == 0
+    finally:
+        plan_db.close()
+
+
+@pytest.mark.parametrize("stages", [{"s1": []}, {"s1": {"rows": {}}}, {"s1": {"rows": ["x"]}}])
+def test_malformed_stages_are_rejected(client, admin_headers, stages):
+    client.post("/api/plans", json={"name": "savebad"}, headers=admin_headers)
+    response = client.post("/api/plansavebad", json={"description": "", "stages": stages}, headers=admin_headers)
+    assert response.status_code == 400
+
+
+def test_json_patch_endpoint(client, admin_headers):
+    client.post("/api/plans", json={"name": "patchplan"}, headers=admin_headers)
+    save(client, admin_headers, "patchplan", {"s1": {"rows": [overview_row(1, "a"), overview_row(2, "b")], "merges": []}})
+
+    response = client.patch("/api/planpatchplan", headers=admin_headers, json=[
+        {"op": "test", "path": "/stages/s1/rows/1/category", "value": "b"},
+        {"op": "replace", "path": "/stages/s1/rows/1/total_tokens", "value": "42"},
+        {"op": "add", "path": "/stages/s1/rows/-", "value": overview_row(3, "c")},
+        {"op": "replace", "path": "/description", "value": "打过补丁"},
+    ])
+    assert response.status_code == 200, response.text
+    assert (response.json()["inserted"], response.json()["updated"], response.json()["deleted"]) == (1, 1, 0)
+    plan = client.get("/api/planpatchplan").json()
+    assert plan["description"] == "打过补丁"
+    assert [(row["key"], row["total_tokens"]) for row in plan["stages"]["s1"]["rows"]] == [(1, ""), (2, "42"), (3, "")]
+
+    # 补丁失败或结果不成形时返回400，计划不变
+    for operations in ([{"op": "test", "path": "/description", "value": "别的"}, {"op": "remove", "path": "/stages/s1"}],
+                       [{"op": "replace", "path": "/description", "value": 1}],
+                       [{"op": "replace", "path": "", "value": []}]):
+        assert client.patch("/api/planpatchplan", json=operations, headers=admin_headers).status_code == 400
+    assert client.get("/api/planpatchplan").json() == plan
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
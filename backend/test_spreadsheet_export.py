@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+表格导出测试 - 计划导出每个子类别一个工作表，CSV导出带阶段/类别/子类别列，多工作表导出时打开的文件数不随工作表数增长，不支持的格式和不存在的对象报错
+
+运行: cd backend && pytest test_spreadsheet_export.py
+"""
+import csv
+import gc
+import io
+import os
+
+import pytest
+from openpyxl import load_workbook
+
+import spreadsheet
+
+FD_DIR = "/proc/self/fd"
+
+
+def open_fd_count():
+    return len(os.listdir(FD_DIR))
+
+
+@pytest.mark.skipif(not os.path.isdir(FD_DIR), reason="needs /proc/self/fd")
+def test_many_sheets_keep_fd_count_flat():
+    # 先回收前面测试留下的垃圾（如TestClient每个请求建的事件循环），免得回收时释放的fd混进计数
+    gc.collect()
+    fd_counts = []
+
+    def rows(index):
+        fd_counts.append(open_fd_count())
+        for i in range(3):
+            yield [f"/data/{index}/{i}", "", "", i, "", ""]
+
+    sheets = ((f"c-{index}", spreadsheet.DATASET_COLUMN_TITLES, rows(index)) for index in range(300))
+    content = b"".join(spreadsheet.xlsx_stream(sheets))
+
+    # 未关闭的工作表各占一个临时文件，300个表会多出约300个fd
+    assert max(fd_counts) - min(fd_counts) <= 2
+    workbook = load_workbook(io.BytesIO(content), read_only=True)
+    try:
+        assert len(workbook.sheetnames) == 300
+        sheet = workbook["c-299"]
+        assert [row for row in sheet.iter_rows(values_only=True)][-1][:4] == ("/data/299/2", None, None, 2)
+    finally:
+        workbook.close()
+
+
+def test_plan_export_with_many_subcategories(client, admin_headers):
+    client.post("/api/plans", json={"name": "expmany"}, headers=admin_headers)
+    for index in range(60):
+        client.post(f"/api/plans/expmany/stages/s/categories/c/x{index}/rows",
+                    json={"rows": [{"key": 1, "hdfs_path": f"/data/{index}", "token_count": str(index)}]},
+                    headers=admin_headers)
+
+    response = client.get("/api/plans/expmany/export?format=xlsx")
+    assert response.status_code == 200, response.text
+    workbook = load_workbook(io.BytesIO(response.content), read_only=True)
+    try:
+        # 一个概览表加每个子类别一个表
+        assert len(workbook.sheetnames) == 61
+        assert workbook.sheetnames[0] == "s-概览"
+        assert list(workbook["s-c-x59"].iter_rows(values_only=True))[1][:4] == ("/data/59", None, None, "59")
+    finally:
+        workbook.close()
+
+
+def test_stage_csv_export(client, admin_headers):
+    client.post("/api/plans", json={"name": "expcsv"}, headers=admin_headers)
+    for subcategory_name in ("x", "y"):
+        client.post(f"/api/plans/expcsv/stages/s/categories/c/{subcategory_name}/rows",
+                    json={"rows": [{"key": k, "hdfs_path": f"/{subcategory_name}/{k}", "token_count": str(k)} for k in (1, 2)]},
+                    headers=admin_headers)
+
+    response = client.get("/api/plans/expcsv/stages/s/export?format=csv")
+    assert response.status_code == 200, response.text
+    text = response.content.decode("utf-8")
+    # 带BOM，Excel才能认出UTF-8
+    assert text.startswith("\ufeff")
+    lines = list(csv.reader(io.StringIO(text[1:])))
+    assert lines[0][:3] == ["阶段", "类别", "子类别"]
+    assert [line[:5] for line in lines[1:]] == [
+        ["s", "c", "x", "/x/1", ""], ["s", "c", "x", "/x/2", ""], ["s", "c", "y", "/y/1", ""], ["s", "c", "y", "/y/2", ""]
+    ]
+
+
+def test_export_errors(client, admin_headers):
+    client.post("/api/plans", json={"name": "expcsv"}, headers=admin_headers)
+    assert client.get("/api/plans/expcsv/export?format=pdf").status_code == 400
+    assert client.get("/api/plans/expmissing/export").status_code == 404
+    assert client.get("/api/plans/expcsv/stages/missing/export").status_code == 404
+    assert client.get("/api/plans/expcsv/stages/s/categories/c/missing/export").status_code == 404
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
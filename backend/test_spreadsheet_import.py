@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+表格导入测试 - 上传.xlsx/.csv按批写入子类别：默认覆盖原有行，坏行按表格行号报告，坏文件返回400且不动原数据
+
+运行: cd backend && pytest test_spreadsheet_import.py
+"""
+import io
+
+import pytest
+from openpyxl import Workbook
+
+import main
+import spreadsheet
+
+
+def detail_path(plan_name):
+    return f"/api/plans/{plan_name}/stages/s/categories/c/x"
+
+
+def csv_file(lines):
+    text = "\n".join([",".join(spreadsheet.DATASET_COLUMN_TITLES)] + lines) + "\n"
+    return {"file": ("rows.csv", text.encode("utf-8"), "text/csv")}
+
+
+def xlsx_file(rows):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(spreadsheet.DATASET_COLUMN_TITLES)
+    for row in rows:
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return {"file": ("rows.xlsx", buffer.getvalue(), "application/octet-stream")}
+
+
+def upload(client, headers, plan_name, files, **params):
+    return client.post(detail_path(plan_name) + "/import", files=files, params=params, headers=headers)
+
+
+def test_csv_import_replaces_existing_rows(client, admin_headers):
+    client.post("/api/plans", json={"name": "impcsv"}, headers=admin_headers)
+    client.post(detail_path("impcsv") + "/rows", json={"rows": [{"key": k, "token_count": "100"} for k in range(1, 4)]},
+                headers=admin_headers)
+
+    # 空行跳过，坏行按表格行号报告（表头是第1行）
+    response = upload(client, admin_headers, "impcsv", csv_file(["/a,,,10,,5", ",,,,,", "/b,,,x,,1", "/c,obs://c,,2.5"]))
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert (result["inserted"], result["updated"], result["rejected"], result["total"]) == (2, 0, 1, 2)
+    assert [error["line"] for error in result["errors"]] == [4]
+    assert (result["tokenCountTotal"], result["actualTokenTotal"]) == ("12.50", "5.00")
+    rows = client.get(detail_path("impcsv")).json()["rows"]
+    assert [(row["hdfs_path"], row["obs_fuzzy_path"], row["token_count"]) for row in rows] == [("/a", "", "10"), ("/c", "obs://c", "2.5")]
+
+    # replace=false则追加
+    result = upload(client, admin_headers, "impcsv", csv_file(["/d,,,1"]), replace="false").json()
+    assert (result["inserted"], result["total"], result["tokenCountTotal"]) == (1, 3, "13.50")
+
+
+def test_large_xlsx_replace_spans_batches(client, admin_headers):
+    client.post("/api/plans", json={"name": "impxlsx"}, headers=admin_headers)
+    client.post(detail_path("impxlsx") + "/rows", json={"rows": [{"key": k, "token_count": "7"} for k in range(1, 11)]},
+                headers=admin_headers)
+
+    count = 2 * main.IMPORT_BATCH_SIZE + 500
+    rows = [[f"/data/{i}", f"obs://{i}", "", i, 0.5, 1.5] for i in range(count)]
+    response = upload(client, admin_headers, "impxlsx", xlsx_file(rows))
+    assert response.status_code == 200, response.text
+    result = response.json()
+    # 只有第一批清空旧行，后面的批次追加
+    assert (result["inserted"], result["updated"], result["rejected"], result["total"]) == (count, 0, 0, count)
+    assert result["tokenCountTotal"] == f"{sum(range(count)):.2f}"
+    assert result["actualTokenTotal"] == f"{1.5 * count:.2f}"
+
+    page = client.get(detail_path("impxlsx") + "?page=3&page_size=1000").json()
+    assert page["total"] == count
+    # 数字单元格按表格显示的文本入库，百分比格式以外的小数原样保留
+    assert page["rows"][-1] == {"key": count, "hdfs_path": f"/data/{count - 1}", "obs_fuzzy_path": f"obs://{count - 1}",
+                                "obs_full_path": "", "token_count": str(count - 1), "actual_usage": "0.5", "actual_token": "1.5"}
+
+
+@pytest.mark.parametrize("files,message", [
+    ({"file": ("rows.xlsx", b"not a zip", "application/octet-stream")}, "Invalid Excel file"),
+    ({"file": ("rows.txt", b"a,b", "text/plain")}, "Unsupported file type"),
+    ({"file": ("rows.csv", ",".join(spreadsheet.DATASET_COLUMN_TITLES).encode("utf-8"), "text/csv")}, "no data rows"),
+])
+def test_malformed_files_are_rejected(client, admin_headers, files, message):
+    client.post("/api/plans", json={"name": "impbad"}, headers=admin_headers)
+    response = upload(client, admin_headers, "impbad", files)
+    assert response.status_code == 400
+    assert message in response.json()["detail"]
+
+
+def test_broken_file_keeps_existing_rows(client, admin_headers):
+    client.post("/api/plans", json={"name": "impkeep"}, headers=admin_headers)
+    client.post(detail_path("impkeep") + "/rows", json={"rows": [{"key": 1, "token_count": "3"}]}, headers=admin_headers)
+
+    # 第一批已经写入（并清空了旧行）之后才读到坏字节，整个导入回滚
+    lines = [f"/data/{i},,,1" for i in range(main.IMPORT_BATCH_SIZE + 10)]
+    body = ("\n".join([",".join(spreadsheet.DATASET_COLUMN_TITLES)] + lines) + "\n").encode("utf-8") + b"\xff\xfe,bad\n"
+    response = upload(client, admin_headers, "impkeep", {"file": ("rows.csv", body, "text/csv")})
+    assert response.status_code == 400
+    assert "Invalid CSV file" in response.json()["detail"]
+
+    detail = client.get(detail_path("impkeep")).json()
+    assert (detail["total"], detail["tokenCountTotal"]) == (1, "3.00")
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -91,6 +91,9 @@ export default function CategoryDetail() {
   const [tokenCountTotal, setTokenCountTotal] = useState('0')
   const [actualTokenTotal, setActualTokenTotal] = useState('0')
   const [hoveredRowKey, setHoveredRowKey] = useState(null)
+  const [sortBy, setSortBy] = useState('row_order')
+  const [sortOrder, setSortOrder] = useState('asc')
+  const [searchText, setSearchText] = useState('')
   const autoSaveTimer = useRef(null)
 
   const stageTitle = {
@@ -102,7 +105,7 @@ export default function CategoryDetail() {
 
   useEffect(() => {
     loadData()
-  }, [planName, stageName, categoryName, subcategoryName, currentPage, pageSize])
+  }, [planName, stageName, categoryName, subcategoryName, currentPage, pageSize, sortBy, sortOrder, searchText])
 
   useEffect(() => {
     if (!isAdmin()) return
@@ -118,7 +121,13 @@ export default function CategoryDetail() {
   const loadData = async () => {
     try {
       const res = await axios.get(`/api/plans/${planName}/stages/${stageName}/categories/${categoryName}/${subcategoryName}`, {
-        params: { page: currentPage, page_size: pageSize }
+        params: {
+          page: currentPage,
+          page_size: pageSize,
+          sort_by: sortBy,
+          sort_order: sortOrder,
+          search: searchText || undefined
+        }
       })
       setDescription(res.data.description || '')
       setRows(res.data.rows || [])
@@ -161,6 +170,23 @@ export default function CategoryDetail() {
     }
   }
 
+  const handleTableChange = (pagination, filters, sorter, extra) => {
+    if (extra.action !== 'sort') return
+    if (sorter.order) {
+      setSortBy(sorter.field)
+      setSortOrder(sorter.order === 'descend' ? 'desc' : 'asc')
+    } else {
+      setSortBy('row_order')
+      setSortOrder('asc')
+    }
+    setCurrentPage(1)
+  }
+
+  const handleSearch = (value) => {
+    setSearchText(value.trim())
+    setCurrentPage(1)
+  }
+
   const handleRowClick = (record) => {
     setExpandedRowKeys(prev => {
       if (prev.includes(record.key)) {
@@ -280,6 +306,8 @@ export default function CategoryDetail() {
       dataIndex: 'token_count',
       key: 'token_count',
       width: 150,
+      sorter: true,
+      sortOrder: sortBy === 'token_count' ? (sortOrder === 'desc' ? 'descend' : 'ascend') : null,
       render: (value, record) => (
         <EditableCell
           value={value}
@@ -308,6 +336,8 @@ export default function CategoryDetail() {
       dataIndex: 'actual_token',
       key: 'actual_token',
       width: 150,
+      sorter: true,
+      sortOrder: sortBy === 'actual_token' ? (sortOrder === 'desc' ? 'descend' : 'ascend') : null,
       render: (value, record) => (
         <EditableCell
           value={value}
@@ -328,163 +358,50 @@ export default function CategoryDetail() {
     message.success('模板下载成功')
   }
 
-  const downloadExcel = async () => {
-    try {
-      // 获取所有数据（不分页）
-      const res = await axios.get(`/api/plans/${planName}/stages/${stageName}/categories/${categoryName}/${subcategoryName}`, {
-        params: { page: 1, page_size: 999999 }
-      })
-      const allRows = res.data.rows || []
-
-      const headers = ['v3词表hdfs路径', 'obs模糊路径', 'obs补全路径', '数据集总token', '实际使用', '实际使用token']
-      const data = allRows.map(row => [
-        row.hdfs_path || '',
-        row.obs_fuzzy_path || '',
-        row.obs_full_path || '',
-        row.token_count || '',
-        row.actual_usage || '',
-        row.actual_token || ''
-      ])
-
-      const ws = XLSX.utils.aoa_to_sheet([headers, ...data])
-      const wb = XLSX.utils.book_new()
-      XLSX.utils.book_append_sheet(wb, ws, 'Data')
-
-      const filename = `${planName}_${stageName}_${decodeURIComponent(categoryName)}_${decodeURIComponent(subcategoryName)}_数据表.xlsx`
-      XLSX.writeFile(wb, filename)
-      message.success('导出成功')
-    } catch (error) {
-      console.error('Export error:', error)
-      message.error('导出失败')
-    }
+  const downloadExcel = () => {
+    // 由服务端流式生成文件，浏览器直接下载
+    const link = document.createElement('a')
+    link.href = `/api/plans/${planName}/stages/${stageName}/categories/${categoryName}/${subcategoryName}/export`
+    document.body.appendChild(link)
+    link.click()
+    document.body.removeChild(link)
+    message.success('开始导出')
   }
 
-  const handleImport = (file) => {
-    const reader = new FileReader()
-    reader.onload = async (e) => {
-      try {
-        const data = new Uint8Array(e.target.result)
-        // 使用 raw: true 保持原始值，包括完整精度的数字
-        const workbook = XLSX.read(data, { type: 'array', raw: true })
-        const sheet = workbook.Sheets[workbook.SheetNames[0]]
-
-        // 手动读取每个单元格，保留原始文本
-        const range = XLSX.utils.decode_range(sheet['!ref'])
-        const jsonData = []
-
-        for (let row = range.s.r; row <= range.e.r; row++) {
-          const rowData = []
-          for (let col = range.s.c; col <= range.e.c; col++) {
-            const cellAddress = XLSX.utils.encode_cell({ r: row, c: col })
-            const cell = sheet[cellAddress]
-
-            if (!cell) {
-              rowData.push('')
-              continue
-            }
-
-            // 优先使用原始文本 w，如果没有则使用格式化值 v
-            let cellValue = ''
-            if (cell.w !== undefined) {
-              cellValue = String(cell.w)  // 保留显示的文本，如 "8.125%"
-            } else if (cell.v !== undefined) {
-              cellValue = String(cell.v)
-            }
-
-            rowData.push(cellValue)
-          }
-          jsonData.push(rowData)
-        }
-
-        // 跳过标题行，生成数据行
-        const newRows = jsonData.slice(1).filter(row => row.some(cell => cell)).map((row, idx) => ({
-          key: Date.now() + idx,
-          hdfs_path: String(row[0] || ''),
-          obs_fuzzy_path: String(row[1] || ''),
-          obs_full_path: String(row[2] || ''),
-          token_count: String(row[3] || ''),
-          actual_usage: String(row[4] || ''),
-          actual_token: String(row[5] || '')
-        }))
-
-        if (newRows.length === 0) {
-          message.warning('Excel文件中没有数据')
-          return
-        }
-
-        // 【覆盖模式】第一步：清空现有数据
-        message.loading({ content: '正在清空现有数据...', key: 'import', duration: 0 })
-
-        try {
-          // 先删除所有现有数据（获取所有keys）
-          const currentDataRes = await axios.get(
-            `/api/plans/${planName}/stages/${stageName}/categories/${categoryName}/${subcategoryName}`,
-            { params: { page: 1, page_size: 999999 } }
-          )
-
-          const allCurrentRows = currentDataRes.data.rows || []
-          if (allCurrentRows.length > 0) {
-            const allKeys = allCurrentRows.map(r => r.key)
-            await axios.delete(
-              `/api/plans/${planName}/stages/${stageName}/categories/${categoryName}/${subcategoryName}/rows`,
-              { data: { keys: allKeys } }
-            )
-          }
-
-          // 第二步：逐行导入新数据（显示进度）
-          message.loading({ content: `正在导入数据... (0/${newRows.length})`, key: 'import', duration: 0 })
-
-          let successCount = 0
-          let lastTokenTotal = '0'
-          let lastActualTotal = '0'
-
-          for (let i = 0; i < newRows.length; i++) {
-            const row = newRows[i]
-            try {
-              const res = await axios.patch(
-                `/api/plans/${planName}/stages/${stageName}/categories/${categoryName}/${subcategoryName}/row`,
-                row
-              )
-              successCount++
-
-              // 保存最后的Token统计
-              if (res.data) {
-                lastTokenTotal = res.data.tokenCountTotal || '0'
-                lastActualTotal = res.data.actualTokenTotal || '0'
-              }
-
-              // 更新进度
-              message.loading({
-                content: `正在导入数据... (${successCount}/${newRows.length})`,
-                key: 'import',
-                duration: 0
-              })
-            } catch (error) {
-              console.error(`导入第 ${i + 1} 行失败:`, error)
-            }
-          }
-
-          // 更新Token统计显示
-          setTokenCountTotal(lastTokenTotal)
-          setActualTokenTotal(lastActualTotal)
+  const handleImport = async (file) => {
+    // 【覆盖模式】文件直接上传到服务端解析并写入
+    message.loading({ content: '正在导入数据...', key: 'import', duration: 0 })
 
-          message.success({ content: `成功导入 ${successCount} 条数据（覆盖模式）`, key: 'import' })
+    try {
+      const formData = new FormData()
+      formData.append('file', file)
+      const res = await axios.post(
+        `/api/plans/${planName}/stages/${stageName}/categories/${categoryName}/${subcategoryName}/import`,
+        formData,
+        { params: { replace: true } }
+      )
 
-          // 重新加载第一页数据
-          setCurrentPage(1)
-          loadData(1)
-        } catch (error) {
-          console.error('Import error:', error)
-          message.error({ content: '导入失败: ' + (error.response?.data?.detail || error.message), key: 'import' })
-        }
+      // 更新Token统计显示
+      setTokenCountTotal(res.data.tokenCountTotal || '0')
+      setActualTokenTotal(res.data.actualTokenTotal || '0')
 
-      } catch (error) {
-        console.error('Import error:', error)
-        message.error({ content: '导入失败: ' + error.message, key: 'import' })
+      if (res.data.rejected > 0) {
+        console.warn('导入时被拒绝的行:', res.data.errors)
+        message.warning({
+          content: `成功导入 ${res.data.inserted} 条数据（覆盖模式），${res.data.rejected} 条数据格式错误未导入`,
+          key: 'import'
+        })
+      } else {
+        message.success({ content: `成功导入 ${res.data.inserted} 条数据（覆盖模式）`, key: 'import' })
       }
+
+      // 重新加载第一页数据
+      setCurrentPage(1)
+      loadData(1)
+    } catch (error) {
+      console.error('Import error:', error)
+      message.error({ content: '导入失败: ' + (error.response?.data?.detail || error.message), key: 'import' })
     }
-    reader.readAsArrayBuffer(file)
-    return false
   }
 
   const insertRow = async () => {
@@ -565,7 +482,7 @@ export default function CategoryDetail() {
         <Button icon={<DownloadOutlined />} onClick={downloadExcel} type="primary">导出Excel</Button>
         {isAdmin() && (
           <>
-            <Upload beforeUpload={handleImport} showUploadList={false}>
+            <Upload accept=".xlsx,.xlsm,.csv" beforeUpload={(file) => { handleImport(file); return false }} showUploadList={false}>
               <Button icon={<UploadOutlined />}>导入Excel</Button>
             </Upload>
             <Button icon={<PlusOutlined />} onClick={insertRow}>插入空行</Button>
@@ -574,6 +491,13 @@ export default function CategoryDetail() {
         )}
       </Space>
 
+      <Input.Search
+        allowClear
+        placeholder="按hdfs路径或obs补全路径搜索"
+        onSearch={handleSearch}
+        style={{ marginBottom: 8, maxWidth: 400 }}
+      />
+
       <div style={{ marginBottom: 8, color: '#666', fontSize: 12 }}>
         提示：单击行展开查看完整内容，双击单元格可编辑数据
       </div>
@@ -595,6 +519,7 @@ export default function CategoryDetail() {
             setPageSize(size)
           }
         }}
+        onChange={handleTableChange}
         bordered
         size="small"
         scroll={{ x: 1500 }}
@@ -61,11 +61,26 @@ export default function PlanDetail() {
     }
   }
 
+  // 服务端为新行分配了不同的key时，按行序同步回本地，下次保存才能按key匹配
+  const adoptRowKeys = (keys) => {
+    if (!keys || Object.keys(keys).length === 0) return
+    setStages(prev => {
+      const next = { ...prev }
+      Object.entries(keys).forEach(([stageKey, rowKeys]) => {
+        const stage = next[stageKey]
+        if (!stage || stage.rows.length !== rowKeys.length) return
+        next[stageKey] = { ...stage, rows: stage.rows.map((row, idx) => ({ ...row, key: rowKeys[idx] })) }
+      })
+      return next
+    })
+  }
+
   const saveData = async (isAutoSave = false) => {
     if (!isAdmin()) return
     setLoading(true)
     try {
-      await axios.post(`/api/plan${planName}`, { description, stages })
+      const res = await axios.post(`/api/plan${planName}`, { description, stages })
+      adoptRowKeys(res.data.keys)
       if (!isAutoSave) message.success('保存成功')
     } catch (error) {
       console.error('Save error:', error)
@@ -193,37 +208,22 @@ export default function PlanDetail() {
     message.success('模板下载成功')
   }
 
-  const downloadStageExcel = (stageKey) => {
-    const stageData = stages[stageKey]
-    if (!stageData || !stageData.rows || stageData.rows.length === 0) {
-      message.warning('该阶段暂无数据')
-      return
-    }
+  // 由服务端流式生成文件：概览表 + 每个子类别一个sheet
+  const startDownload = (url) => {
+    const link = document.createElement('a')
+    link.href = url
+    document.body.appendChild(link)
+    link.click()
+    document.body.removeChild(link)
+    message.success('开始导出')
+  }
 
-    const headers = columns.map(col => col.title)
-    const data = stageData.rows.map(row => [
-      row.category || '',
-      row.subcategory || '',
-      row.total_tokens || '',
-      row.sample_ratio || '',
-      row.cumulative_ratio || '',
-      row.sample_tokens || '',
-      row.category_ratio || '',
-      row.part1 || '',
-      row.part2 || '',
-      row.part3 || '',
-      row.part4 || '',
-      row.part5 || '',
-      row.note || ''
-    ])
-
-    const ws = XLSX.utils.aoa_to_sheet([headers, ...data])
-    const wb = XLSX.utils.book_new()
-    XLSX.utils.book_append_sheet(wb, ws, 'Data')
+  const downloadStageExcel = (stageKey) => {
+    startDownload(`/api/plans/${planName}/stages/${stageKey}/export`)
+  }
 
-    const filename = `${planName}_${stageKey}_概览表.xlsx`
-    XLSX.writeFile(wb, filename)
-    message.success('导出成功')
+  const downloadPlanExcel = () => {
+    startDownload(`/api/plans/${planName}/export`)
   }
 
   const handleImport = (file, stageKey) => {
@@ -655,15 +655,18 @@ export default function PlanDetail() {
     <div>
       <div style={{ display: 'flex', justifyContent: 'space-between', alignItems: 'center', marginBottom: 16 }}>
         <Title level={2} style={{ margin: 0 }}>{planName.toUpperCase()} 训练计划</Title>
-        {isAdmin() && (
-          <Button
-            type="primary"
-            icon={<PlusOutlined />}
-            onClick={handleAddStage}
-          >
-            添加Stage
-          </Button>
-        )}
+        <Space>
+          <Button icon={<DownloadOutlined />} onClick={downloadPlanExcel}>导出整个计划</Button>
+          {isAdmin() && (
+            <Button
+              type="primary"
+              icon={<PlusOutlined />}
+              onClick={handleAddStage}
+            >
+              添加Stage
+            </Button>
+          )}
+        </Space>
       </div>
 
       <div style={{ marginBottom: 24, padding: 16, background: '#f5f5f5', borderRadius: 8 }}>